@@ -26,6 +26,7 @@ os.umask(022)
 # project
 from checks.check_status import CollectorStatus
 from checks.collector import Collector
+from checks.scheduler import next_run_time
 from config import (
     get_config,
     get_parsed_args,
@@ -163,9 +164,16 @@ class Agent(Daemon):
 
         profiled = False
         collector_profiled_runs = 0
+        next_collection = time.time()
 
         # Run the main loop.
         while self.run_forever:
+            # Between collection runs, only run the checks.d instances which are due
+            if time.time() < next_collection:
+                self.collector.run_due_checks()
+                self._sleep_until(next_collection)
+                continue
+
             log.debug("Found {num_checks} checks".format(num_checks=len(self._checksd['initialized_checks'])))
 
             # Setup profiling if necessary
@@ -183,6 +191,8 @@ class Agent(Daemon):
                                configs_reloaded=self.configs_reloaded)
             if self.configs_reloaded:
                 self.configs_reloaded = False
+            # Stay aligned on the check frequency however long the run took
+            next_collection = next_run_time(next_collection, self.check_frequency, time.time())
             if profiled:
                 if collector_profiled_runs >= self.collector_profile_interval:
                     try:
@@ -202,8 +212,7 @@ class Agent(Daemon):
                     watchdog.reset()
                 if profiled:
                     collector_profiled_runs += 1
-                log.debug("Sleeping for {0} seconds".format(self.check_frequency))
-                time.sleep(self.check_frequency)
+                self._sleep_until(next_collection)
 
         # Now clean-up.
         try:
@@ -215,6 +224,21 @@ class Agent(Daemon):
         log.info("Exiting. Bye bye.")
         sys.exit(0)
 
+    def _sleep_until(self, next_collection):
+        """
+        Sleep until the next collection run, or until a checks.d instance
+        is due before it.
+        """
+        wake_up = next_collection
+        next_check_run = self.collector.get_next_check_run_time()
+        if next_check_run is not None:
+            wake_up = min(wake_up, next_check_run)
+
+        delay = wake_up - time.time()
+        if delay > 0 and self.run_forever:
+            log.debug("Sleeping for {0} seconds".format(round(delay, 2)))
+            time.sleep(delay)
+
     def _get_emitters(self):
         return [http_emitter]
 
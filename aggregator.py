@@ -1,6 +1,7 @@
 # stdlib
 import logging
-from time import time
+import math
+from time import sleep, time
 
 # project
 from checks.metric_types import MetricTypes
@@ -19,6 +20,24 @@ log = logging.getLogger(__name__)
 # MetricsBucketAggregator constructor.
 RECENT_POINT_THRESHOLD_DEFAULT = 3600
 
+# Max number of distinct tags fields of dogstatsd packets whose parsing is
+# cached. The cache is emptied when full.
+TAGS_CACHE_SIZE = 10000
+
+# Max number of contexts in each generation of a ContextRegistry
+CONTEXT_REGISTRY_SIZE = 100000
+
+# Relative accuracy of the quantiles of the sketch histograms, see QuantileSketch
+SKETCH_RELATIVE_ACCURACY = 0.01
+# Max number of bins per sign of a QuantileSketch, which bounds its memory usage
+SKETCH_MAX_BINS = 2048
+# Values closer to zero than this are counted as zeros by a QuantileSketch
+SKETCH_MIN_VALUE = 1e-9
+
+# How often a flush checks whether a submit_packets call running in another
+# thread is done with the metrics it swapped out
+INGEST_WAIT_INTERVAL = 0.0005
+
 
 class Infinity(Exception):
     pass
@@ -42,6 +61,10 @@ class Metric(object):
         """ Flush all metrics up to the given timestamp. """
         raise NotImplementedError()
 
+    def merge(self, other):
+        """ Fold the points of another metric of the same context into this one. """
+        raise NotImplementedError()
+
 
 class Gauge(Metric):
     """ A metric that tracks a value at particular points in time. """
@@ -61,6 +84,12 @@ class Gauge(Metric):
         self.last_sample_time = time()
         self.timestamp = timestamp
 
+    def merge(self, other):
+        # The most recently sampled value wins, as it would have with a single sample() stream
+        if other.value is not None and other.last_sample_time >= self.last_sample_time:
+            self.value = other.value
+            self.timestamp = other.timestamp
+            self.last_sample_time = other.last_sample_time
 
     def flush(self, timestamp, interval):
         if self.value is not None:
@@ -201,6 +230,10 @@ class Counter(Metric):
         self.value += value * int(1 / sample_rate)
         self.last_sample_time = time()
 
+    def merge(self, other):
+        self.value += other.value
+        self.last_sample_time = max(self.last_sample_time, other.last_sample_time)
+
     def flush(self, timestamp, interval):
         try:
             value = self.value / interval
@@ -217,9 +250,11 @@ class Counter(Metric):
         finally:
             self.value = 0
 
+
 DEFAULT_HISTOGRAM_AGGREGATES = ['max', 'median', 'avg', 'count']
 DEFAULT_HISTOGRAM_PERCENTILES = [0.95]
 
+
 class Histogram(Metric):
     """ A metric to track the distribution of a set of values. """
 
@@ -244,6 +279,11 @@ class Histogram(Metric):
         self.samples.append(value)
         self.last_sample_time = time()
 
+    def merge(self, other):
+        self.count += other.count
+        self.samples.extend(other.samples)
+        self.last_sample_time = max(self.last_sample_time, other.last_sample_time)
+
     def flush(self, ts, interval):
         if not self.count:
             return []
@@ -255,7 +295,17 @@ class Histogram(Metric):
         max_ = self.samples[-1]
         med = self.samples[int(round(length/2 - 1))]
         avg = sum(self.samples) / float(length)
+        percentile_values = [self.samples[int(round(p * length - 1))] for p in self.percentiles]
+
+        metrics = self._format_metrics(ts, interval, min_, max_, med, avg, percentile_values)
 
+        # Reset our state.
+        self.samples = []
+        self.count = 0
+
+        return metrics
+
+    def _format_metrics(self, ts, interval, min_, max_, med, avg, percentile_values):
         aggregators = [
             ('min', min_, MetricTypes.GAUGE),
             ('max', max_, MetricTypes.GAUGE),
@@ -281,8 +331,7 @@ class Histogram(Metric):
             interval=interval) for suffix, value, metric_type in metric_aggrs
         ]
 
-        for p in self.percentiles:
-            val = self.samples[int(round(p * length - 1))]
+        for p, val in zip(self.percentiles, percentile_values):
             name = '%s.%spercentile' % (self.name, int(p * 100))
             metrics.append(self.formatter(
                 hostname=self.hostname,
@@ -294,8 +343,161 @@ class Histogram(Metric):
                 interval=interval,
             ))
 
+        return metrics
+
+
+class QuantileSketch(object):
+    """
+    A mergeable quantile sketch using a bounded amount of memory (DDSketch).
+
+    Values are counted in logarithmically sized bins, bin `i` holding the
+    values of ]gamma^(i-1), gamma^i] with gamma = (1 + a) / (1 - a), `a`
+    being the relative accuracy. A value is estimated by the middle of its
+    bin, so any quantile estimate q' of a quantile q satisfies
+    |q' - q| <= a * |q|.
+    This holds as long as `max_bins` bins per sign are enough to cover the
+    values (with a = 1%, 2048 bins span 17 orders of magnitude). Past that,
+    the bins of the smallest magnitudes are collapsed together, which only
+    degrades the accuracy of the quantiles closest to zero.
+    Negative values have their own bins, and values too close to zero are
+    counted as zeros.
+    """
+
+    def __init__(self, relative_accuracy=SKETCH_RELATIVE_ACCURACY, max_bins=SKETCH_MAX_BINS):
+        self.relative_accuracy = relative_accuracy
+        self.gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self.log_gamma = math.log(self.gamma)
+        self.max_bins = max_bins
+
+        # bin index -> number of values
+        self.positive_bins = {}
+        self.negative_bins = {}
+        self.zero_count = 0
+
+        self.count = 0
+        self.min = None
+        self.max = None
+        self.sum = 0
+
+    def add(self, value):
+        if value > SKETCH_MIN_VALUE:
+            bins = self.positive_bins
+            index = int(math.ceil(math.log(value) / self.log_gamma))
+        elif value < -SKETCH_MIN_VALUE:
+            bins = self.negative_bins
+            index = int(math.ceil(math.log(-value) / self.log_gamma))
+        else:
+            bins = None
+            self.zero_count += 1
+
+        if bins is not None:
+            bins[index] = bins.get(index, 0) + 1
+            if len(bins) > self.max_bins:
+                self._collapse(bins)
+
+        self.count += 1
+        self.sum += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+
+    def merge(self, other):
+        """ Add the values counted by another sketch with the same accuracy to this one. """
+        for bins, other_bins in ((self.positive_bins, other.positive_bins),
+                                 (self.negative_bins, other.negative_bins)):
+            for index, count in other_bins.iteritems():
+                bins[index] = bins.get(index, 0) + count
+            if len(bins) > self.max_bins:
+                self._collapse(bins)
+
+        self.zero_count += other.zero_count
+        self.count += other.count
+        self.sum += other.sum
+        if other.count:
+            self.min = other.min if self.min is None else min(self.min, other.min)
+            self.max = other.max if self.max is None else max(self.max, other.max)
+
+    def _collapse(self, bins):
+        """ Fold the bins of the smallest magnitudes into one to get back to `max_bins` bins. """
+        indexes = sorted(bins)
+        excess = indexes[:len(indexes) - self.max_bins + 1]
+        target = excess[-1]
+        for index in excess[:-1]:
+            bins[target] += bins.pop(index)
+
+    def _bin_value(self, index):
+        return 2 * self.gamma ** index / (self.gamma + 1)
+
+    def values_at_ranks(self, ranks):
+        """
+        Estimates of the values at the given ranks (0-based) of the sorted
+        values, clamped to the exact min and max.
+        """
+        def sorted_bins():
+            for index in sorted(self.negative_bins, reverse=True):
+                yield -self._bin_value(index), self.negative_bins[index]
+            if self.zero_count:
+                yield 0, self.zero_count
+            for index in sorted(self.positive_bins):
+                yield self._bin_value(index), self.positive_bins[index]
+
+        values = {}
+        bins = sorted_bins()
+        seen = 0
+        value = self.min
+        for rank in sorted(set(ranks)):
+            while seen <= rank:
+                try:
+                    value, count = next(bins)
+                except StopIteration:
+                    break
+                seen += count
+            values[rank] = min(max(value, self.min), self.max)
+
+        return [values[rank] for rank in ranks]
+
+
+class SketchHistogram(Histogram):
+    """
+    A histogram keeping its samples in a QuantileSketch instead of a list:
+    its memory usage and flush time don't depend on the number of samples.
+    min, max, avg and count are exact, median and percentiles are within
+    SKETCH_RELATIVE_ACCURACY of the exact values.
+    """
+
+    def __init__(self, formatter, name, tags, hostname, device_name, extra_config=None):
+        super(SketchHistogram, self).__init__(formatter, name, tags, hostname, device_name, extra_config)
+        self.samples = None
+        self.sketch = QuantileSketch()
+
+    def sample(self, value, sample_rate, timestamp=None):
+        self.count += int(1 / sample_rate)
+        self.sketch.add(value)
+        self.last_sample_time = time()
+
+    def merge(self, other):
+        self.count += other.count
+        self.sketch.merge(other.sketch)
+        self.last_sample_time = max(self.last_sample_time, other.last_sample_time)
+
+    def flush(self, ts, interval):
+        if not self.count:
+            return []
+
+        sketch = self.sketch
+        length = sketch.count
+
+        # Same ranks as the exact histogram, negative ones included
+        ranks = [int(round(length/2 - 1))] + [int(round(p * length - 1)) for p in self.percentiles]
+        ranks = [rank + length if rank < 0 else rank for rank in ranks]
+        values = sketch.values_at_ranks(ranks)
+
+        avg = sketch.sum / float(length)
+        metrics = self._format_metrics(ts, interval, sketch.min, sketch.max, values[0], avg, values[1:])
+
         # Reset our state.
-        self.samples = []
+        self.sketch = QuantileSketch()
         self.count = 0
 
         return metrics
@@ -317,6 +519,10 @@ class Set(Metric):
         self.values.add(value)
         self.last_sample_time = time()
 
+    def merge(self, other):
+        self.values.update(other.values)
+        self.last_sample_time = max(self.last_sample_time, other.last_sample_time)
+
     def flush(self, timestamp, interval):
         if not self.values:
             return []
@@ -387,6 +593,57 @@ class Rate(Metric):
         finally:
             self.samples = self.samples[-1:]
 
+class ContextRegistry(object):
+    """
+    Interns metric contexts: maps the (name, tags, hostname, device_name)
+    submitted to an aggregator to its canonical context, so that tags are
+    only deduped and sorted the first time a series is seen.
+
+    Contexts unused for `expiry_seconds` are forgotten. The registry keeps
+    two generations looked up in turn, the oldest one is dropped every
+    `expiry_seconds`, or earlier when the current one holds `max_size` contexts.
+    """
+
+    def __init__(self, expiry_seconds, max_size=CONTEXT_REGISTRY_SIZE):
+        self.expiry_seconds = expiry_seconds
+        self.max_size = max_size
+        self._contexts = {}
+        self._previous_contexts = {}
+        self._last_rotation = time()
+
+    def __len__(self):
+        return len(self._contexts)
+
+    def get_context(self, name, tags, hostname, device_name):
+        if tags is not None and tags.__class__ is not tuple:
+            tags = tuple(tags)
+        key = (name, tags, hostname, device_name)
+
+        context = self._contexts.get(key)
+        if context is None:
+            context = self._previous_contexts.get(key)
+            if context is None:
+                if tags is None:
+                    context = (name, tuple(), hostname, device_name)
+                else:
+                    context = (name, tuple(sorted(set(tags))), hostname, device_name)
+            if len(self._contexts) >= self.max_size:
+                self.rotate()
+            self._contexts[key] = context
+
+        return context
+
+    def rotate(self):
+        self._previous_contexts = self._contexts
+        self._contexts = {}
+        self._last_rotation = time()
+
+    def expire(self, timestamp):
+        """ To call at flush time, drops the contexts unused since the last rotation. """
+        if timestamp - self._last_rotation >= self.expiry_seconds:
+            self.rotate()
+
+
 class Aggregator(object):
     """
     Abstract metric aggregator class.
@@ -397,13 +654,18 @@ class Aggregator(object):
     def __init__(self, hostname, interval=1.0, expiry_seconds=300,
             formatter=None, recent_point_threshold=None,
             histogram_aggregates=None, histogram_percentiles=None,
-            utf8_decoding=False):
+            utf8_decoding=False, histogram_backend=None):
         self.events = []
         self.service_checks = []
         self.total_count = 0
         self.count = 0
         self.event_count = 0
         self.service_check_count = 0
+        # {listener: number of datagrams it received}
+        self.listener_packet_counts = {}
+        # Datagrams forwarded to another statsd server, or dropped instead
+        self.forwarded_count = 0
+        self.forward_dropped_count = 0
         self.hostname = hostname
         self.expiry_seconds = expiry_seconds
         self.formatter = formatter or api_formatter
@@ -420,9 +682,18 @@ class Aggregator(object):
                 'percentiles': histogram_percentiles
             }
         }
+        self.metric_config[SketchHistogram] = self.metric_config[Histogram]
+
+        # Class of the 'h' and 'ms' metrics
+        self.histogram_class = SketchHistogram if histogram_backend == 'sketch' else Histogram
 
         self.utf8_decoding = utf8_decoding
 
+        # Raw tags field of the packets -> (hostname, device_name, tags)
+        self._tags_cache = {}
+        self._context_registry = ContextRegistry(expiry_seconds)
+        self._ingest_epoch = 0
+
     def packets_per_second(self, interval):
         if interval == 0:
             return 0
@@ -432,28 +703,25 @@ class Aggregator(object):
         """
         Schema of a dogstatsd packet:
         <name>:<value>|<metric_type>|@<sample_rate>|#<tag1_name>:<tag1_value>,<tag2_name>:<tag2_value>:<value>|<metric_type>...
+
+        Returns a list of (name, value, metric_type, hostname, device_name, tags, sample_rate),
+        the host and device magic tags being already extracted from the tags.
         """
         parsed_packets = []
-        name_and_metadata = packet.split(':', 1)
+        name, separator, metadata = packet.partition(':')
 
-        if len(name_and_metadata) != 2:
+        if not separator:
             raise Exception('Unparseable metric packet: %s' % packet)
 
-        name = name_and_metadata[0]
-        broken_split = name_and_metadata[1].split(':')
-        data = []
-        partial_datum = None
-        for token in broken_split:
-            # We need to fix the tag groups that got broken by the : split
-            if partial_datum is None:
-                partial_datum = token
-            elif "|" not in token:
-                partial_datum += ":" + token
-            else:
-                data.append(partial_datum)
-                partial_datum = token
-        data.append(partial_datum)
+        # A ':' followed by a '|' starts another value of the same metric,
+        # the other ones belong to tags
+        first_colon = metadata.find(':')
+        if first_colon == -1 or first_colon > metadata.rfind('|'):
+            data = (metadata,)
+        else:
+            data = self._split_metric_values(metadata)
 
+        tags_cache = self._tags_cache
         for datum in data:
             value_and_metadata = datum.split('|')
 
@@ -466,6 +734,8 @@ class Aggregator(object):
 
             if metric_type in self.ALLOW_STRINGS:
                 value = raw_value
+            elif raw_value.isdigit():
+                value = int(raw_value)
             else:
                 # Try to cast as an int first to avoid precision issues, then as a
                 # float.
@@ -478,9 +748,10 @@ class Aggregator(object):
                         # Otherwise, raise an error saying it must be a number
                         raise Exception('Metric value must be a number: %s, %s' % (name, raw_value))
 
-
             # Parse the optional values - sample rate & tags.
             sample_rate = 1
+            hostname = None
+            device_name = None
             tags = None
             for m in value_and_metadata[2:]:
                 # Parse the sample rate
@@ -488,12 +759,47 @@ class Aggregator(object):
                     sample_rate = float(m[1:])
                     assert 0 <= sample_rate <= 1
                 elif m[0] == '#':
-                    tags = tuple(sorted(m[1:].split(',')))
+                    parsed_tags = tags_cache.get(m)
+                    if parsed_tags is None:
+                        parsed_tags = self._parse_tags(m)
+                    hostname, device_name, tags = parsed_tags
 
-            parsed_packets.append((name, value, metric_type, tags,sample_rate))
+            parsed_packets.append((name, value, metric_type, hostname, device_name, tags, sample_rate))
 
         return parsed_packets
 
+    def _split_metric_values(self, metadata):
+        """
+        Split the metadata of a packet carrying several values, e.g.
+        `1|c|#tag:a:2|c` into `['1|c|#tag:a', '2|c']`.
+        """
+        data = []
+        partial_datum = None
+        for token in metadata.split(':'):
+            # We need to fix the tag groups that got broken by the : split
+            if partial_datum is None:
+                partial_datum = token
+            elif "|" not in token:
+                partial_datum += ":" + token
+            else:
+                data.append(partial_datum)
+                partial_datum = token
+        data.append(partial_datum)
+        return data
+
+    def _parse_tags(self, raw_tags):
+        """
+        Parse a `#tag1,tag2` packet field into (hostname, device_name, tags)
+        and cache the result: most packets reuse the same few tag strings.
+        """
+        tags_cache = self._tags_cache
+        if len(tags_cache) >= TAGS_CACHE_SIZE:
+            tags_cache.clear()
+
+        parsed_tags = self._extract_magic_tags(tuple(sorted(raw_tags[1:].split(','))))
+        tags_cache[raw_tags] = parsed_tags
+        return parsed_tags
+
     def _unescape_sc_content(self, string):
         return string.replace('\\n', '\n').replace('m\:', 'm:')
 
@@ -587,26 +893,51 @@ class Aggregator(object):
         if self.utf8_decoding:
             packets = unicode(packets, 'utf-8', errors='replace')
 
-        for packet in packets.splitlines():
-            if not packet.strip():
-                continue
+        # Odd while submitting, lets a flush running in another thread know
+        # when we're done with the metrics table it swapped out
+        self._ingest_epoch += 1
+        try:
+            for packet in packets.splitlines():
+                if not packet.strip():
+                    continue
+
+                if packet.startswith('_e'):
+                    self.event_count += 1
+                    event = self.parse_event_packet(packet)
+                    self.event(**event)
+                elif packet.startswith('_sc'):
+                    self.service_check_count += 1
+                    service_check = self.parse_sc_packet(packet)
+                    self.service_check(**service_check)
+                else:
+                    self.count += 1
+                    parsed_packets = self.parse_metric_packet(packet)
+                    for name, value, mtype, hostname, device_name, tags, sample_rate in parsed_packets:
+                        self.submit_metric(name, value, mtype, tags=tags, hostname=hostname,
+                            device_name=device_name, sample_rate=sample_rate)
+        finally:
+            self._ingest_epoch += 1
 
-            if packet.startswith('_e'):
-                self.event_count += 1
-                event = self.parse_event_packet(packet)
-                self.event(**event)
-            elif packet.startswith('_sc'):
-                self.service_check_count += 1
-                service_check = self.parse_sc_packet(packet)
-                self.service_check(**service_check)
-            else:
-                self.count += 1
-                parsed_packets = self.parse_metric_packet(packet)
-                for name, value, mtype, tags, sample_rate in parsed_packets:
-                    hostname, device_name, tags = self._extract_magic_tags(tags)
-                    self.submit_metric(name, value, mtype, tags=tags, hostname=hostname,
-                        device_name=device_name, sample_rate=sample_rate)
 
+    def count_forwarded_packets(self, forwarded_count, dropped_count):
+        """ Count the datagrams forwarded to another statsd server, and the ones dropped instead """
+        self.forwarded_count += forwarded_count
+        self.forward_dropped_count += dropped_count
+
+    def submit_packet_batch(self, messages, listener=None):
+        """
+        Submit several datagrams at once. Unlike `submit_packets` a bad
+        datagram doesn't prevent the next ones from being processed.
+        They're counted in the packets received by `listener` if given.
+        """
+        if listener is not None:
+            self.listener_packet_counts[listener] = self.listener_packet_counts.get(listener, 0) + len(messages)
+        submit_packets = self.submit_packets
+        for message in messages:
+            try:
+                submit_packets(message)
+            except Exception:
+                log.exception("Error processing datagram: %r" % message)
 
     def _extract_magic_tags(self, tags):
         """Magic tags (host, device) override metric hostname and device_name attributes"""
@@ -717,7 +1048,7 @@ class MetricsBucketAggregator(Aggregator):
     def __init__(self, hostname, interval=1.0, expiry_seconds=300,
             formatter=None, recent_point_threshold=None,
             histogram_aggregates=None, histogram_percentiles=None,
-            utf8_decoding=False):
+            utf8_decoding=False, histogram_backend=None):
         super(MetricsBucketAggregator, self).__init__(
             hostname,
             interval,
@@ -726,18 +1057,25 @@ class MetricsBucketAggregator(Aggregator):
             recent_point_threshold,
             histogram_aggregates,
             histogram_percentiles,
-            utf8_decoding
+            utf8_decoding,
+            histogram_backend
         )
+        # Table the metrics are submitted to, swapped for an empty one at each flush
         self.metric_by_bucket = {}
+        # Buckets swapped out of `metric_by_bucket` but not due yet, only used by flush
+        self.pending_metric_by_bucket = {}
+        # (table, bucket start, metric_by_context, metric_by_raw_key) of the
+        # last bucket submitted to. metric_by_raw_key maps the (name, tags,
+        # hostname, device_name) of the points submitted to the bucket
+        # straight to their metric, it's dropped when the bucket rolls.
+        self.current_bucket = (None, None, None, None)
         self.last_sample_time_by_context = {}
-        self.current_bucket = None
-        self.current_mbc = {}
         self.last_flush_cutoff_time = 0
         self.metric_type_to_class = {
             'g': BucketGauge,
             'c': Counter,
-            'h': Histogram,
-            'ms': Histogram,
+            'h': self.histogram_class,
+            'ms': self.histogram_class,
             's': Set,
         }
 
@@ -746,43 +1084,52 @@ class MetricsBucketAggregator(Aggregator):
 
     def submit_metric(self, name, value, mtype, tags=None, hostname=None,
                       device_name=None, timestamp=None, sample_rate=1):
-        # Avoid calling extra functions to dedupe tags if there are none
         # Note: if you change the way that context is created, please also change create_empty_metrics,
         #  which counts on this order
 
         # Keep hostname with empty string to unset it
         hostname = hostname if hostname is not None else self.hostname
 
-        if tags is None:
-            context = (name, tuple(), hostname, device_name)
-        else:
-            context = (name, tuple(sorted(set(tags))), hostname, device_name)
-
         cur_time = time()
         # Check to make sure that the timestamp that is passed in (if any) is not older than
         #  recent_point_threshold.  If so, discard the point.
         if timestamp is not None and cur_time - int(timestamp) > self.recent_point_threshold:
             log.debug("Discarding %s - ts = %s , current ts = %s " % (name, timestamp, cur_time))
             self.num_discarded_old_points += 1
+            return
+
+        timestamp = timestamp or cur_time
+        # Keep track of the buckets using the timestamp at the start time of the bucket
+        bucket_start_timestamp = timestamp - (timestamp % self.interval)
+        raw_key = (name, tags if tags is None or tags.__class__ is tuple else tuple(tags),
+                   hostname, device_name)
+        # The table is read once: if flush swaps it meanwhile, this point
+        # goes to the old one, which flush waits for us to be done with
+        metric_by_bucket = self.metric_by_bucket
+        current_table, current_bucket, metric_by_context, metric_by_raw_key = self.current_bucket
+        if current_table is metric_by_bucket and bucket_start_timestamp == current_bucket:
+            # A known series of the current bucket: a single lookup
+            metric = metric_by_raw_key.get(raw_key)
+            if metric is not None:
+                metric.sample(value, sample_rate, timestamp)
+                return
         else:
-            timestamp = timestamp or cur_time
-            # Keep track of the buckets using the timestamp at the start time of the bucket
-            bucket_start_timestamp = self.calculate_bucket_start(timestamp)
-            if bucket_start_timestamp == self.current_bucket:
-                metric_by_context = self.current_mbc
-            else:
-                if bucket_start_timestamp not in self.metric_by_bucket:
-                    self.metric_by_bucket[bucket_start_timestamp] = {}
-                metric_by_context = self.metric_by_bucket[bucket_start_timestamp]
-                self.current_bucket = bucket_start_timestamp
-                self.current_mbc = metric_by_context
-
-            if context not in metric_by_context:
-                metric_class = self.metric_type_to_class[mtype]
-                metric_by_context[context] = metric_class(self.formatter, name, tags,
-                    hostname, device_name, self.metric_config.get(metric_class))
+            if bucket_start_timestamp not in metric_by_bucket:
+                metric_by_bucket[bucket_start_timestamp] = {}
+            metric_by_context = metric_by_bucket[bucket_start_timestamp]
+            metric_by_raw_key = {}
+            self.current_bucket = (metric_by_bucket, bucket_start_timestamp, metric_by_context,
+                                   metric_by_raw_key)
+
+        context = self._context_registry.get_context(name, raw_key[1], hostname, device_name)
+        metric = metric_by_context.get(context)
+        if metric is None:
+            metric_class = self.metric_type_to_class[mtype]
+            metric = metric_by_context[context] = metric_class(self.formatter, name, tags,
+                hostname, device_name, self.metric_config.get(metric_class))
+        metric_by_raw_key[raw_key] = metric
 
-            metric_by_context[context].sample(value, sample_rate, timestamp)
+        metric.sample(value, sample_rate, timestamp)
 
     def create_empty_metrics(self, sample_time_by_context, expiry_timestamp, flush_timestamp, metrics):
         # Even if no data is submitted, Counters keep reporting "0" for expiry_seconds.  The other Metrics
@@ -797,18 +1144,54 @@ class MetricsBucketAggregator(Aggregator):
                 metric = Counter(self.formatter, context[0], context[1], context[2], context[3])
                 metrics += metric.flush(flush_timestamp, self.interval)
 
+    def _swap_metric_by_bucket(self):
+        """
+        Give the ingest thread an empty table to submit to, and return the
+        previous one once nothing can write to it anymore.
+        Ingest never waits on this: a `submit_packets` call running during
+        the swap may still hold the previous table, so we wait for it to
+        return before handing the table over.
+        """
+        metric_by_bucket = self.metric_by_bucket
+        self.metric_by_bucket = {}
+
+        ingest_epoch = self._ingest_epoch
+        if ingest_epoch % 2:
+            while self._ingest_epoch == ingest_epoch:
+                sleep(INGEST_WAIT_INTERVAL)
+
+        return metric_by_bucket
+
+    def _merge_metric_by_bucket(self, metric_by_bucket):
+        """ Merge a table of metrics into the pending ones, which only flush uses. """
+        pending = self.pending_metric_by_bucket
+        for bucket_start_timestamp, metric_by_context in metric_by_bucket.iteritems():
+            if bucket_start_timestamp not in pending:
+                pending[bucket_start_timestamp] = metric_by_context
+                continue
+            pending_mbc = pending[bucket_start_timestamp]
+            for context, metric in metric_by_context.iteritems():
+                if context in pending_mbc:
+                    pending_mbc[context].merge(metric)
+                else:
+                    pending_mbc[context] = metric
+
     def flush(self):
         cur_time = time()
         flush_cutoff_time = self.calculate_bucket_start(cur_time)
         expiry_timestamp = cur_time - self.expiry_seconds
 
+        # Everything below runs on the swapped out table, out of the way of ingest
+        self._merge_metric_by_bucket(self._swap_metric_by_bucket())
+        pending_metric_by_bucket = self.pending_metric_by_bucket
+
         metrics = []
 
-        if self.metric_by_bucket:
+        if pending_metric_by_bucket:
             # We want to process these in order so that we can check for and expired metrics and
-            #  re-create non-expired metrics.  We also mutate self.metric_by_bucket.
-            for bucket_start_timestamp in sorted(self.metric_by_bucket.keys()):
-                metric_by_context = self.metric_by_bucket[bucket_start_timestamp]
+            #  re-create non-expired metrics.  We also mutate pending_metric_by_bucket.
+            for bucket_start_timestamp in sorted(pending_metric_by_bucket.keys()):
+                metric_by_context = pending_metric_by_bucket[bucket_start_timestamp]
                 if bucket_start_timestamp < flush_cutoff_time:
                     not_sampled_in_this_bucket = self.last_sample_time_by_context.copy()
                     # We mutate this dictionary while iterating so don't use an iterator.
@@ -826,7 +1209,7 @@ class MetricsBucketAggregator(Aggregator):
                     # We need to account for Metrics that have not expired and were not flushed for this bucket
                     self.create_empty_metrics(not_sampled_in_this_bucket, expiry_timestamp, bucket_start_timestamp, metrics)
 
-                    del self.metric_by_bucket[bucket_start_timestamp]
+                    del pending_metric_by_bucket[bucket_start_timestamp]
         else:
             # Even if there are no metrics in this flush, there may be some non-expired counters
             #  We should only create these non-expired metrics if we've passed an interval since the last flush
@@ -834,6 +1217,8 @@ class MetricsBucketAggregator(Aggregator):
                 self.create_empty_metrics(self.last_sample_time_by_context.copy(), expiry_timestamp,
                                           flush_cutoff_time-self.interval, metrics)
 
+        self._context_registry.expire(cur_time)
+
         # Log a warning regarding metrics with old timestamps being submitted
         if self.num_discarded_old_points > 0:
             log.warn('%s points were discarded as a result of having an old timestamp' % self.num_discarded_old_points)
@@ -843,11 +1228,71 @@ class MetricsBucketAggregator(Aggregator):
         log.debug("received %s payloads since last flush" % self.count)
         self.total_count += self.count
         self.count = 0
-        self.current_bucket = None
-        self.current_mbc = {}
         self.last_flush_cutoff_time = flush_cutoff_time
         return metrics
 
+    def pop_shard_state(self):
+        """
+        Detach everything received since the last call so that it can be
+        merged into another aggregator with `merge_shard_state`.
+        Used by the dogstatsd workers: they only aggregate, the aggregator
+        they report to takes care of flushing and expiring contexts.
+        """
+        metric_by_bucket = self.metric_by_bucket
+        for metric_by_context in metric_by_bucket.itervalues():
+            for metric in metric_by_context.itervalues():
+                # Formatters can be closures, which can't be pickled
+                metric.formatter = None
+
+        state = {
+            'metric_by_bucket': metric_by_bucket,
+            'events': self.events,
+            'service_checks': self.service_checks,
+            'count': self.count,
+            'event_count': self.event_count,
+            'service_check_count': self.service_check_count,
+            'num_discarded_old_points': self.num_discarded_old_points,
+            'listener_packet_counts': self.listener_packet_counts,
+            'forwarded_count': self.forwarded_count,
+            'forward_dropped_count': self.forward_dropped_count,
+        }
+
+        self.metric_by_bucket = {}
+        self.events = []
+        self.service_checks = []
+        self.count = 0
+        self.event_count = 0
+        self.service_check_count = 0
+        self.num_discarded_old_points = 0
+        self.listener_packet_counts = {}
+        self.forwarded_count = 0
+        self.forward_dropped_count = 0
+
+        return state
+
+    def merge_shard_state(self, state):
+        """
+        Merge a state returned by `pop_shard_state` into this aggregator.
+        Counters are summed, sets are joined and histogram samples are
+        concatenated, so the flush outputs the same metrics as if all the
+        packets had been submitted to this aggregator.
+        """
+        for metric_by_context in state['metric_by_bucket'].itervalues():
+            for metric in metric_by_context.itervalues():
+                metric.formatter = self.formatter
+        self._merge_metric_by_bucket(state['metric_by_bucket'])
+
+        self.events.extend(state['events'])
+        self.service_checks.extend(state['service_checks'])
+        self.count += state['count']
+        self.event_count += state['event_count']
+        self.service_check_count += state['service_check_count']
+        self.num_discarded_old_points += state['num_discarded_old_points']
+        for listener, count in state['listener_packet_counts'].iteritems():
+            self.listener_packet_counts[listener] = self.listener_packet_counts.get(listener, 0) + count
+        self.forwarded_count += state['forwarded_count']
+        self.forward_dropped_count += state['forward_dropped_count']
+
 
 class MetricsAggregator(Aggregator):
     """
@@ -857,7 +1302,7 @@ class MetricsAggregator(Aggregator):
     def __init__(self, hostname, interval=1.0, expiry_seconds=300,
             formatter=None, recent_point_threshold=None,
             histogram_aggregates=None, histogram_percentiles=None,
-            utf8_decoding=False):
+            utf8_decoding=False, histogram_backend=None):
         super(MetricsAggregator, self).__init__(
             hostname,
             interval,
@@ -866,41 +1311,49 @@ class MetricsAggregator(Aggregator):
             recent_point_threshold,
             histogram_aggregates,
             histogram_percentiles,
-            utf8_decoding
+            utf8_decoding,
+            histogram_backend
         )
         self.metrics = {}
+        # Maps the (name, tags, hostname, device_name) of the submitted points
+        # straight to their metric in `metrics`, cleared when metrics expire
+        self._metric_by_raw_key = {}
         self.metric_type_to_class = {
             'g': Gauge,
             'ct': Count,
             'ct-c': MonotonicCount,
             'c': Counter,
-            'h': Histogram,
-            'ms': Histogram,
+            'h': self.histogram_class,
+            'ms': self.histogram_class,
             's': Set,
             '_dd-r': Rate,
         }
 
     def submit_metric(self, name, value, mtype, tags=None, hostname=None,
                       device_name=None, timestamp=None, sample_rate=1):
-        # Avoid calling extra functions to dedupe tags if there are none
-
         # Keep hostname with empty string to unset it
         hostname = hostname if hostname is not None else self.hostname
 
-        if tags is None:
-            context = (name, tuple(), hostname, device_name)
-        else:
-            context = (name, tuple(sorted(set(tags))), hostname, device_name)
-        if context not in self.metrics:
-            metric_class = self.metric_type_to_class[mtype]
-            self.metrics[context] = metric_class(self.formatter, name, tags,
-                hostname, device_name, self.metric_config.get(metric_class))
+        raw_key = (name, tags if tags is None or tags.__class__ is tuple else tuple(tags),
+                   hostname, device_name)
+        metric = self._metric_by_raw_key.get(raw_key)
+        if metric is None:
+            context = self._context_registry.get_context(name, raw_key[1], hostname, device_name)
+            metric = self.metrics.get(context)
+            if metric is None:
+                metric_class = self.metric_type_to_class[mtype]
+                metric = self.metrics[context] = metric_class(self.formatter, name, tags,
+                    hostname, device_name, self.metric_config.get(metric_class))
+            if len(self._metric_by_raw_key) >= CONTEXT_REGISTRY_SIZE:
+                self._metric_by_raw_key = {}
+            self._metric_by_raw_key[raw_key] = metric
+
         cur_time = time()
         if timestamp is not None and cur_time - int(timestamp) > self.recent_point_threshold:
             log.debug("Discarding %s - ts = %s , current ts = %s " % (name, timestamp, cur_time))
             self.num_discarded_old_points += 1
         else:
-            self.metrics[context].sample(value, sample_rate, timestamp)
+            metric.sample(value, sample_rate, timestamp)
 
     def gauge(self, name, value, tags=None, hostname=None, device_name=None, timestamp=None):
         self.submit_metric(name, value, 'g', tags, hostname, device_name, timestamp)
@@ -939,9 +1392,12 @@ class MetricsAggregator(Aggregator):
             if metric.last_sample_time < expiry_timestamp:
                 log.debug("%s hasn't been submitted in %ss. Expiring." % (context, self.expiry_seconds))
                 del self.metrics[context]
+                self._metric_by_raw_key = {}
             else:
                 metrics += metric.flush(timestamp, self.interval)
 
+        self._context_registry.expire(timestamp)
+
         # Log a warning regarding metrics with old timestamps being submitted
         if self.num_discarded_old_points > 0:
             log.warn('%s points were discarded as a result of having an old timestamp' % self.num_discarded_old_points)
@@ -5,7 +5,7 @@ import requests
 import time
 import socket
 import urllib2
-from collections import defaultdict, Counter, deque
+from collections import defaultdict, Counter, deque, OrderedDict
 
 # project
 from checks import AgentCheck
@@ -14,12 +14,18 @@ from utils.dockerutil import find_cgroup, find_cgroup_filename_pattern, get_clie
     set_docker_settings, image_tag_extractor, container_name_extractor
 from utils.kubeutil import get_kube_labels
 from utils.platform import Platform
+from utils.proc_snapshot import get_proc_snapshot
 
 
 EVENT_TYPE = 'docker'
 SERVICE_CHECK_NAME = 'docker.service_up'
 SIZE_REFRESH_RATE = 5  # Collect container sizes every 5 iterations of the check
 MAX_CGROUP_LISTING_RETRIES = 3
+# Events after which the processes of a container have to be looked up again
+CONTAINER_PIDS_EVENTS = ('start', 'restart', 'die', 'kill', 'oom', 'destroy')
+# Default number of cgroup stat files kept open, 3 per container. Past that
+# the least recently read ones are closed.
+DEFAULT_MAX_CGROUP_FILES = 300
 CONTAINER_ID_RE = re.compile('[0-9a-f]{64}')
 POD_NAME_LABEL = "io.kubernetes.pod.name"
 
@@ -107,6 +113,18 @@ def get_mountpoints(docker_root):
         mountpoints[metric["cgroup"]] = find_cgroup(metric["cgroup"], docker_root)
     return mountpoints
 
+def parse_docker_cpuacct_cgroups(pid_cgroups):
+    """ {pid: cpuacct cgroup} for the processes in a docker cgroup """
+    cpuacct_cgroups = {}
+    for pid, lines in pid_cgroups.iteritems():
+        for line in lines:
+            # hierarchy-ID:controller-list:cgroup-path
+            line = line.strip().split(':')
+            if len(line) > 2 and line[1] in ('cpu,cpuacct', 'cpuacct,cpu', 'cpuacct') and 'docker' in line[2]:
+                cpuacct_cgroups[pid] = line[2]
+                break
+    return cpuacct_cgroups
+
 def get_filters(include, exclude):
     # The reasoning is to check exclude first, so we can skip if there is no exclude
     if not exclude:
@@ -157,6 +175,16 @@ class DockerDaemon(AgentCheck):
             self._filtered_containers = set()
             self._disable_net_metrics = False
 
+            # Index of the running containers: {container id: pid of one of its
+            # processes, or None if none was found}. /proc is only crawled
+            # when a container isn't indexed, or its indexed process is gone.
+            self._container_pids = {}
+            # The cgroup stat files of the running containers are kept open
+            # and read again from the start at each run, least recently read
+            # first: {(container id, cgroup): file}
+            self._cgroup_files = OrderedDict()
+            self._max_cgroup_files = max(1, int(instance.get('max_open_cgroup_files', DEFAULT_MAX_CGROUP_FILES)))
+
             # At first run we'll just collect the events from the latest 60 secs
             self._last_event_collection_ts = int(time.time()) - 60
 
@@ -229,6 +257,13 @@ class DockerDaemon(AgentCheck):
 
         # Get the list of containers and the index of their names
         containers_by_id = self._get_and_count_containers()
+        self._forget_stopped_containers(containers_by_id)
+        # The containers which were (re)started or stopped since the last run
+        # are looked up again before their metrics are read
+        api_events = None
+        if self.collect_events or self._has_unindexed_cgroup_files():
+            api_events = self._get_container_events()
+        self._forget_restarted_containers(api_events)
         containers_by_id = self._crawl_container_pids(containers_by_id)
 
         # Report performance container metrics (cpu, mem, net, io)
@@ -239,7 +274,7 @@ class DockerDaemon(AgentCheck):
 
         # Send events from Docker API
         if self.collect_events:
-            self._process_events(containers_by_id)
+            self._process_events(api_events, containers_by_id)
 
     def _count_and_weigh_images(self):
         try:
@@ -497,8 +532,7 @@ class DockerDaemon(AgentCheck):
     def _report_cgroup_metrics(self, container, tags):
         try:
             for cgroup in CGROUP_METRICS:
-                stat_file = self._get_cgroup_file(cgroup["cgroup"], container['Id'], cgroup['file'])
-                stats = self._parse_cgroup_file(stat_file)
+                stats = self._parse_cgroup_file(container['Id'], cgroup["cgroup"], cgroup['file'])
                 if stats:
                     for key, (dd_key, metric_func) in cgroup['metrics'].iteritems():
                         metric_func = FUNC_MAP[metric_func][self.use_histogram]
@@ -553,14 +587,29 @@ class DockerDaemon(AgentCheck):
             # It is possible that the container got stopped between the API call and now
             self.warning("Failed to report IO metrics from file {0}. Exception: {1}".format(proc_net_file, e))
 
-    def _process_events(self, containers_by_id):
+    def _get_container_events(self):
+        """Get the events since the last run, or None if they can't be collected."""
         try:
-            api_events = self._get_events()
-            aggregated_events = self._pre_aggregate_events(api_events, containers_by_id)
-            events = self._format_events(aggregated_events, containers_by_id)
+            return self._get_events()
         except (socket.timeout, urllib2.URLError):
-            self.warning('Timeout when collecting events. Events will be missing.')
+            if self.collect_events:
+                self.warning('Timeout when collecting events. Events will be missing.')
+            else:
+                self.log.debug('Timeout when collecting events')
+        except Exception, e:
+            if self.collect_events:
+                self.warning("Unexpected exception when collecting events: {0}. "
+                    "Events will be missing".format(e))
+            else:
+                self.log.debug("Unexpected exception when collecting events: {0}".format(e))
+        return None
+
+    def _process_events(self, api_events, containers_by_id):
+        if api_events is None:
             return
+        try:
+            aggregated_events = self._pre_aggregate_events(api_events, containers_by_id)
+            events = self._format_events(aggregated_events, containers_by_id)
         except Exception, e:
             self.warning("Unexpected exception when collecting events: {0}. "
                 "Events will be missing".format(e))
@@ -655,18 +704,51 @@ class DockerDaemon(AgentCheck):
 
         return find_cgroup_filename_pattern(self._mountpoints, container_id) % (params)
 
-    def _parse_cgroup_file(self, stat_file):
-        """Parse a cgroup pseudo file for key/values."""
-        self.log.debug("Opening cgroup file: %s" % stat_file)
+    def _read_cgroup_file(self, container_id, cgroup, filename):
+        """Read a cgroup pseudo file, through the file kept open for the container."""
+        key = (container_id, cgroup)
+        fp = self._cgroup_files.pop(key, None)
+        if fp is None:
+            stat_file = self._get_cgroup_file(cgroup, container_id, filename)
+            self.log.debug("Opening cgroup file: %s" % stat_file)
+            try:
+                fp = open(stat_file, 'r')
+            except IOError:
+                # It is possible that the container got stopped between the API call and now
+                self.log.info("Can't open %s. Metrics for this container are skipped." % stat_file)
+                return None
+            # Close the least recently read files past the limit
+            while self._cgroup_files and len(self._cgroup_files) >= self._max_cgroup_files:
+                self._close_cgroup_file(next(iter(self._cgroup_files)))
+        # Most recently read last
+        self._cgroup_files[key] = fp
+
         try:
-            with open(stat_file, 'r') as fp:
-                if 'blkio' in stat_file:
-                    return self._parse_blkio_metrics(fp.read().splitlines())
-                else:
-                    return dict(map(lambda x: x.split(' ', 1), fp.read().splitlines()))
+            # The kernel generates the content of the file again when it's read from the start
+            fp.seek(0)
+            return fp.read()
         except IOError:
-            # It is possible that the container got stopped between the API call and now
-            self.log.info("Can't open %s. Metrics for this container are skipped." % stat_file)
+            self.log.info("Can't read %s. Metrics for this container are skipped." % fp.name)
+            self._close_cgroup_file(key)
+            return None
+
+    def _close_cgroup_file(self, key):
+        fp = self._cgroup_files.pop(key, None)
+        if fp is not None:
+            try:
+                fp.close()
+            except IOError:
+                pass
+
+    def _parse_cgroup_file(self, container_id, cgroup, filename):
+        """Parse a cgroup pseudo file for key/values."""
+        content = self._read_cgroup_file(container_id, cgroup, filename)
+        if content is None:
+            return None
+        if cgroup == 'blkio':
+            return self._parse_blkio_metrics(content.splitlines())
+        else:
+            return dict(map(lambda x: x.split(' ', 1), content.splitlines()))
 
     def _parse_blkio_metrics(self, stats):
         """Parse the blkio metrics."""
@@ -682,54 +764,96 @@ class DockerDaemon(AgentCheck):
         return metrics
 
     # proc files
+    def _forget_stopped_containers(self, containers_by_id):
+        """Drop what's kept about the containers which aren't running anymore."""
+        running = set(container_id for container_id, container in containers_by_id.iteritems()
+                      if self._is_container_running(container))
+        for container_id in self._container_pids.keys():
+            if container_id not in running:
+                del self._container_pids[container_id]
+        for key in self._cgroup_files.keys():
+            if key[0] not in running:
+                self._close_cgroup_file(key)
+
+    def _has_unindexed_cgroup_files(self):
+        """Tell if cgroup files are open for containers without a PID to notice their restart."""
+        return any(key[0] not in self._container_pids for key in self._cgroup_files)
+
+    def _forget_restarted_containers(self, api_events):
+        """Look up again the processes and cgroup files of the containers which were (re)started or stopped."""
+        if not api_events:
+            return
+        restarted = set(event.get('id') for event in api_events
+                        if event.get('status') in CONTAINER_PIDS_EVENTS)
+        for container_id in restarted:
+            self._container_pids.pop(container_id, None)
+        for key in self._cgroup_files.keys():
+            if key[0] in restarted:
+                self._close_cgroup_file(key)
+
+    def _is_container_pid(self, proc_path, container_id, pid):
+        """Tell if the process `pid` still runs in the container."""
+        try:
+            with open(os.path.join(proc_path, str(pid), 'cgroup'), 'r') as fp:
+                return container_id in fp.read()
+        except IOError:
+            return False
+
     def _crawl_container_pids(self, container_dict):
-        """Crawl `/proc` to find container PIDs and add them to `containers_by_id`."""
+        """Find a PID of each running container, and add it to `containers_by_id`.
+
+        The PIDs are indexed: `/proc` is only crawled when a container isn't
+        in the index yet, or when the process indexed for it is gone, in which
+        case the container was restarted and its cgroup files are opened again.
+        """
         proc_path = os.path.join(self._docker_root, 'proc')
-        pid_dirs = [_dir for _dir in os.listdir(proc_path) if _dir.isdigit()]
 
-        if len(pid_dirs) == 0:
+        unknown_containers = False
+        for container_id, container in container_dict.iteritems():
+            if not self._is_container_running(container):
+                continue
+            if container_id not in self._container_pids:
+                unknown_containers = True
+                continue
+            if not self._is_container_pid(proc_path, container_id, self._container_pids[container_id]):
+                del self._container_pids[container_id]
+                for key in self._cgroup_files.keys():
+                    if key[0] == container_id:
+                        self._close_cgroup_file(key)
+                unknown_containers = True
+
+        if unknown_containers:
+            self._index_container_pids(proc_path, container_dict)
+
+        for container_id, pid in self._container_pids.iteritems():
+            if container_id in container_dict:
+                container_dict[container_id]['_pid'] = str(pid)
+                container_dict[container_id]['_proc_root'] = os.path.join(proc_path, str(pid))
+        return container_dict
+
+    def _index_container_pids(self, proc_path, container_dict):
+        """Crawl `/proc` to find the PIDs of the running containers."""
+        # The cgroups of all the processes are shared with the other checks
+        # reading them during the collection run
+        proc_snapshot = get_proc_snapshot(proc_path)
+        pid_cgroups = proc_snapshot.get('pid_cgroups')
+
+        if len(pid_cgroups) == 0:
             self.warning("Unable to find any pid directory in {0}. "
                 "If you are running the agent in a container, make sure to "
                 'share the volume properly: "/proc:/host/proc:ro". '
                 "See https://github.com/DataDog/docker-dd-agent/blob/master/README.md for more information. "
                 "Network metrics will be missing".format(proc_path))
             self._disable_net_metrics = True
-            return container_dict
+            return
 
         self._disable_net_metrics = False
 
-        for folder in pid_dirs:
-
-            try:
-                path = os.path.join(proc_path, folder, 'cgroup')
-                with open(path, 'r') as f:
-                    content = [line.strip().split(':') for line in f.readlines()]
-            except IOError, e:
-                #  Issue #2074
-                self.log.debug("Cannot read %s, "
-                               "process likely raced to finish : %s" %
-                               (path, str(e)))
-            except Exception, e:
-                self.warning("Cannot read %s : %s" % (path, str(e)))
-                continue
-
-            try:
-                for line in content:
-                    if line[1] in ('cpu,cpuacct', 'cpuacct,cpu', 'cpuacct') and 'docker' in line[2]:
-                        cpuacct = line[2]
-                        break
-                else:
+        for pid, cpuacct in proc_snapshot.get('pid_cgroups', parse_docker_cpuacct_cgroups).iteritems():
+            match = CONTAINER_ID_RE.search(cpuacct)
+            if match:
+                container_id = match.group(0)
+                if container_id not in container_dict:
+                    self.log.debug("Container %s not in container_dict, it's likely excluded", container_id)
                     continue
-
-                match = CONTAINER_ID_RE.search(cpuacct)
-                if match:
-                    container_id = match.group(0)
-                    if container_id not in container_dict:
-                        self.log.debug("Container %s not in container_dict, it's likely excluded", container_id)
-                        continue
-                    container_dict[container_id]['_pid'] = folder
-                    container_dict[container_id]['_proc_root'] = os.path.join(proc_path, folder)
-            except Exception, e:
-                self.warning("Cannot parse %s content: %s" % (path, str(e)))
-                continue
-        return container_dict
+                self._container_pids[container_id] = pid
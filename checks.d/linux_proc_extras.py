@@ -1,5 +1,6 @@
 # project
 from checks import AgentCheck
+from utils.proc_snapshot import get_proc_snapshot
 from utils.subprocess_output import get_subprocess_output
 from collections import defaultdict
 
@@ -32,19 +33,18 @@ class MoreUnixCheck(AgentCheck):
             self.gauge('system.inodes.total', float(inode_stats[0]), tags=tags)
             self.gauge('system.inodes.used', float(inode_stats[1]), tags=tags)
 
-        with open('/proc/stat', 'r') as stat_info:
-            lines = [line.strip() for line in stat_info.readlines()]
+        lines = [line.strip() for line in get_proc_snapshot().get('stat')]
 
-            for line in lines:
-                if line.startswith('ctxt'):
-                    ctxt_count = float(line.split(' ')[1])
-                    self.monotonic_count('system.linux.context_switches', ctxt_count, tags=tags)
-                elif line.startswith('processes'):
-                    process_count = int(line.split(' ')[1])
-                    self.monotonic_count('system.linux.processes_created', process_count, tags=tags)
-                elif line.startswith('intr'):
-                    interrupts = int(line.split(' ')[1])
-                    self.monotonic_count('system.linux.interrupts', interrupts, tags=tags)
+        for line in lines:
+            if line.startswith('ctxt'):
+                ctxt_count = float(line.split(' ')[1])
+                self.monotonic_count('system.linux.context_switches', ctxt_count, tags=tags)
+            elif line.startswith('processes'):
+                process_count = int(line.split(' ')[1])
+                self.monotonic_count('system.linux.processes_created', process_count, tags=tags)
+            elif line.startswith('intr'):
+                interrupts = int(line.split(' ')[1])
+                self.monotonic_count('system.linux.interrupts', interrupts, tags=tags)
 
         with open('/proc/sys/kernel/random/entropy_avail') as entropy_info:
             entropy = entropy_info.readline()
@@ -268,6 +268,438 @@ SYNTHETIC_VARS = {
     'Qcache_instant_utilization': ('mysql.performance.qcache.utilization.instant', GAUGE),
 }
 
+
+# SHOW ENGINE INNODB STATUS parsing
+# This is heavily inspired by the Percona monitoring plugins work
+#
+# Each line of the status is only matched against the rules which could
+# apply to it: the rules starting with its first word, and the rules
+# looking for a substring when the line contains one of them. Most lines,
+# e.g. the body of the transactions, don't match anything and are skipped
+# after a dict lookup and a regex search.
+
+def _innodb_row(line):
+    """ The columns of a line of the InnoDB status """
+    return [item.strip(',').strip(';').strip('[').strip(']') for item in line.split(' ') if item]
+
+
+class InnoDBStatusState(object):
+    """ What's gathered while parsing the InnoDB status """
+    def __init__(self):
+        self.results = defaultdict(int)
+        self.txn_seen = False
+        self.prev_line = ''
+
+
+# SEMAPHORES
+def _parse_mutex_spin_waits(state, line):
+    # Mutex spin waits 79626940, rounds 157459864, OS waits 698719
+    # Mutex spin waits 0, rounds 247280272495, OS waits 316513438
+    row = _innodb_row(line)
+    state.results['Innodb_mutex_spin_waits'] = long(row[3])
+    state.results['Innodb_mutex_spin_rounds'] = long(row[5])
+    state.results['Innodb_mutex_os_waits'] = long(row[8])
+
+
+def _parse_rw_shared_spins(state, line):
+    row = _innodb_row(line)
+    if line.find(';') > 0:
+        # RW-shared spins 3859028, OS waits 2100750; RW-excl spins
+        # 4641946, OS waits 1530310
+        state.results['Innodb_s_lock_spin_waits'] = long(row[2])
+        state.results['Innodb_x_lock_spin_waits'] = long(row[8])
+        state.results['Innodb_s_lock_os_waits'] = long(row[5])
+        state.results['Innodb_x_lock_os_waits'] = long(row[11])
+    else:
+        # Post 5.5.17 SHOW ENGINE INNODB STATUS syntax
+        # RW-shared spins 604733, rounds 8107431, OS waits 241268
+        state.results['Innodb_s_lock_spin_waits'] = long(row[2])
+        state.results['Innodb_s_lock_spin_rounds'] = long(row[4])
+        state.results['Innodb_s_lock_os_waits'] = long(row[7])
+
+
+def _parse_rw_excl_spins(state, line):
+    # Post 5.5.17 SHOW ENGINE INNODB STATUS syntax
+    # RW-excl spins 604733, rounds 8107431, OS waits 241268
+    row = _innodb_row(line)
+    state.results['Innodb_x_lock_spin_waits'] = long(row[2])
+    state.results['Innodb_x_lock_spin_rounds'] = long(row[4])
+    state.results['Innodb_x_lock_os_waits'] = long(row[7])
+
+
+def _parse_semaphore_wait(state, line):
+    # --Thread 907205 has waited at handler/ha_innodb.cc line 7156 for 1.00 seconds the semaphore:
+    row = _innodb_row(line)
+    state.results['Innodb_semaphore_waits'] += 1
+    state.results['Innodb_semaphore_wait_time'] += long(float(row[9])) * 1000
+
+
+# TRANSACTIONS
+def _parse_trx_id_counter(state, line):
+    # The beginning of the TRANSACTIONS section: start counting
+    # transactions
+    # Trx id counter 0 1170664159
+    # Trx id counter 861B144C
+    state.txn_seen = True
+
+
+def _parse_history_list_length(state, line):
+    # History list length 132
+    state.results['Innodb_history_list_length'] = long(_innodb_row(line)[3])
+
+
+def _parse_transaction(state, line):
+    # ---TRANSACTION 0, not started, process no 13510, OS thread id 1170446656
+    if not state.txn_seen:
+        return False
+    state.results['Innodb_current_transactions'] += 1
+    if line.find('ACTIVE') > 0:
+        state.results['Innodb_active_transactions'] += 1
+
+
+def _parse_trx_lock_wait(state, line):
+    # ------- TRX HAS BEEN WAITING 32 SEC FOR THIS LOCK TO BE GRANTED:
+    if not state.txn_seen:
+        return False
+    state.results['Innodb_row_lock_time'] += long(_innodb_row(line)[5]) * 1000
+
+
+def _parse_read_views(state, line):
+    # 1 read views open inside InnoDB
+    state.results['Innodb_read_views'] = long(_innodb_row(line)[0])
+
+
+def _parse_tables_in_use(state, line):
+    # mysql tables in use 2, locked 2
+    row = _innodb_row(line)
+    state.results['Innodb_tables_in_use'] += long(row[4])
+    state.results['Innodb_locked_tables'] += long(row[6])
+
+
+def _parse_lock_structs(state, line):
+    # 23 lock struct(s), heap size 3024, undo log entries 27
+    # LOCK WAIT 12 lock struct(s), heap size 3024, undo log entries 5
+    # LOCK WAIT 2 lock struct(s), heap size 368
+    if not state.txn_seen:
+        return False
+    row = _innodb_row(line)
+    if line.find('LOCK WAIT') == 0:
+        state.results['Innodb_lock_structs'] += long(row[2])
+        state.results['Innodb_locked_transactions'] += 1
+    elif line.find('ROLLING BACK') == 0:
+        # ROLLING BACK 127539 lock struct(s), heap size 15201832,
+        # 4411492 row lock(s), undo log entries 1042488
+        state.results['Innodb_lock_structs'] += long(row[2])
+    else:
+        state.results['Innodb_lock_structs'] += long(row[0])
+
+
+# FILE I/O
+def _parse_os_file_reads(state, line):
+    # 8782182 OS file reads, 15635445 OS file writes, 947800 OS
+    # fsyncs
+    row = _innodb_row(line)
+    state.results['Innodb_os_file_reads'] = long(row[0])
+    state.results['Innodb_os_file_writes'] = long(row[4])
+    state.results['Innodb_os_file_fsyncs'] = long(row[8])
+
+
+def _parse_pending_normal_aio(state, line):
+    # Pending normal aio reads: 0, aio writes: 0,
+    # or Pending normal aio reads: [0, 0, 0, 0] , aio writes: [0, 0, 0, 0] ,
+    # or Pending normal aio reads: 0 [0, 0, 0, 0] , aio writes: 0 [0, 0, 0, 0] ,
+    row = _innodb_row(line)
+    if len(row) == 16:
+        state.results['Innodb_pending_normal_aio_reads'] = (long(row[4]) + long(row[5]) +
+                                                            long(row[6]) + long(row[7]))
+        state.results['Innodb_pending_normal_aio_writes'] = (long(row[11]) + long(row[12]) +
+                                                             long(row[13]) + long(row[14]))
+    elif len(row) == 18:
+        state.results['Innodb_pending_normal_aio_reads'] = long(row[4])
+        state.results['Innodb_pending_normal_aio_writes'] = long(row[12])
+    else:
+        state.results['Innodb_pending_normal_aio_reads'] = long(row[4])
+        state.results['Innodb_pending_normal_aio_writes'] = long(row[7])
+
+
+def _parse_ibuf_aio_reads(state, line):
+    #  ibuf aio reads: 0, log i/o's: 0, sync i/o's: 0
+    #  or ibuf aio reads:, log i/o's:, sync i/o's:
+    row = _innodb_row(line)
+    if len(row) == 10:
+        state.results['Innodb_pending_ibuf_aio_reads'] = long(row[3])
+        state.results['Innodb_pending_aio_log_ios'] = long(row[6])
+        state.results['Innodb_pending_aio_sync_ios'] = long(row[9])
+    elif len(row) == 7:
+        state.results['Innodb_pending_ibuf_aio_reads'] = 0
+        state.results['Innodb_pending_aio_log_ios'] = 0
+        state.results['Innodb_pending_aio_sync_ios'] = 0
+
+
+def _parse_pending_flushes(state, line):
+    # Pending flushes (fsync) log: 0; buffer pool: 0
+    row = _innodb_row(line)
+    state.results['Innodb_pending_log_flushes'] = long(row[4])
+    state.results['Innodb_pending_buffer_pool_flushes'] = long(row[7])
+
+
+# INSERT BUFFER AND ADAPTIVE HASH INDEX
+def _parse_ibuf_for_space(state, line):
+    # Older InnoDB code seemed to be ready for an ibuf per tablespace.  It
+    # had two lines in the output.  Newer has just one line, see below.
+    # Ibuf for space 0: size 1, free list len 887, seg size 889, is not empty
+    # Ibuf for space 0: size 1, free list len 887, seg size 889,
+    row = _innodb_row(line)
+    state.results['Innodb_ibuf_size'] = long(row[5])
+    state.results['Innodb_ibuf_free_list'] = long(row[9])
+    state.results['Innodb_ibuf_segment_size'] = long(row[12])
+
+
+def _parse_ibuf_size(state, line):
+    # Ibuf: size 1, free list len 4634, seg size 4636,
+    row = _innodb_row(line)
+    state.results['Innodb_ibuf_size'] = long(row[2])
+    state.results['Innodb_ibuf_free_list'] = long(row[6])
+    state.results['Innodb_ibuf_segment_size'] = long(row[9])
+
+    if line.find('merges') > -1:
+        state.results['Innodb_ibuf_merges'] = long(row[10])
+
+
+def _parse_ibuf_merged_operations(state, line):
+    # Output of show engine innodb status has changed in 5.5
+    # merged operations:
+    # insert 593983, delete mark 387006, delete 73092
+    if state.prev_line.find('merged operations:') != 0:
+        return False
+    row = _innodb_row(line)
+    results = state.results
+    results['Innodb_ibuf_merged_inserts'] = long(row[1])
+    results['Innodb_ibuf_merged_delete_marks'] = long(row[4])
+    results['Innodb_ibuf_merged_deletes'] = long(row[6])
+    results['Innodb_ibuf_merged'] = results['Innodb_ibuf_merged_inserts'] + results[
+        'Innodb_ibuf_merged_delete_marks'] + results['Innodb_ibuf_merged_deletes']
+
+
+def _parse_ibuf_merged_recs(state, line):
+    # 19817685 inserts, 19817684 merged recs, 3552620 merges
+    row = _innodb_row(line)
+    state.results['Innodb_ibuf_merged_inserts'] = long(row[0])
+    state.results['Innodb_ibuf_merged'] = long(row[2])
+    state.results['Innodb_ibuf_merges'] = long(row[5])
+
+
+def _parse_hash_table_size(state, line):
+    # In some versions of InnoDB, the used cells is omitted.
+    # Hash table size 4425293, used cells 4229064, ....
+    # Hash table size 57374437, node heap has 72964 buffer(s) <--
+    # no used cells
+    row = _innodb_row(line)
+    state.results['Innodb_hash_index_cells_total'] = long(row[3])
+    state.results['Innodb_hash_index_cells_used'] = long(
+        row[6]) if line.find('used cells') > 0 else 0
+
+
+# LOG
+def _parse_log_ios_done(state, line):
+    # 3430041 log i/o's done, 17.44 log i/o's/second
+    # 520835887 log i/o's done, 17.28 log i/o's/second, 518724686
+    # syncs, 2980893 checkpoints
+    state.results['Innodb_log_writes'] = long(_innodb_row(line)[0])
+
+
+def _parse_pending_log_writes(state, line):
+    # 0 pending log writes, 0 pending chkp writes
+    row = _innodb_row(line)
+    state.results['Innodb_pending_log_writes'] = long(row[0])
+    state.results['Innodb_pending_checkpoint_writes'] = long(row[4])
+
+
+def _parse_log_sequence_number(state, line):
+    # This number is NOT printed in hex in InnoDB plugin.
+    # Log sequence number 272588624
+    state.results['Innodb_lsn_current'] = long(_innodb_row(line)[3])
+
+
+def _parse_log_flushed_up_to(state, line):
+    # This number is NOT printed in hex in InnoDB plugin.
+    # Log flushed up to   272588624
+    state.results['Innodb_lsn_flushed'] = long(_innodb_row(line)[4])
+
+
+def _parse_last_checkpoint(state, line):
+    # Last checkpoint at  272588624
+    state.results['Innodb_lsn_last_checkpoint'] = long(_innodb_row(line)[3])
+
+
+# BUFFER POOL AND MEMORY
+def _parse_total_memory_allocated(state, line):
+    # Total memory allocated 29642194944; in additional pool allocated 0
+    # Total memory allocated by read views 96
+    if line.find("in additional pool allocated") <= 0:
+        return False
+    row = _innodb_row(line)
+    state.results['Innodb_mem_total'] = long(row[3])
+    state.results['Innodb_mem_additional_pool'] = long(row[8])
+
+
+def _parse_pages_read(state, line):
+    if line.find("Pages read ahead") == 0:
+        # Must be skipped, otherwise it'll get fooled by this
+        # line from the new plugin:
+        # Pages read ahead 0.00/s, evicted without access 0.06/s
+        return
+    # Pages read 15240822, created 1770238, written 21705836
+    row = _innodb_row(line)
+    state.results['Innodb_pages_read'] = long(row[2])
+    state.results['Innodb_pages_created'] = long(row[4])
+    state.results['Innodb_pages_written'] = long(row[6])
+
+
+def _innodb_column(metric, column):
+    """ Rule parsing a single column of the line as `metric` """
+    def parse(state, line):
+        state.results[metric] = long(_innodb_row(line)[column])
+    return parse
+
+
+# ROW OPERATIONS
+def _parse_rows_inserted(state, line):
+    # Number of rows inserted 50678311, updated 66425915, deleted
+    # 20605903, read 454561562
+    row = _innodb_row(line)
+    state.results['Innodb_rows_inserted'] = long(row[4])
+    state.results['Innodb_rows_updated'] = long(row[6])
+    state.results['Innodb_rows_deleted'] = long(row[8])
+    state.results['Innodb_rows_read'] = long(row[10])
+
+
+def _parse_queries_inside(state, line):
+    # 0 queries inside InnoDB, 0 queries in queue
+    row = _innodb_row(line)
+    state.results['Innodb_queries_inside'] = long(row[0])
+    state.results['Innodb_queries_queued'] = long(row[4])
+
+
+# (prefix, substring, parse) by order of precedence: a line is parsed by the
+# first rule which prefix it starts with, or which substring it contains
+# past its first character, and which `parse` doesn't return False
+INNODB_STATUS_RULES = [
+    # SEMAPHORES
+    ('Mutex spin waits', None, _parse_mutex_spin_waits),
+    ('RW-shared spins', None, _parse_rw_shared_spins),
+    ('RW-excl spins', None, _parse_rw_excl_spins),
+    (None, 'seconds the semaphore:', _parse_semaphore_wait),
+    # TRANSACTIONS
+    ('Trx id counter', None, _parse_trx_id_counter),
+    ('History list length', None, _parse_history_list_length),
+    ('---TRANSACTION', None, _parse_transaction),
+    ('------- TRX HAS BEEN', None, _parse_trx_lock_wait),
+    (None, 'read views open inside InnoDB', _parse_read_views),
+    ('mysql tables in use', None, _parse_tables_in_use),
+    (None, 'lock struct(s)', _parse_lock_structs),
+    # FILE I/O
+    (None, ' OS file reads, ', _parse_os_file_reads),
+    ('Pending normal aio reads:', None, _parse_pending_normal_aio),
+    ('ibuf aio reads', None, _parse_ibuf_aio_reads),
+    ('Pending flushes (fsync)', None, _parse_pending_flushes),
+    # INSERT BUFFER AND ADAPTIVE HASH INDEX
+    ('Ibuf for space 0: size ', None, _parse_ibuf_for_space),
+    ('Ibuf: size ', None, _parse_ibuf_size),
+    (None, ', delete mark ', _parse_ibuf_merged_operations),
+    (None, ' merged recs, ', _parse_ibuf_merged_recs),
+    ('Hash table size ', None, _parse_hash_table_size),
+    # LOG
+    (None, " log i/o's done, ", _parse_log_ios_done),
+    (None, " pending log writes, ", _parse_pending_log_writes),
+    ("Log sequence number", None, _parse_log_sequence_number),
+    ("Log flushed up to", None, _parse_log_flushed_up_to),
+    ("Last checkpoint at", None, _parse_last_checkpoint),
+    # BUFFER POOL AND MEMORY
+    ("Total memory allocated", None, _parse_total_memory_allocated),
+    #   Adaptive hash index 1538240664     (186998824 + 1351241840)
+    ('Adaptive hash index ', None, _innodb_column('Innodb_mem_adaptive_hash', 3)),
+    #   Page hash           11688584
+    ('Page hash           ', None, _innodb_column('Innodb_mem_page_hash', 2)),
+    #   Dictionary cache    145525560      (140250984 + 5274576)
+    ('Dictionary cache    ', None, _innodb_column('Innodb_mem_dictionary', 2)),
+    #   File system         313848         (82672 + 231176)
+    ('File system         ', None, _innodb_column('Innodb_mem_file_system', 2)),
+    #   Lock system         29232616       (29219368 + 13248)
+    ('Lock system         ', None, _innodb_column('Innodb_mem_lock_system', 2)),
+    #   Recovery system     0      (0 + 0)
+    ('Recovery system     ', None, _innodb_column('Innodb_mem_recovery_system', 2)),
+    #   Threads             409336         (406936 + 2400)
+    ('Threads             ', None, _innodb_column('Innodb_mem_thread_hash', 1)),
+    # The " " after size is necessary to avoid matching the wrong line:
+    # Buffer pool size        1769471
+    # Buffer pool size, bytes 28991012864
+    ("Buffer pool size ", None, _innodb_column('Innodb_buffer_pool_pages_total', 3)),
+    # Free buffers            0
+    ("Free buffers", None, _innodb_column('Innodb_buffer_pool_pages_free', 2)),
+    # Database pages          1696503
+    ("Database pages", None, _innodb_column('Innodb_buffer_pool_pages_data', 2)),
+    # Modified db pages       160602
+    ("Modified db pages", None, _innodb_column('Innodb_buffer_pool_pages_dirty', 3)),
+    ("Pages read", None, _parse_pages_read),
+    # ROW OPERATIONS
+    ('Number of rows inserted', None, _parse_rows_inserted),
+    (None, " queries inside InnoDB, ", _parse_queries_inside),
+]
+
+
+def _index_innodb_status_rules(rules):
+    """
+    Return {first word: rules which could apply to a line starting with it},
+    the rules which could apply to any line, and a regex finding the
+    substrings these ones look for.
+    """
+    substring_rules = [rule for rule in rules if rule[0] is None]
+    rules_by_word = defaultdict(list)
+    for rule in rules:
+        if rule[0] is not None:
+            rules_by_word[rule[0].split(' ', 1)[0]].append(rule)
+    # Keep the order of precedence between the prefix and the substring rules
+    for word, word_rules in rules_by_word.items():
+        rules_by_word[word] = [rule for rule in rules if rule in word_rules or rule[0] is None]
+
+    substrings_re = re.compile('|'.join(re.escape(rule[1]) for rule in substring_rules))
+    return dict(rules_by_word), substring_rules, substrings_re
+
+_INNODB_RULES_BY_WORD, _INNODB_SUBSTRING_RULES, _INNODB_SUBSTRINGS_RE = \
+    _index_innodb_status_rules(INNODB_STATUS_RULES)
+
+
+def parse_innodb_status(innodb_status_text):
+    """ Parse the output of SHOW ENGINE INNODB STATUS to {metric: value} """
+    state = InnoDBStatusState()
+    rules_by_word = _INNODB_RULES_BY_WORD
+    substrings_search = _INNODB_SUBSTRINGS_RE.search
+
+    for line in innodb_status_text.splitlines():
+        line = line.strip()
+        rules = rules_by_word.get(line.split(' ', 1)[0])
+        if rules is None:
+            # Only the substring rules may apply, if the line has one of them
+            if substrings_search(line) is None:
+                state.prev_line = line
+                continue
+            rules = _INNODB_SUBSTRING_RULES
+
+        for prefix, substring, parse in rules:
+            if prefix is not None:
+                if not line.startswith(prefix):
+                    continue
+            elif line.find(substring) <= 0:
+                continue
+            if parse(state, line) is not False:
+                break
+
+        state.prev_line = line
+
+    return state.results
+
+
 class MySql(AgentCheck):
     SERVICE_CHECK_NAME = 'mysql.can_connect'
     SLAVE_SERVICE_CHECK_NAME = 'mysql.replication.slave_running'
@@ -277,6 +709,10 @@ class MySql(AgentCheck):
         AgentCheck.__init__(self, name, init_config, agentConfig, instances)
         self.mysql_version = {}
         self.qcache_stats = {}
+        # Connections kept open between the runs, by host key and user
+        self.connections = {}
+        # Host keys of the servers refusing several statements in one query
+        self.no_multi_statements = set()
 
     def get_library_versions(self):
         return {"pymysql": pymysql.__version__}
@@ -290,6 +726,8 @@ class MySql(AgentCheck):
         if (not host or not user) and not defaults_file:
             raise Exception("Mysql host and user are needed.")
 
+        self._evict_connections()
+
         with self._connect(host, port, mysql_sock, user,
                            password, defaults_file, ssl) as db:
             try:
@@ -339,66 +777,114 @@ class MySql(AgentCheck):
         )
 
     def _get_host_key(self):
-        if self.defaults_file:
-            return self.defaults_file
+        return self._make_host_key(self.host, self.port, self.mysql_sock, self.defaults_file)
 
-        hostkey = self.host
-        if self.mysql_sock:
-            hostkey = "{0}:{1}".format(hostkey, self.mysql_sock)
-        elif self.port:
-            hostkey = "{0}:{1}".format(hostkey, self.port)
+    @staticmethod
+    def _make_host_key(host, port, mysql_sock, defaults_file):
+        if defaults_file:
+            return defaults_file
+
+        hostkey = host
+        if mysql_sock:
+            hostkey = "{0}:{1}".format(hostkey, mysql_sock)
+        elif port:
+            hostkey = "{0}:{1}".format(hostkey, port)
 
         return hostkey
 
+    def _get_connection_key(self, instance):
+        host_key = self._make_host_key(instance.get('server', ''), int(instance.get('port', 0)),
+                                       instance.get('sock', ''), instance.get('defaults_file', ''))
+        return (host_key, instance.get('user', ''))
+
+    def _evict_connections(self):
+        """Close the connections kept for instances which don't exist anymore."""
+        keys = set(self._get_connection_key(instance) for instance in self.instances)
+        for key in self.connections.keys():
+            if key not in keys:
+                self._close_connection(self.connections.pop(key))
+
+    def stop(self):
+        for db in self.connections.itervalues():
+            self._close_connection(db)
+        self.connections.clear()
+
     @contextmanager
     def _connect(self, host, port, mysql_sock, user, password, defaults_file, ssl):
+        """
+        Yield the connection to the instance, reusing the one of the
+        previous run if the server still answers to a ping on it.
+        The connection is dropped when anything fails while it's used.
+        """
         self.service_check_tags = [
             'server:%s' % (mysql_sock if mysql_sock != '' else host),
             'port:%s' % ('unix_socket' if port == 0 else port)
         ]
+        if defaults_file == '' and mysql_sock != '':
+            self.service_check_tags = [
+                'server:{0}'.format(mysql_sock),
+                'port:unix_socket'
+            ]
 
-        db = None
+        key = (self._get_host_key(), user)
+        # Not shared while it's used
+        db = self.connections.pop(key, None)
         try:
-            ssl = dict(ssl) if ssl else None
-
-            if defaults_file != '':
-                db = pymysql.connect(read_default_file=defaults_file, ssl=ssl)
-            elif mysql_sock != '':
-                self.service_check_tags = [
-                    'server:{0}'.format(mysql_sock),
-                    'port:unix_socket'
-                ]
-                db = pymysql.connect(
-                    unix_socket=mysql_sock,
-                    user=user,
-                    passwd=password
-                )
-            elif port:
-                db = pymysql.connect(
-                    host=host,
-                    port=port,
-                    user=user,
-                    passwd=password,
-                    ssl=ssl
-                )
-            else:
-                db = pymysql.connect(
-                    host=host,
-                    user=user,
-                    passwd=password,
-                    ssl=ssl
-                )
-            self.log.debug("Connected to MySQL")
+            if db is not None:
+                try:
+                    db.ping(reconnect=False)
+                except Exception as e:
+                    self.log.debug("Cached MySQL connection is unusable, reconnecting: %s", e)
+                    self._close_connection(db)
+                    db = None
+
+            if db is None:
+                db = self._open_connection(host, port, mysql_sock, user, password, defaults_file, ssl)
+                self.log.debug("Connected to MySQL")
             self.service_check(self.SERVICE_CHECK_NAME, AgentCheck.OK,
                                tags=self.service_check_tags)
             yield db
         except Exception:
             self.service_check(self.SERVICE_CHECK_NAME, AgentCheck.CRITICAL,
                                tags=self.service_check_tags)
-            raise
-        finally:
             if db:
-                db.close()
+                self._close_connection(db)
+            raise
+        else:
+            self.connections[key] = db
+
+    def _open_connection(self, host, port, mysql_sock, user, password, defaults_file, ssl):
+        ssl = dict(ssl) if ssl else None
+
+        if defaults_file != '':
+            return pymysql.connect(read_default_file=defaults_file, ssl=ssl)
+        elif mysql_sock != '':
+            return pymysql.connect(
+                unix_socket=mysql_sock,
+                user=user,
+                passwd=password
+            )
+        elif port:
+            return pymysql.connect(
+                host=host,
+                port=port,
+                user=user,
+                passwd=password,
+                ssl=ssl
+            )
+        else:
+            return pymysql.connect(
+                host=host,
+                user=user,
+                passwd=password,
+                ssl=ssl
+            )
+
+    def _close_connection(self, db):
+        try:
+            db.close()
+        except Exception as e:
+            self.log.debug("Error closing the MySQL connection: %s", e)
 
     def _collect_metrics(self, host, db, tags, options, queries):
 
@@ -406,10 +892,9 @@ class MySql(AgentCheck):
         metrics = STATUS_VARS
 
         # collect results from db
-        results = self._get_stats_from_status(db)
-        results.update(self._get_stats_from_variables(db))
+        results, innodb_enabled = self._get_global_stats(db)
 
-        if self._is_innodb_engine_enabled(db):
+        if innodb_enabled:
             results.update(self._get_stats_from_innodb_status(db))
 
             innodb_keys = [
@@ -774,6 +1259,39 @@ class MySql(AgentCheck):
 
         return pid
 
+    def _get_global_stats(self, db):
+        """
+        Get the global status, the global variables and whether InnoDB is
+        enabled, in a single round trip when the server accepts it.
+        """
+        hostkey = self._get_host_key()
+        if hostkey not in self.no_multi_statements:
+            try:
+                with closing(db.cursor()) as cursor:
+                    cursor.execute(
+                        "SHOW /*!50002 GLOBAL */ STATUS; "
+                        "SHOW GLOBAL VARIABLES; "
+                        "select engine from information_schema.ENGINES where engine='InnoDB';")
+                    results = dict(cursor.fetchall())
+                    cursor.nextset()
+                    results.update(cursor.fetchall())
+                    cursor.nextset()
+                    innodb_enabled = cursor.rowcount > 0
+
+                    return results, innodb_enabled
+            except (pymysql.err.ProgrammingError, pymysql.err.OperationalError) as e:
+                self.log.debug("Can't send several statements to %s, querying them one by one: %s", hostkey, e)
+                # Only a refused query is remembered, not a failing server
+                if isinstance(e, pymysql.err.ProgrammingError):
+                    self.no_multi_statements.add(hostkey)
+                # The results of the other statements may still be pending
+                self._close_connection(db)
+                db.ping(reconnect=True)
+
+        results = self._get_stats_from_status(db)
+        results.update(self._get_stats_from_variables(db))
+        return results, self._is_innodb_engine_enabled(db)
+
     def _get_stats_from_status(self, db):
         with closing(db.cursor()) as cursor:
             cursor.execute("SHOW /*!50002 GLOBAL */ STATUS;")
@@ -869,258 +1387,7 @@ class MySql(AgentCheck):
             self.warning("Privilege error accessing the INNODB status tables (must grant PROCESS): %s" % str(e))
             return {}
 
-        results = defaultdict(int)
-
-        # Here we now parse InnoDB STATUS one line at a time
-        # This is heavily inspired by the Percona monitoring plugins work
-        txn_seen = False
-        prev_line = ''
-
-        for line in innodb_status_text.splitlines():
-            line = line.strip()
-            row = re.split(" +", line)
-            row = [item.strip(',') for item in row]
-            row = [item.strip(';') for item in row]
-            row = [item.strip('[') for item in row]
-            row = [item.strip(']') for item in row]
-
-            # SEMAPHORES
-            if line.find('Mutex spin waits') == 0:
-                # Mutex spin waits 79626940, rounds 157459864, OS waits 698719
-                # Mutex spin waits 0, rounds 247280272495, OS waits 316513438
-                results['Innodb_mutex_spin_waits'] = long(row[3])
-                results['Innodb_mutex_spin_rounds'] = long(row[5])
-                results['Innodb_mutex_os_waits'] = long(row[8])
-            elif line.find('RW-shared spins') == 0 and line.find(';') > 0:
-                # RW-shared spins 3859028, OS waits 2100750; RW-excl spins
-                # 4641946, OS waits 1530310
-                results['Innodb_s_lock_spin_waits'] = long(row[2])
-                results['Innodb_x_lock_spin_waits'] = long(row[8])
-                results['Innodb_s_lock_os_waits'] = long(row[5])
-                results['Innodb_x_lock_os_waits'] = long(row[11])
-            elif line.find('RW-shared spins') == 0 and line.find('; RW-excl spins') == -1:
-                # Post 5.5.17 SHOW ENGINE INNODB STATUS syntax
-                # RW-shared spins 604733, rounds 8107431, OS waits 241268
-                results['Innodb_s_lock_spin_waits'] = long(row[2])
-                results['Innodb_s_lock_spin_rounds'] = long(row[4])
-                results['Innodb_s_lock_os_waits'] = long(row[7])
-            elif line.find('RW-excl spins') == 0:
-                # Post 5.5.17 SHOW ENGINE INNODB STATUS syntax
-                # RW-excl spins 604733, rounds 8107431, OS waits 241268
-                results['Innodb_x_lock_spin_waits'] = long(row[2])
-                results['Innodb_x_lock_spin_rounds'] = long(row[4])
-                results['Innodb_x_lock_os_waits'] = long(row[7])
-            elif line.find('seconds the semaphore:') > 0:
-                # --Thread 907205 has waited at handler/ha_innodb.cc line 7156 for 1.00 seconds the semaphore:
-                results['Innodb_semaphore_waits'] += 1
-                results[
-                    'Innodb_semaphore_wait_time'] += long(float(row[9])) * 1000
-
-            # TRANSACTIONS
-            elif line.find('Trx id counter') == 0:
-                # The beginning of the TRANSACTIONS section: start counting
-                # transactions
-                # Trx id counter 0 1170664159
-                # Trx id counter 861B144C
-                txn_seen = True
-            elif line.find('History list length') == 0:
-                # History list length 132
-                results['Innodb_history_list_length'] = long(row[3])
-            elif txn_seen and line.find('---TRANSACTION') == 0:
-                # ---TRANSACTION 0, not started, process no 13510, OS thread id 1170446656
-                results['Innodb_current_transactions'] += 1
-                if line.find('ACTIVE') > 0:
-                    results['Innodb_active_transactions'] += 1
-            elif txn_seen and line.find('------- TRX HAS BEEN') == 0:
-                # ------- TRX HAS BEEN WAITING 32 SEC FOR THIS LOCK TO BE GRANTED:
-                results['Innodb_row_lock_time'] += long(row[5]) * 1000
-            elif line.find('read views open inside InnoDB') > 0:
-                # 1 read views open inside InnoDB
-                results['Innodb_read_views'] = long(row[0])
-            elif line.find('mysql tables in use') == 0:
-                # mysql tables in use 2, locked 2
-                results['Innodb_tables_in_use'] += long(row[4])
-                results['Innodb_locked_tables'] += long(row[6])
-            elif txn_seen and line.find('lock struct(s)') > 0:
-                # 23 lock struct(s), heap size 3024, undo log entries 27
-                # LOCK WAIT 12 lock struct(s), heap size 3024, undo log entries 5
-                # LOCK WAIT 2 lock struct(s), heap size 368
-                if line.find('LOCK WAIT') == 0:
-                    results['Innodb_lock_structs'] += long(row[2])
-                    results['Innodb_locked_transactions'] += 1
-                elif line.find('ROLLING BACK') == 0:
-                    # ROLLING BACK 127539 lock struct(s), heap size 15201832,
-                    # 4411492 row lock(s), undo log entries 1042488
-                    results['Innodb_lock_structs'] += long(row[2])
-                else:
-                    results['Innodb_lock_structs'] += long(row[0])
-
-            # FILE I/O
-            elif line.find(' OS file reads, ') > 0:
-                # 8782182 OS file reads, 15635445 OS file writes, 947800 OS
-                # fsyncs
-                results['Innodb_os_file_reads'] = long(row[0])
-                results['Innodb_os_file_writes'] = long(row[4])
-                results['Innodb_os_file_fsyncs'] = long(row[8])
-            elif line.find('Pending normal aio reads:') == 0:
-                # Pending normal aio reads: 0, aio writes: 0,
-                # or Pending normal aio reads: [0, 0, 0, 0] , aio writes: [0, 0, 0, 0] ,
-                # or Pending normal aio reads: 0 [0, 0, 0, 0] , aio writes: 0 [0, 0, 0, 0] ,
-                if len(row) == 16:
-                    results['Innodb_pending_normal_aio_reads'] = (long(row[4]) + long(row[5]) +
-                                                                  long(row[6]) + long(row[7]))
-                    results['Innodb_pending_normal_aio_writes'] = (long(row[11]) + long(row[12]) +
-                                                                  long(row[13]) + long(row[14]))
-                elif len(row) == 18:
-                    results['Innodb_pending_normal_aio_reads'] = long(row[4])
-                    results['Innodb_pending_normal_aio_writes'] = long(row[12])
-                else:
-                    results['Innodb_pending_normal_aio_reads'] = long(row[4])
-                    results['Innodb_pending_normal_aio_writes'] = long(row[7])
-            elif line.find('ibuf aio reads') == 0:
-                #  ibuf aio reads: 0, log i/o's: 0, sync i/o's: 0
-                #  or ibuf aio reads:, log i/o's:, sync i/o's:
-                if len(row) == 10:
-                    results['Innodb_pending_ibuf_aio_reads'] = long(row[3])
-                    results['Innodb_pending_aio_log_ios'] = long(row[6])
-                    results['Innodb_pending_aio_sync_ios'] = long(row[9])
-                elif len(row) == 7:
-                    results['Innodb_pending_ibuf_aio_reads'] = 0
-                    results['Innodb_pending_aio_log_ios'] = 0
-                    results['Innodb_pending_aio_sync_ios'] = 0
-            elif line.find('Pending flushes (fsync)') == 0:
-                # Pending flushes (fsync) log: 0; buffer pool: 0
-                results['Innodb_pending_log_flushes'] = long(row[4])
-                results['Innodb_pending_buffer_pool_flushes'] = long(row[7])
-
-            # INSERT BUFFER AND ADAPTIVE HASH INDEX
-            elif line.find('Ibuf for space 0: size ') == 0:
-                # Older InnoDB code seemed to be ready for an ibuf per tablespace.  It
-                # had two lines in the output.  Newer has just one line, see below.
-                # Ibuf for space 0: size 1, free list len 887, seg size 889, is not empty
-                # Ibuf for space 0: size 1, free list len 887, seg size 889,
-                results['Innodb_ibuf_size'] = long(row[5])
-                results['Innodb_ibuf_free_list'] = long(row[9])
-                results['Innodb_ibuf_segment_size'] = long(row[12])
-            elif line.find('Ibuf: size ') == 0:
-                # Ibuf: size 1, free list len 4634, seg size 4636,
-                results['Innodb_ibuf_size'] = long(row[2])
-                results['Innodb_ibuf_free_list'] = long(row[6])
-                results['Innodb_ibuf_segment_size'] = long(row[9])
-
-                if line.find('merges') > -1:
-                    results['Innodb_ibuf_merges'] = long(row[10])
-            elif line.find(', delete mark ') > 0 and prev_line.find('merged operations:') == 0:
-                # Output of show engine innodb status has changed in 5.5
-                # merged operations:
-                # insert 593983, delete mark 387006, delete 73092
-                results['Innodb_ibuf_merged_inserts'] = long(row[1])
-                results['Innodb_ibuf_merged_delete_marks'] = long(row[4])
-                results['Innodb_ibuf_merged_deletes'] = long(row[6])
-                results['Innodb_ibuf_merged'] = results['Innodb_ibuf_merged_inserts'] + results[
-                    'Innodb_ibuf_merged_delete_marks'] + results['Innodb_ibuf_merged_deletes']
-            elif line.find(' merged recs, ') > 0:
-                # 19817685 inserts, 19817684 merged recs, 3552620 merges
-                results['Innodb_ibuf_merged_inserts'] = long(row[0])
-                results['Innodb_ibuf_merged'] = long(row[2])
-                results['Innodb_ibuf_merges'] = long(row[5])
-            elif line.find('Hash table size ') == 0:
-                # In some versions of InnoDB, the used cells is omitted.
-                # Hash table size 4425293, used cells 4229064, ....
-                # Hash table size 57374437, node heap has 72964 buffer(s) <--
-                # no used cells
-                results['Innodb_hash_index_cells_total'] = long(row[3])
-                results['Innodb_hash_index_cells_used'] = long(
-                    row[6]) if line.find('used cells') > 0 else 0
-
-            # LOG
-            elif line.find(" log i/o's done, ") > 0:
-                # 3430041 log i/o's done, 17.44 log i/o's/second
-                # 520835887 log i/o's done, 17.28 log i/o's/second, 518724686
-                # syncs, 2980893 checkpoints
-                results['Innodb_log_writes'] = long(row[0])
-            elif line.find(" pending log writes, ") > 0:
-                # 0 pending log writes, 0 pending chkp writes
-                results['Innodb_pending_log_writes'] = long(row[0])
-                results['Innodb_pending_checkpoint_writes'] = long(row[4])
-            elif line.find("Log sequence number") == 0:
-                # This number is NOT printed in hex in InnoDB plugin.
-                # Log sequence number 272588624
-                results['Innodb_lsn_current'] = long(row[3])
-            elif line.find("Log flushed up to") == 0:
-                # This number is NOT printed in hex in InnoDB plugin.
-                # Log flushed up to   272588624
-                results['Innodb_lsn_flushed'] = long(row[4])
-            elif line.find("Last checkpoint at") == 0:
-                # Last checkpoint at  272588624
-                results['Innodb_lsn_last_checkpoint'] = long(row[3])
-
-            # BUFFER POOL AND MEMORY
-            elif line.find("Total memory allocated") == 0 and line.find("in additional pool allocated") > 0:
-                # Total memory allocated 29642194944; in additional pool allocated 0
-                # Total memory allocated by read views 96
-                results['Innodb_mem_total'] = long(row[3])
-                results['Innodb_mem_additional_pool'] = long(row[8])
-            elif line.find('Adaptive hash index ') == 0:
-                #   Adaptive hash index 1538240664     (186998824 + 1351241840)
-                results['Innodb_mem_adaptive_hash'] = long(row[3])
-            elif line.find('Page hash           ') == 0:
-                #   Page hash           11688584
-                results['Innodb_mem_page_hash'] = long(row[2])
-            elif line.find('Dictionary cache    ') == 0:
-                #   Dictionary cache    145525560      (140250984 + 5274576)
-                results['Innodb_mem_dictionary'] = long(row[2])
-            elif line.find('File system         ') == 0:
-                #   File system         313848         (82672 + 231176)
-                results['Innodb_mem_file_system'] = long(row[2])
-            elif line.find('Lock system         ') == 0:
-                #   Lock system         29232616       (29219368 + 13248)
-                results['Innodb_mem_lock_system'] = long(row[2])
-            elif line.find('Recovery system     ') == 0:
-                #   Recovery system     0      (0 + 0)
-                results['Innodb_mem_recovery_system'] = long(row[2])
-            elif line.find('Threads             ') == 0:
-                #   Threads             409336         (406936 + 2400)
-                results['Innodb_mem_thread_hash'] = long(row[1])
-            elif line.find("Buffer pool size ") == 0:
-                # The " " after size is necessary to avoid matching the wrong line:
-                # Buffer pool size        1769471
-                # Buffer pool size, bytes 28991012864
-                results['Innodb_buffer_pool_pages_total'] = long(row[3])
-            elif line.find("Free buffers") == 0:
-                # Free buffers            0
-                results['Innodb_buffer_pool_pages_free'] = long(row[2])
-            elif line.find("Database pages") == 0:
-                # Database pages          1696503
-                results['Innodb_buffer_pool_pages_data'] = long(row[2])
-            elif line.find("Modified db pages") == 0:
-                # Modified db pages       160602
-                results['Innodb_buffer_pool_pages_dirty'] = long(row[3])
-            elif line.find("Pages read ahead") == 0:
-                # Must do this BEFORE the next test, otherwise it'll get fooled by this
-                # line from the new plugin:
-                # Pages read ahead 0.00/s, evicted without access 0.06/s
-                pass
-            elif line.find("Pages read") == 0:
-                # Pages read 15240822, created 1770238, written 21705836
-                results['Innodb_pages_read'] = long(row[2])
-                results['Innodb_pages_created'] = long(row[4])
-                results['Innodb_pages_written'] = long(row[6])
-
-            # ROW OPERATIONS
-            elif line.find('Number of rows inserted') == 0:
-                # Number of rows inserted 50678311, updated 66425915, deleted
-                # 20605903, read 454561562
-                results['Innodb_rows_inserted'] = long(row[4])
-                results['Innodb_rows_updated'] = long(row[6])
-                results['Innodb_rows_deleted'] = long(row[8])
-                results['Innodb_rows_read'] = long(row[10])
-            elif line.find(" queries inside InnoDB, ") > 0:
-                # 0 queries inside InnoDB, 0 queries in queue
-                results['Innodb_queries_inside'] = long(row[0])
-                results['Innodb_queries_queued'] = long(row[4])
-
-            prev_line = line
+        results = parse_innodb_status(innodb_status_text)
 
         # We need to calculate this metric separately
         try:
@@ -10,6 +10,7 @@ from subprocess import check_output
 # project
 from checks import AgentCheck
 from utils.platform import Platform
+from utils.proc_snapshot import get_proc_snapshot
 from utils.subprocess_output import (
     get_subprocess_output,
     SubprocessOutputEmptyError,
@@ -223,11 +224,8 @@ class Network(AgentCheck):
             except SubprocessOutputEmptyError:
                 self.log.exception("Error collecting connection stats.")
 
-        proc = open('/proc/net/dev', 'r')
-        try:
-            lines = proc.readlines()
-        finally:
-            proc.close()
+        proc_snapshot = get_proc_snapshot()
+        lines = proc_snapshot.get('net/dev')
         # Inter-|   Receive                                                 |  Transmit
         #  face |bytes     packets errs drop fifo frame compressed multicast|bytes       packets errs drop fifo colls carrier compressed
         #     lo:45890956   112797   0    0    0     0          0         0    45890956   112797    0    0    0     0       0          0
@@ -250,8 +248,6 @@ class Network(AgentCheck):
                 self._submit_devicemetrics(iface, metrics)
 
         try:
-            proc = open('/proc/net/snmp', 'r')
-
             # IP:      Forwarding   DefaultTTL InReceives     InHdrErrors  ...
             # IP:      2            64         377145470      0            ...
             # Icmp:    InMsgs       InErrors   InDestUnreachs InTimeExcds  ...
@@ -264,10 +260,7 @@ class Network(AgentCheck):
             # Udp:     24249494     1643257    0              25892947     ...
             # UdpLite: InDatagrams  Noports    InErrors       OutDatagrams ...
             # UdpLite: 0            0          0              0            ...
-            try:
-                lines = proc.readlines()
-            finally:
-                proc.close()
+            lines = proc_snapshot.get('net/snmp')
 
             tcp_lines = [line for line in lines if line.startswith('Tcp:')]
             udp_lines = [line for line in lines if line.startswith('Udp:')]
@@ -1,5 +1,6 @@
 # stdlib
-from collections import defaultdict
+from collections import defaultdict, namedtuple
+import re
 import time
 
 # 3p
@@ -9,6 +10,7 @@ import psutil
 from checks import AgentCheck
 from config import _is_affirmative
 from utils.platform import Platform
+from utils.proc_snapshot import get_proc_snapshot
 
 
 DEFAULT_AD_CACHE_DURATION = 120
@@ -31,6 +33,54 @@ ATTR_TO_METRIC = {
 }
 
 
+ProcessMatches = namedtuple('ProcessMatches', ['pids', 'matches', 'denied'])
+
+
+def index_process_names(names):
+    """
+    Index the processes by name: {pid: name} -> ProcessMatches, where
+    `matches` is {name: pids} and `denied` is {pid: psutil.AccessDenied}
+    """
+    matches = defaultdict(set)
+    denied = {}
+    for pid, name in names.iteritems():
+        if isinstance(name, psutil.AccessDenied):
+            denied[pid] = name
+        else:
+            matches[name].add(pid)
+    return ProcessMatches(set(names), matches, denied)
+
+
+class CmdlineMatcher(object):
+    """
+    Find the processes which command line contains any of `patterns`, for
+    all of them in a single pass over the processes.
+    Most of the processes don't match any pattern: they're ruled out by a
+    single search of all the patterns at once, only the other ones are
+    searched for each pattern.
+    """
+
+    def __init__(self, patterns):
+        self.patterns = frozenset(patterns)
+        self._any_pattern_re = re.compile('|'.join(re.escape(p) for p in sorted(self.patterns)))
+
+    def __call__(self, cmdlines):
+        """ {pid: command line arguments} -> ProcessMatches, with {pattern: pids} """
+        matches = dict((pattern, set()) for pattern in self.patterns)
+        denied = {}
+        for pid, cmdline in cmdlines.iteritems():
+            if isinstance(cmdline, psutil.AccessDenied):
+                denied[pid] = cmdline
+                continue
+            cmdline = ' '.join(cmdline)
+            if not self.patterns or self._any_pattern_re.search(cmdline) is None:
+                continue
+            for pattern in self.patterns:
+                if pattern in cmdline:
+                    matches[pattern].add(pid)
+        return ProcessMatches(set(cmdlines), matches, denied)
+
+
 class ProcessCheck(AgentCheck):
     def __init__(self, name, init_config, agentConfig, instances=None):
         AgentCheck.__init__(self, name, init_config, agentConfig, instances)
@@ -69,6 +119,15 @@ class ProcessCheck(AgentCheck):
         # Process cache, indexed by instance
         self.process_cache = defaultdict(dict)
 
+        # Command lines of all the instances are matched together
+        patterns = set()
+        for instance in self.instances or []:
+            search_string = instance.get('search_string')
+            if isinstance(search_string, list) and not _is_affirmative(instance.get('exact_match', True)):
+                patterns.update(search_string)
+        patterns.discard('All')
+        self._cmdline_matcher = CmdlineMatcher(patterns)
+
     def should_refresh_ad_cache(self, name):
         now = time.time()
         return now - self.last_ad_cache_ts.get(name, 0) > self.access_denied_cache_duration
@@ -91,41 +150,38 @@ class ProcessCheck(AgentCheck):
 
         refresh_ad_cache = self.should_refresh_ad_cache(name)
 
-        matching_pids = set()
+        # The names or command lines of all the processes are read once,
+        # and matched once for all the instances looking for processes
+        proc_snapshot = get_proc_snapshot(getattr(psutil, 'PROCFS_PATH', '/proc'))
+        if exact_match:
+            processes = proc_snapshot.get('process_names', index_process_names)
+        else:
+            missing_patterns = set(search_string) - self._cmdline_matcher.patterns - set(['All'])
+            if missing_patterns:
+                self._cmdline_matcher = CmdlineMatcher(self._cmdline_matcher.patterns | missing_patterns)
+            processes = proc_snapshot.get('process_cmdlines', self._cmdline_matcher)
 
-        for proc in psutil.process_iter():
-            # Skip access denied processes
-            if not refresh_ad_cache and proc.pid in self.ad_cache:
+        # Skip access denied processes
+        if refresh_ad_cache:
+            self.ad_cache.intersection_update(processes.denied)
+        for pid, e in processes.denied.iteritems():
+            if not refresh_ad_cache and pid in self.ad_cache:
                 continue
+            ad_error_logger('Access denied to process with PID %s', pid)
+            ad_error_logger('Error: %s', e)
+            if refresh_ad_cache:
+                self.ad_cache.add(pid)
+            if not ignore_ad:
+                raise e
 
-            found = False
-            for string in search_string:
-                try:
-                    # FIXME 6.x: All has been deprecated from the doc, should be removed
-                    if string == 'All':
-                        found = True
-                    if exact_match:
-                        if proc.name() == string:
-                            found = True
-                    else:
-                        cmdline = proc.cmdline()
-                        if string in ' '.join(cmdline):
-                            found = True
-                except psutil.NoSuchProcess:
-                    self.log.warning('Process disappeared while scanning')
-                except psutil.AccessDenied, e:
-                    ad_error_logger('Access denied to process with PID %s', proc.pid)
-                    ad_error_logger('Error: %s', e)
-                    if refresh_ad_cache:
-                        self.ad_cache.add(proc.pid)
-                    if not ignore_ad:
-                        raise
-                else:
-                    if refresh_ad_cache:
-                        self.ad_cache.discard(proc.pid)
-                    if found:
-                        matching_pids.add(proc.pid)
-                        break
+        matching_pids = set()
+        for string in search_string:
+            # FIXME 6.x: All has been deprecated from the doc, should be removed
+            if string == 'All':
+                matching_pids.update(processes.pids)
+            else:
+                matching_pids.update(processes.matches.get(string, ()))
+        matching_pids.difference_update(processes.denied)
 
         self.pid_cache[name] = matching_pids
         self.last_pid_cache_ts[name] = time.time()
@@ -201,38 +257,48 @@ class ProcessCheck(AgentCheck):
 
             p = self.process_cache[name][pid]
 
-            meminfo = self.psutil_wrapper(p, 'memory_info', ['rss', 'vms'])
-            st['rss'].append(meminfo.get('rss'))
-            st['vms'].append(meminfo.get('vms'))
-
-            # will fail on win32 and solaris
-            shared_mem = self.psutil_wrapper(p, 'memory_info_ex', ['shared']).get('shared')
-            if shared_mem is not None and meminfo.get('rss') is not None:
-                st['real'].append(meminfo['rss'] - shared_mem)
+            # psutil >= 5.0 reads what's shared by the Process methods once
+            if hasattr(p, 'oneshot'):
+                with p.oneshot():
+                    self._get_process_stats(p, new_process, st)
             else:
-                st['real'].append(None)
+                self._get_process_stats(p, new_process, st)
 
-            ctxinfo = self.psutil_wrapper(p, 'num_ctx_switches', ['voluntary', 'involuntary'])
-            st['ctx_swtch_vol'].append(ctxinfo.get('voluntary'))
-            st['ctx_swtch_invol'].append(ctxinfo.get('involuntary'))
+        return st
 
-            st['thr'].append(self.psutil_wrapper(p, 'num_threads', None))
+    def _get_process_stats(self, p, new_process, st):
+        # will fail on win32 and solaris, memory_info has the rss and vms
+        meminfo = self.psutil_wrapper(p, 'memory_info_ex', ['rss', 'vms', 'shared'])
+        if meminfo.get('rss') is None:
+            meminfo = self.psutil_wrapper(p, 'memory_info', ['rss', 'vms'])
+        st['rss'].append(meminfo.get('rss'))
+        st['vms'].append(meminfo.get('vms'))
 
-            cpu_percent = self.psutil_wrapper(p, 'cpu_percent', None)
-            if not new_process:
-                # psutil returns `0.` for `cpu_percent` the first time it's sampled on a process,
-                # so save the value only on non-new processes
-                st['cpu'].append(cpu_percent)
+        shared_mem = meminfo.get('shared')
+        if shared_mem is not None and meminfo.get('rss') is not None:
+            st['real'].append(meminfo['rss'] - shared_mem)
+        else:
+            st['real'].append(None)
 
-            st['open_fd'].append(self.psutil_wrapper(p, 'num_fds', None))
+        ctxinfo = self.psutil_wrapper(p, 'num_ctx_switches', ['voluntary', 'involuntary'])
+        st['ctx_swtch_vol'].append(ctxinfo.get('voluntary'))
+        st['ctx_swtch_invol'].append(ctxinfo.get('involuntary'))
 
-            ioinfo = self.psutil_wrapper(p, 'io_counters', ['read_count', 'write_count', 'read_bytes', 'write_bytes'])
-            st['r_count'].append(ioinfo.get('read_count'))
-            st['w_count'].append(ioinfo.get('write_count'))
-            st['r_bytes'].append(ioinfo.get('read_bytes'))
-            st['w_bytes'].append(ioinfo.get('write_bytes'))
+        st['thr'].append(self.psutil_wrapper(p, 'num_threads', None))
 
-        return st
+        cpu_percent = self.psutil_wrapper(p, 'cpu_percent', None)
+        if not new_process:
+            # psutil returns `0.` for `cpu_percent` the first time it's sampled on a process,
+            # so save the value only on non-new processes
+            st['cpu'].append(cpu_percent)
+
+        st['open_fd'].append(self.psutil_wrapper(p, 'num_fds', None))
+
+        ioinfo = self.psutil_wrapper(p, 'io_counters', ['read_count', 'write_count', 'read_bytes', 'write_bytes'])
+        st['r_count'].append(ioinfo.get('read_count'))
+        st['w_count'].append(ioinfo.get('write_count'))
+        st['r_bytes'].append(ioinfo.get('read_bytes'))
+        st['w_bytes'].append(ioinfo.get('write_bytes'))
 
     def check(self, instance):
         name = instance.get('name', None)
@@ -10,7 +10,7 @@ import traceback
 
 # 3p
 from pyVim import connect
-from pyVmomi import vim
+from pyVmomi import vim, vmodl
 
 # project
 from checks import AgentCheck
@@ -30,6 +30,10 @@ REFRESH_MORLIST_INTERVAL = 3 * 60
 REFRESH_METRICS_METADATA_INTERVAL = 10 * 60
 # The amount of jobs batched at the same time in the queue to query available metrics
 BATCH_MORLIST_SIZE = 50
+# The amount of MORs which metrics are queried in a single QueryPerf call.
+# vCenter rejects the queries for more than `config.vpxd.stats.maxQueryMetrics`
+# entities (64 by default) on some intervals, stay below it
+BATCH_QUERY_PERF_SIZE = 64
 
 # Time after which we reap the jobs that clog the queue
 # TODO: use it
@@ -745,9 +749,22 @@ class VSphereCheck(AgentCheck):
         # Defaults to return the value without transformation
         return value
 
+    def _query_perf(self, perfManager, mors):
+        """ Query the latest values of the metrics of the MORs, in a single QueryPerf call """
+        queries = [
+            vim.PerformanceManager.QuerySpec(maxSample=1,
+                                             entity=mor['mor'],
+                                             metricId=mor['metrics'],
+                                             intervalId=20,
+                                             format='normal')
+            for mor in mors
+        ]
+        return perfManager.QueryPerf(querySpec=queries)
+
     @atomic_method
-    def _collect_metrics_atomic(self, instance, mor):
-        """ Task that collects the metrics listed in the morlist for one MOR
+    def _collect_metrics_atomic(self, instance, mors):
+        """ Task that collects the metrics listed in the morlist for a batch
+        of MORs, in a single query
         """
         ### <TEST-INSTRUMENTATION>
         t = Timer()
@@ -756,14 +773,32 @@ class VSphereCheck(AgentCheck):
         i_key = self._instance_key(instance)
         server_instance = self._get_server_instance(instance)
         perfManager = server_instance.content.perfManager
-        query = vim.PerformanceManager.QuerySpec(maxSample=1,
-                                                 entity=mor['mor'],
-                                                 metricId=mor['metrics'],
-                                                 intervalId=20,
-                                                 format='normal')
-        results = perfManager.QueryPerf(querySpec=[query])
-        if results:
-            for result in results[0].value:
+        try:
+            results = self._query_perf(perfManager, mors)
+        except vmodl.MethodFault as e:
+            # The vmodl.fault and vim.fault faults. A single entity, e.g. a VM
+            # removed since the MORs were cached, fails the whole query: the
+            # MORs of the batch are queried again one by one.
+            if len(mors) == 1:
+                raise
+            self.log.warning("Failed to query the metrics of a batch of %d MORs, querying them one by one: %s",
+                             len(mors), e.msg or type(e).__name__)
+            results = []
+            for mor in mors:
+                try:
+                    results.extend(self._query_perf(perfManager, [mor]) or [])
+                except vmodl.MethodFault as e:
+                    self.log.warning("Failed to query the metrics of %s: %s", mor['hostname'], e.msg or type(e).__name__)
+
+        # One result per MOR which has metric values, identified by its entity
+        mors_by_name = dict((str(mor['mor']), mor) for mor in mors)
+        for mor_result in results or []:
+            mor = mors_by_name.get(str(mor_result.entity))
+            if mor is None:
+                self.log.debug("Skipping the metric values of %s, it wasn't queried", mor_result.entity)
+                continue
+
+            for result in mor_result.value:
                 if result.id.counterId not in self.metrics_metadata[i_key]:
                     self.log.debug("Skipping this metric value, because there is no metadata about it")
                     continue
@@ -787,8 +822,8 @@ class VSphereCheck(AgentCheck):
         ### </TEST-INSTRUMENTATION>
 
     def collect_metrics(self, instance):
-        """ Calls asynchronously _collect_metrics_atomic on all MORs, as the
-        job queue is processed the Aggregator will receive the metrics.
+        """ Calls asynchronously _collect_metrics_atomic on batches of MORs, as
+        the job queue is processed the Aggregator will receive the metrics.
         """
         i_key = self._instance_key(instance)
         if i_key not in self.morlist:
@@ -799,6 +834,8 @@ class VSphereCheck(AgentCheck):
         self.log.debug("Collecting metrics of %d mors" % len(mors))
 
         vm_count = 0
+        batch_size = int(self.init_config.get('batch_query_perf_size', BATCH_QUERY_PERF_SIZE))
+        batch = []
 
         for mor_name, mor in mors:
             if mor['mor_type'] == 'vm':
@@ -807,7 +844,13 @@ class VSphereCheck(AgentCheck):
                 # self.log.debug("Skipping entity %s collection because we didn't cache its metrics yet" % mor['hostname'])
                 continue
 
-            self.pool.apply_async(self._collect_metrics_atomic, args=(instance, mor))
+            batch.append(mor)
+            if len(batch) >= batch_size:
+                self.pool.apply_async(self._collect_metrics_atomic, args=(instance, batch))
+                batch = []
+
+        if batch:
+            self.pool.apply_async(self._collect_metrics_atomic, args=(instance, batch))
 
         self.gauge('vsphere.vm.count', vm_count, tags=["vcenter_server:%s" % instance.get('name')])
 
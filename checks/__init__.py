@@ -5,7 +5,6 @@ The Check class is being deprecated so don't write new checks with it.
 """
 # stdlib
 from collections import defaultdict
-import copy
 import logging
 import numbers
 import os
@@ -25,6 +24,7 @@ import yaml
 
 # project
 from checks import check_status
+from checks.instance_config import freeze, thaw
 from util import get_hostname, get_next_id, LaconicFilter, yLoader
 from utils.platform import Platform
 from utils.profile import pretty_statistics
@@ -330,12 +330,15 @@ class AgentCheck(object):
             formatter=agent_formatter,
             recent_point_threshold=agentConfig.get('recent_point_threshold', None),
             histogram_aggregates=agentConfig.get('histogram_aggregates'),
-            histogram_percentiles=agentConfig.get('histogram_percentiles')
+            histogram_percentiles=agentConfig.get('histogram_percentiles'),
+            histogram_backend=agentConfig.get('histogram_backend')
         )
 
         self.events = []
         self.service_checks = []
         self.instances = instances or []
+        # (instances, their frozen copies) set by `freeze_instances`
+        self._frozen_instances = None
         self.warnings = []
         self.library_versions = None
         self.last_collection_time = defaultdict(int)
@@ -713,8 +716,27 @@ class AgentCheck(object):
         self._internal_profiling_stats = None
         return stats
 
-    def run(self):
-        """ Run all instances. """
+    def freeze_instances(self):
+        """
+        Take an immutable copy of the instances, the check runs get a
+        plain copy of it. Changes made to the instances after this
+        aren't seen by the runs, unless `self.instances` is replaced.
+        """
+        self._frozen_instances = (self.instances, [freeze(instance) for instance in self.instances])
+
+    def get_min_collection_interval(self, instance):
+        return instance.get(
+            'min_collection_interval', self.init_config.get(
+                'min_collection_interval',
+                self.DEFAULT_MIN_COLLECTION_INTERVAL
+            )
+        )
+
+    def run(self, instance_indexes=None):
+        """
+        Run all instances, or only the instances at `instance_indexes` when
+        something else decides when they should run.
+        """
 
         # Store run statistics if needed
         before, after = None, None
@@ -724,26 +746,28 @@ class AgentCheck(object):
             except Exception:  # It's fine if we can't collect stats for the run, just log and proceed
                 self.log.debug("Failed to collect Agent Stats before check {0}".format(self.name))
 
+        if self._frozen_instances is None or self._frozen_instances[0] is not self.instances:
+            self.freeze_instances()
+        frozen_instances = self._frozen_instances[1]
+
         instance_statuses = []
         for i, instance in enumerate(self.instances):
+            if instance_indexes is not None and i not in instance_indexes:
+                continue
             try:
-                min_collection_interval = instance.get(
-                    'min_collection_interval', self.init_config.get(
-                        'min_collection_interval',
-                        self.DEFAULT_MIN_COLLECTION_INTERVAL
-                    )
-                )
                 now = time.time()
-                if now - self.last_collection_time[i] < min_collection_interval:
-                    self.log.debug("Not running instance #{0} of check {1} as it ran less than {2}s ago".format(i, self.name, min_collection_interval))
-                    continue
+                if instance_indexes is None:
+                    min_collection_interval = self.get_min_collection_interval(instance)
+                    if now - self.last_collection_time[i] < min_collection_interval:
+                        self.log.debug("Not running instance #{0} of check {1} as it ran less than {2}s ago".format(i, self.name, min_collection_interval))
+                        continue
 
                 self.last_collection_time[i] = now
 
                 check_start_time = None
                 if self.in_developer_mode:
                     check_start_time = timeit.default_timer()
-                self.check(copy.deepcopy(instance))
+                self.check(thaw(frozen_instances[i]))
 
                 instance_check_stats = None
                 if check_start_time is not None:
@@ -82,6 +82,25 @@ def style(*args):
     return Stylizer.stylize(*args)
 
 
+def http_stats_line(stats):
+    line = "HTTP requests: %s, %s on a reused connection" % (
+        stats['request_count'], stats['reused_connection_count'])
+    if stats['avg_latency_ms'] is not None:
+        line += ", latency: %sms avg, %sms last" % (stats['avg_latency_ms'], stats['last_latency_ms'])
+    return line
+
+
+def latency_histogram_line(histogram):
+    """ The (upper bound in ms, count) buckets of a latency histogram, the last one has no bound """
+    buckets = []
+    for i, (bound, count) in enumerate(histogram):
+        if bound is None:
+            buckets.append(">%sms: %s" % (histogram[i - 1][0], count))
+        else:
+            buckets.append("<=%sms: %s" % (bound, count))
+    return ", ".join(buckets)
+
+
 def logger_info():
     loggers = []
     root_logger = logging.getLogger()
@@ -344,11 +363,12 @@ class CollectorStatus(AgentStatus):
 
     NAME = 'Collector'
 
-    def __init__(self, check_statuses=None, emitter_statuses=None, metadata=None):
+    def __init__(self, check_statuses=None, emitter_statuses=None, metadata=None, http_stats=None):
         AgentStatus.__init__(self)
         self.check_statuses = check_statuses or []
         self.emitter_statuses = emitter_statuses or []
         self.host_metadata = metadata or []
+        self.http_stats = http_stats
 
     @property
     def status(self):
@@ -625,6 +645,8 @@ class CollectorStatus(AgentStatus):
                 if es.status != STATUS_OK:
                     line += ": %s" % es.error
                 lines.append(line)
+        if self.http_stats is not None:
+            lines.append("  " + http_stats_line(self.http_stats))
 
         return lines
 
@@ -683,6 +705,7 @@ class CollectorStatus(AgentStatus):
             if es.has_error():
                 check_status['error'] = es.error
             status_info['emitter'].append(check_status)
+        status_info['http'] = self.http_stats
 
         osname = config.get_os()
 
@@ -716,7 +739,8 @@ class DogstatsdStatus(AgentStatus):
     NAME = 'Dogstatsd'
 
     def __init__(self, flush_count=0, packet_count=0, packets_per_second=0,
-            metric_count=0, event_count=0, service_check_count=0):
+            metric_count=0, event_count=0, service_check_count=0, udp_drop_count=None,
+            listener_stats=None, forwarder_stats=None, http_stats=None):
         AgentStatus.__init__(self)
         self.flush_count = flush_count
         self.packet_count = packet_count
@@ -724,6 +748,12 @@ class DogstatsdStatus(AgentStatus):
         self.metric_count = metric_count
         self.event_count = event_count
         self.service_check_count = service_check_count
+        self.udp_drop_count = udp_drop_count
+        # {listener: {'packet_count': ..., 'drop_count': ...}}
+        self.listener_stats = listener_stats or {}
+        # {'forwarded_count': ..., 'dropped_count': ...}, None when not forwarding
+        self.forwarder_stats = forwarder_stats
+        self.http_stats = http_stats
 
     def has_error(self):
         return self.flush_count == 0 and self.packet_count == 0 and self.metric_count == 0
@@ -737,6 +767,18 @@ class DogstatsdStatus(AgentStatus):
             "Event count: %s" % self.event_count,
             "Service check count: %s" % self.service_check_count,
         ]
+        if self.udp_drop_count is not None:
+            lines.append("Packets dropped by the kernel: %s" % self.udp_drop_count)
+        for listener, stats in sorted(self.listener_stats.iteritems()):
+            line = "Listener %s: %s packets received" % (listener, stats['packet_count'])
+            if stats['drop_count'] is not None:
+                line += ", %s dropped" % stats['drop_count']
+            lines.append(line)
+        if self.forwarder_stats is not None:
+            lines.append("Forwarded to statsd: %s packets forwarded, %s dropped" % (
+                self.forwarder_stats['forwarded_count'], self.forwarder_stats['dropped_count']))
+        if self.http_stats is not None:
+            lines.append(http_stats_line(self.http_stats))
         return lines
 
     def to_dict(self):
@@ -748,6 +790,10 @@ class DogstatsdStatus(AgentStatus):
             'metric_count': self.metric_count,
             'event_count': self.event_count,
             'service_check_count': self.service_check_count,
+            'udp_drop_count': self.udp_drop_count,
+            'listeners': self.listener_stats,
+            'forwarder': self.forwarder_stats,
+            'http': self.http_stats,
         })
         return status_info
 
@@ -757,13 +803,15 @@ class ForwarderStatus(AgentStatus):
     NAME = 'Forwarder'
 
     def __init__(self, queue_length=0, queue_size=0, flush_count=0, transactions_received=0,
-            transactions_flushed=0):
+            transactions_flushed=0, spilled_length=0, endpoint_stats=None):
         AgentStatus.__init__(self)
         self.queue_length = queue_length
+        self.spilled_length = spilled_length
         self.queue_size = queue_size
         self.flush_count = flush_count
         self.transactions_received = transactions_received
         self.transactions_flushed = transactions_flushed
+        self.endpoint_stats = endpoint_stats or {}
         self.proxy_data = get_config(parse_args=False).get('proxy_settings')
         self.hidden_username = None
         self.hidden_password = None
@@ -777,12 +825,26 @@ class ForwarderStatus(AgentStatus):
         lines = [
             "Queue Size: %s bytes" % self.queue_size,
             "Queue Length: %s" % self.queue_length,
+            "Spilled to disk: %s" % self.spilled_length,
             "Flush Count: %s" % self.flush_count,
             "Transactions received: %s" % self.transactions_received,
             "Transactions flushed: %s" % self.transactions_flushed,
             ""
         ]
 
+        if self.endpoint_stats:
+            lines += [
+                "Endpoints",
+                "=========",
+                ""
+            ]
+            for endpoint, stats in sorted(self.endpoint_stats.iteritems()):
+                lines.append("  %s: %s requests, %s errors, %s in flight, %sms avg latency" % (
+                    endpoint, stats['request_count'], stats['error_count'],
+                    stats['in_flight'], stats['avg_latency_ms']))
+                lines.append("    Latency: %s" % latency_histogram_line(stats['latency_histogram']))
+            lines.append("")
+
         if self.proxy_data:
             lines += [
                 "Proxy",
@@ -808,10 +870,11 @@ class ForwarderStatus(AgentStatus):
             'flush_count': self.flush_count,
             'queue_length': self.queue_length,
             'queue_size': self.queue_size,
+            'spilled_length': self.spilled_length,
             'proxy_data': self.proxy_data,
             'hidden_username': self.hidden_username,
             'hidden_password': self.hidden_password,
-
+            'endpoints': self.endpoint_stats,
         })
         return status_info
 
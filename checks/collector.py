@@ -12,12 +12,15 @@ from checks.check_status import (
     CheckStatus,
     CollectorStatus,
     EmitterStatus,
+    InstanceStatus,
     STATUS_ERROR,
     STATUS_OK,
 )
 from checks.datadog import DdForwarder, Dogstreams
 from checks.ganglia import Ganglia
-from config import get_system_stats, get_version
+from checks.libs.thread_pool import Pool, TimeoutError
+from checks.scheduler import CheckScheduler
+from config import DEFAULT_CHECK_FREQUENCY, DEFAULT_CHECK_TIMEOUT, get_system_stats, get_version
 from resources.processes import Processes as ResProcesses
 import checks.system.unix as u
 import checks.system.win32 as w32
@@ -30,9 +33,11 @@ from util import (
     get_uuid,
     Timer,
 )
+from utils.http import get_http_session_stats
 from utils.logger import log_exceptions
 from utils.jmx import JMXFiles
 from utils.platform import Platform
+from utils.proc_snapshot import invalidate_proc_snapshots
 from utils.subprocess_output import get_subprocess_output
 
 log = logging.getLogger(__name__)
@@ -41,6 +46,8 @@ log = logging.getLogger(__name__)
 FLUSH_LOGGING_PERIOD = 10
 FLUSH_LOGGING_INITIAL = 5
 DD_CHECK_TAG = 'dd_check:{0}'
+# How often the collector checks whether a queued check got a runner, in seconds
+CHECK_QUEUED_WAIT = 0.1
 
 
 class AgentPayload(collections.MutableMapping):
@@ -182,6 +189,20 @@ class Collector(object):
         self.initialized_checks_d = []
         self.init_failed_checks_d = {}
 
+        # checks.d checks run in parallel on a pool of `check_runners` threads,
+        # they're run one by one in the collector thread if there's only one
+        self._check_runners = None
+        self._check_runner_count = agentConfig.get('check_runners', 1)
+        self._check_timeout = agentConfig.get('check_timeout', DEFAULT_CHECK_TIMEOUT)
+        if self._check_runner_count > 1:
+            self._check_runners = Pool(self._check_runner_count, name="CheckRunner")
+        # Checks which didn't finish their run in time: check -> pending result
+        self._pending_check_runs = {}
+        # check -> when its last run started on a check runner
+        self._check_start_times = {}
+        # Each instance of a checks.d check runs on its own schedule
+        self._scheduler = CheckScheduler(int(agentConfig.get('check_freq', DEFAULT_CHECK_FREQUENCY)))
+
         # Unix System Checks
         self._unix_system_checks = {
             'io': u.IO(log),
@@ -241,6 +262,8 @@ class Collector(object):
         self.continue_running = False
         for check in self.initialized_checks_d:
             check.stop()
+        if self._check_runners is not None:
+            self._check_runners.terminate()
 
     @staticmethod
     def _stats_for_display(raw_stats):
@@ -257,6 +280,8 @@ class Collector(object):
             cpu_clock = time.clock()
         self.run_count += 1
         log.debug("Starting collection run #%s" % self.run_count)
+        # What the checks read from /proc is shared during the run only
+        invalidate_proc_snapshots()
 
         if checksd:
             self.initialized_checks_d = checksd['initialized_checks']  # is a list of AgentCheck instances
@@ -272,6 +297,7 @@ class Collector(object):
                     self._agent_metrics = check
                     self.initialized_checks_d.remove(check)
                     break
+        self._scheduler.set_checks(self.initialized_checks_d)
 
         # Initialize payload
         self._build_payload(payload)
@@ -391,79 +417,9 @@ class Collector(object):
                 metrics.extend(res)
 
         # checks.d checks
-        check_statuses = []
-        for check in self.initialized_checks_d:
-            if not self.continue_running:
-                return
-            log.info("Running check %s" % check.name)
-            instance_statuses = []
-            metric_count = 0
-            event_count = 0
-            service_check_count = 0
-            check_start_time = time.time()
-            check_stats = None
-
-            try:
-                # Run the check.
-                instance_statuses = check.run()
-
-                # Collect the metrics and events.
-                current_check_metrics = check.get_metrics()
-                current_check_events = check.get_events()
-                check_stats = check._get_internal_profiling_stats()
-
-                # Collect metadata
-                current_check_metadata = check.get_service_metadata()
-
-                # Save metrics & events for the payload.
-                metrics.extend(current_check_metrics)
-                if current_check_events:
-                    if check.name not in events:
-                        events[check.name] = current_check_events
-                    else:
-                        events[check.name] += current_check_events
-
-                # Save the status of the check.
-                metric_count = len(current_check_metrics)
-                event_count = len(current_check_events)
-
-            except Exception:
-                log.exception("Error running check %s" % check.name)
-
-            check_status = CheckStatus(
-                check.name, instance_statuses, metric_count,
-                event_count, service_check_count, service_metadata=current_check_metadata,
-                library_versions=check.get_library_info(),
-                source_type_name=check.SOURCE_TYPE_NAME or check.name,
-                check_stats=check_stats
-            )
-
-            # Service check for Agent checks failures
-            service_check_tags = ["check:%s" % check.name]
-            if check_status.status == STATUS_OK:
-                status = AgentCheck.OK
-            elif check_status.status == STATUS_ERROR:
-                status = AgentCheck.CRITICAL
-            check.service_check('datadog.agent.check_status', status, tags=service_check_tags)
-
-            # Collect the service checks and save them in the payload
-            current_check_service_checks = check.get_service_checks()
-            if current_check_service_checks:
-                service_checks.extend(current_check_service_checks)
-            service_check_count = len(current_check_service_checks)
-
-            # Update the check status with the correct service_check_count
-            check_status.service_check_count = service_check_count
-            check_statuses.append(check_status)
-
-            check_run_time = time.time() - check_start_time
-            log.debug("Check %s ran in %.2f s" % (check.name, check_run_time))
-
-            # Intrument check run timings if enabled.
-            if self.check_timings:
-                metric = 'datadog.agent.check_run_time'
-                meta = {'tags': ["check:%s" % check.name]}
-                metrics.append((metric, time.time(), check_run_time, meta))
+        check_statuses = self._collect_checks_d(metrics, events, service_checks)
+        if check_statuses is None:
+            return
 
         for check_name, info in self.init_failed_checks_d.iteritems():
             if not self.continue_running:
@@ -512,7 +468,8 @@ class Collector(object):
         # Persist the status of the collection run.
         try:
             CollectorStatus(check_statuses, emitter_statuses,
-                            self.hostname_metadata_cache).persist()
+                            self.hostname_metadata_cache,
+                            http_stats=get_http_session_stats()).persist()
         except Exception:
             log.exception("Error persisting collector status")
 
@@ -528,6 +485,223 @@ class Collector(object):
 
         return payload
 
+    @log_exceptions(log)
+    def run_due_checks(self):
+        """
+        Run the checks.d instances which are due before the next collection
+        run, and submit what they collected right away.
+        """
+        invalidate_proc_snapshots()
+        payload = AgentPayload()
+        self._build_payload(payload)
+
+        check_statuses = self._collect_checks_d(payload['metrics'], payload['events'],
+                                                payload['service_checks'], due_only=True)
+        if not check_statuses:
+            return
+
+        log.debug("Ran %s due check(s)" % len(check_statuses))
+        payload.emit(log, self.agentConfig, self.emitters, self.continue_running)
+
+        return payload
+
+    def get_next_check_run_time(self):
+        """ When the next checks.d instance is due, None if there isn't any """
+        return self._scheduler.get_next_run_time()
+
+    def _collect_checks_d(self, metrics, events, service_checks, due_only=False):
+        """
+        Run the checks.d checks, add what they collected to `metrics`,
+        `events` and `service_checks` and return their statuses.
+        Return None if the collector is stopped meanwhile.
+        """
+        check_statuses = []
+        for check, check_result in self._run_checks_d(due_only):
+            if not self.continue_running:
+                return
+
+            if check_result is None:
+                # The check is still running, report it as failing for this run
+                log.warning("Check %s didn't finish its run in %ss" % (check.name, self._check_timeout))
+                error = "Check run timed out after %ss" % self._check_timeout
+                check_statuses.append(CheckStatus(
+                    check.name, [InstanceStatus(i, STATUS_ERROR, error=error)
+                                 for i in xrange(len(check.instances))],
+                    service_metadata=[{} for _ in check.instances],
+                    library_versions=check.get_library_info(),
+                    source_type_name=check.SOURCE_TYPE_NAME or check.name
+                ))
+                service_checks.append(create_service_check(
+                    'datadog.agent.check_status', AgentCheck.CRITICAL,
+                    tags=["check:%s" % check.name], hostname=self.hostname
+                ))
+                continue
+
+            instance_statuses, current_check_metrics, current_check_events, \
+                current_check_metadata, check_stats, check_run_time, check_lag = check_result
+
+            # Save metrics & events for the payload.
+            metrics.extend(current_check_metrics)
+            if current_check_events:
+                if check.name not in events:
+                    events[check.name] = current_check_events
+                else:
+                    events[check.name] += current_check_events
+
+            check_status = CheckStatus(
+                check.name, instance_statuses, len(current_check_metrics),
+                len(current_check_events), 0, service_metadata=current_check_metadata,
+                library_versions=check.get_library_info(),
+                source_type_name=check.SOURCE_TYPE_NAME or check.name,
+                check_stats=check_stats
+            )
+
+            # Service check for Agent checks failures
+            service_check_tags = ["check:%s" % check.name]
+            if check_status.status == STATUS_OK:
+                status = AgentCheck.OK
+            elif check_status.status == STATUS_ERROR:
+                status = AgentCheck.CRITICAL
+            check.service_check('datadog.agent.check_status', status, tags=service_check_tags)
+
+            # Collect the service checks and save them in the payload
+            current_check_service_checks = check.get_service_checks()
+            if current_check_service_checks:
+                service_checks.extend(current_check_service_checks)
+            service_check_count = len(current_check_service_checks)
+
+            # Update the check status with the correct service_check_count
+            check_status.service_check_count = service_check_count
+            check_statuses.append(check_status)
+
+            log.debug("Check %s ran in %.2f s" % (check.name, check_run_time))
+
+            # Intrument check run timings if enabled.
+            if self.check_timings:
+                metric = 'datadog.agent.check_run_time'
+                meta = {'tags': ["check:%s" % check.name]}
+                metrics.append((metric, time.time(), check_run_time, meta))
+                if check_lag is not None:
+                    metric = 'datadog.agent.check_scheduling_lag'
+                    metrics.append((metric, time.time(), check_lag, meta))
+
+        return check_statuses
+
+    @staticmethod
+    def _run_check(check, instance_indexes=None, lag=None, start_times=None):
+        """
+        Run a check, or only the given instances of it, and take what it
+        collected. `lag` is how late the instances are on their schedule.
+        Called from the check runners threads when there are some, the
+        time the check starts is then recorded in `start_times`.
+        """
+        log.info("Running check %s" % check.name)
+        instance_statuses = []
+        current_check_metrics = []
+        current_check_events = []
+        current_check_metadata = []
+        check_stats = None
+        check_start_time = time.time()
+        if start_times is not None:
+            start_times[check] = check_start_time
+
+        try:
+            # Run the check.
+            instance_statuses = check.run(instance_indexes)
+
+            # Collect the metrics and events.
+            current_check_metrics = check.get_metrics()
+            current_check_events = check.get_events()
+            check_stats = check._get_internal_profiling_stats()
+
+            # Collect metadata
+            current_check_metadata = check.get_service_metadata()
+        except Exception:
+            log.exception("Error running check %s" % check.name)
+
+        return (instance_statuses, current_check_metrics, current_check_events,
+                current_check_metadata, check_stats, time.time() - check_start_time, lag)
+
+    def _run_checks_d(self, due_only=False):
+        """
+        Run the checks.d instances which are due, yield (check, result of
+        `_run_check`) pairs. Unless `due_only` is set, every check is
+        yielded, even if none of its instances are due.
+        With check runners all the checks are started at once, and the ones
+        which don't finish within `check_timeout` seconds of starting are
+        yielded with a None result. So are the queued ones which can't start
+        because every runner is busy with a check past its timeout. They
+        aren't run again until they're done, their result is then taken in
+        the first collection run after that.
+        """
+        due_instances = self._scheduler.pop_due()
+        checks = []
+        for check in self.initialized_checks_d:
+            if due_only and check not in due_instances:
+                continue
+            instances = due_instances.get(check, [])
+            lag = max(lag for _, lag in instances) if instances else None
+            checks.append((check, [i for i, _ in instances], lag))
+
+        if self._check_runners is None:
+            for check, instance_indexes, lag in checks:
+                yield check, self._run_check(check, instance_indexes, lag)
+            return
+
+        # Forget about the checks which aren't configured anymore, keep
+        # waiting for the ones which aren't run this time
+        pending_check_runs = self._pending_check_runs
+        run_checks = set(check for check, _, _ in checks)
+        self._pending_check_runs = dict(
+            (check, check_run) for check, check_run in pending_check_runs.iteritems()
+            if check in self.initialized_checks_d and check not in run_checks
+        )
+
+        start_times = self._check_start_times
+        check_runs = []
+        for check, instance_indexes, lag in checks:
+            check_run = pending_check_runs.get(check)
+            if check_run is None:
+                start_times.pop(check, None)
+                check_run = self._check_runners.apply_async(self._run_check,
+                                                            args=(check, instance_indexes, lag, start_times))
+            check_runs.append((check, check_run))
+
+        for check, check_run in check_runs:
+            result = None
+            while True:
+                start_time = start_times.get(check)
+                queued = False
+                if not self._check_timeout:
+                    timeout = None
+                elif start_time is not None:
+                    timeout = max(0, start_time + self._check_timeout - time.time())
+                elif self._check_runners_stuck(check_runs):
+                    timeout = 0
+                else:
+                    # Queued behind other checks, its timeout starts when it gets a runner
+                    timeout = CHECK_QUEUED_WAIT
+                    queued = True
+                try:
+                    result = check_run.get(timeout)
+                    break
+                except TimeoutError:
+                    if not queued:
+                        break
+            if result is None:
+                self._pending_check_runs[check] = check_run
+            yield check, result
+
+    def _check_runners_stuck(self, check_runs):
+        """ Whether every check runner is busy with a check which went past its timeout """
+        now = time.time()
+        stuck = 0
+        for check, check_run in check_runs + self._pending_check_runs.items():
+            start_time = self._check_start_times.get(check)
+            if start_time is not None and not check_run.ready() and now - start_time > self._check_timeout:
+                stuck += 1
+        return stuck >= self._check_runner_count
+
     @staticmethod
     def run_single_check(check, verbose=True):
         log.info("Running check %s" % check.name)
@@ -0,0 +1,61 @@
+"""
+Immutable check instance configurations, and the copies of them which
+are handed to `AgentCheck.check`.
+
+A check instance is frozen once, when the check is loaded. At each run
+the check gets a plain copy of it, made of dicts and lists, so it can
+change its instance as it likes without changing the configuration of
+its next runs. Since the frozen instance only holds dicts, lists and
+immutable values, copying it is a simple walk of the structure, much
+cheaper than a `copy.deepcopy` with its memo and reduce protocol.
+"""
+
+
+def _read_only(self, *args, **kwargs):
+    raise TypeError("Check instance configurations are read-only")
+
+
+class FrozenDict(dict):
+    """ A dict which can't be modified """
+    __setitem__ = __delitem__ = _read_only
+    clear = pop = popitem = setdefault = update = _read_only
+
+    def __copy__(self):
+        return self
+
+    def __deepcopy__(self, memo):
+        return self
+
+    def __reduce__(self):
+        return (FrozenDict, (dict(self),))
+
+
+class FrozenList(tuple):
+    """ An immutable list, it doesn't have any of the list methods which change it """
+
+    def __copy__(self):
+        return self
+
+    def __deepcopy__(self, memo):
+        return self
+
+
+def freeze(value):
+    """ Return an immutable copy of `value`, a structure of dicts and lists """
+    if isinstance(value, dict):
+        return FrozenDict((k, freeze(v)) for k, v in value.iteritems())
+    if isinstance(value, list):
+        return FrozenList(freeze(v) for v in value)
+    return value
+
+
+def thaw(value):
+    """
+    Return a plain, modifiable copy of a frozen value: dicts and lists
+    all the way down, so it behaves like the instance it was frozen from.
+    """
+    if isinstance(value, FrozenDict):
+        return dict((k, thaw(v)) for k, v in value.iteritems())
+    if isinstance(value, FrozenList):
+        return [thaw(v) for v in value]
+    return value
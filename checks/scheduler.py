@@ -0,0 +1,79 @@
+# stdlib
+import heapq
+import time
+
+# Instances due this close to a run are run with it
+SCHEDULING_TOLERANCE = 1
+
+
+def next_run_time(due, interval, now):
+    """
+    Next time something due at `due` and run every `interval` seconds
+    should run, skipping the runs missed because we're late already.
+    Keeps runs aligned on their initial schedule instead of drifting by
+    the time each run takes.
+    """
+    if interval <= 0:
+        return now
+    missed = int((now - due) // interval) + 1 if now >= due else 1
+    return due + missed * interval
+
+
+class CheckScheduler(object):
+    """
+    Keeps track of when each instance of each check has to run.
+    An instance runs every `min_collection_interval` seconds, but not more
+    often than every `default_interval` seconds (the collector check
+    frequency). Instances are first due when their check is added.
+    """
+
+    def __init__(self, default_interval):
+        self._default_interval = default_interval
+        self._checks = set()
+        self._heap = []  # (due time, sequence number, check, instance index)
+        self._seq = 0
+
+    def _push(self, due, check, i):
+        self._seq += 1
+        heapq.heappush(self._heap, (due, self._seq, check, i))
+
+    def get_interval(self, check, i):
+        return max(check.get_min_collection_interval(check.instances[i]), self._default_interval)
+
+    def set_checks(self, checks, now=None):
+        """ Schedule the new checks, forget about the ones not in `checks` anymore """
+        if now is None:
+            now = time.time()
+
+        checks = set(checks)
+        for check in checks - self._checks:
+            for i in xrange(len(check.instances)):
+                self._push(now, check, i)
+        self._checks = checks
+
+    def pop_due(self, now=None):
+        """
+        Return {check: [(instance index, lag)]} for the instances due at
+        `now`, with the number of seconds they're late by, and schedule
+        their next run.
+        """
+        if now is None:
+            now = time.time()
+
+        due_instances = {}
+        heap = self._heap
+        while heap and heap[0][0] <= now + SCHEDULING_TOLERANCE:
+            due, _, check, i = heapq.heappop(heap)
+            if check not in self._checks:
+                continue
+            due_instances.setdefault(check, []).append((i, max(0, now - due)))
+            self._push(next_run_time(due, self.get_interval(check, i), now), check, i)
+
+        return due_instances
+
+    def get_next_run_time(self):
+        """ When the next instance is due, None if there isn't any """
+        heap = self._heap
+        while heap and heap[0][2] not in self._checks:
+            heapq.heappop(heap)
+        return heap[0][0] if heap else None
@@ -3,7 +3,9 @@ Unix system checks.
 """
 # stdlib
 import operator
+import os
 import platform
+import pwd
 import re
 import sys
 import time
@@ -12,6 +14,7 @@ import time
 from checks import Check
 from util import get_hostname
 from utils.platform import Platform
+from utils.proc_snapshot import get_proc_snapshot
 from utils.subprocess_output import get_subprocess_output
 
 # 3rd party
@@ -23,6 +26,10 @@ except ImportError:
 # locale-resilient float converter
 to_float = lambda s: float(s.replace(",", "."))
 
+# Seconds between the two readings of the counters on the first run, the
+# next runs compute their rates since the previous run
+FIRST_RUN_INTERVAL = 1
+
 
 class IO(Check):
 
@@ -31,6 +38,113 @@ class IO(Check):
         self.header_re = re.compile(r'([%\\/\-_a-zA-Z0-9]+)[\s+]?')
         self.item_re = re.compile(r'^([a-zA-Z0-9\/]+)')
         self.value_re = re.compile(r'\d+\.\d+')
+        # Counters of /proc/diskstats at the previous run, and when they were read
+        self._last_diskstats = None
+        self._last_diskstats_ts = None
+
+    @staticmethod
+    def _parse_diskstats(lines):
+        """
+        Return {device: counters} from the lines of /proc/diskstats, for the
+        devices which have seen any I/O, like iostat does.
+        The counters are, in this order: reads completed, reads merged,
+        sectors read, ms spent reading, writes completed, writes merged,
+        sectors written, ms spent writing, ms spent doing I/Os, weighted ms
+        spent doing I/Os. The number of I/Os in progress isn't a counter,
+        it's left out.
+        """
+        diskstats = {}
+        for line in lines:
+            cols = line.split()
+            # Partitions only have 4 counters on kernels older than 2.6.25
+            if len(cols) < 14:
+                continue
+            counters = [int(c) for c in cols[3:11]] + [int(cols[12]), int(cols[13])]
+            if any(counters):
+                diskstats[cols[2]] = counters
+        return diskstats
+
+    @staticmethod
+    def _filter_block_devices(diskstats, sysfs_path):
+        """
+        Keep the whole devices of `diskstats` and leave out their partitions,
+        like iostat does: a device is kept when it's in `sysfs_path`/block,
+        where the '/' of its name are replaced by '!'. Nothing's left out
+        when there's no such directory.
+        """
+        block_path = os.path.join(sysfs_path, 'block')
+        if not os.path.isdir(block_path):
+            return diskstats
+        return dict((device, counters) for device, counters in diskstats.iteritems()
+                    if os.path.exists(os.path.join(block_path, device.replace('/', '!'))))
+
+    @staticmethod
+    def _diskstats_rates(last_counters, counters, interval):
+        """
+        Compute the metrics of `iostat -d -x -k` from two readings of the
+        counters of a device, taken `interval` seconds apart.
+        """
+        rd_ios, rd_merges, rd_sectors, rd_ticks, \
+            wr_ios, wr_merges, wr_sectors, wr_ticks, \
+            tot_ticks, rq_ticks = [c - l for c, l in zip(counters, last_counters)]
+        nr_ios = rd_ios + wr_ios
+
+        def ratio(a, b):
+            return float(a) / b if b else 0.0
+
+        stats = {
+            'rrqm/s': rd_merges / interval,
+            'wrqm/s': wr_merges / interval,
+            'r/s': rd_ios / interval,
+            'w/s': wr_ios / interval,
+            # Sectors are always 512 bytes long in /proc/diskstats
+            'rkB/s': rd_sectors / 2.0 / interval,
+            'wkB/s': wr_sectors / 2.0 / interval,
+            'avgrq-sz': ratio(rd_sectors + wr_sectors, nr_ios),
+            'avgqu-sz': rq_ticks / 1000.0 / interval,
+            'await': ratio(rd_ticks + wr_ticks, nr_ios),
+            'r_await': ratio(rd_ticks, rd_ios),
+            'w_await': ratio(wr_ticks, wr_ios),
+            'svctm': ratio(tot_ticks, nr_ios),
+            '%util': min(tot_ticks / 10.0 / interval, 100.0),
+        }
+        # Same format as iostat
+        return dict((name, "%.2f" % value) for name, value in stats.iteritems())
+
+    def _check_linux(self):
+        """
+        Compute the I/O stats of each device from /proc/diskstats, over the
+        time elapsed since the previous run. The first run reads the counters
+        twice, `FIRST_RUN_INTERVAL` seconds apart, like `iostat -d 1 2`.
+        The sysfs mounted next to /proc tells the partitions apart.
+        """
+        proc_snapshot = get_proc_snapshot()
+        sysfs_path = os.path.join(os.path.dirname(proc_snapshot.procfs_path), 'sys')
+        diskstats = self._filter_block_devices(proc_snapshot.get('diskstats', self._parse_diskstats),
+                                               sysfs_path)
+        now = time.time()
+
+        if self._last_diskstats is None:
+            self._last_diskstats, self._last_diskstats_ts = diskstats, now
+            time.sleep(FIRST_RUN_INTERVAL)
+            proc_snapshot.invalidate('diskstats')
+            diskstats = self._filter_block_devices(proc_snapshot.get('diskstats', self._parse_diskstats),
+                                                   sysfs_path)
+            now = time.time()
+
+        last_diskstats, last_ts = self._last_diskstats, self._last_diskstats_ts
+        self._last_diskstats, self._last_diskstats_ts = diskstats, now
+        if last_diskstats is None or now <= last_ts:
+            return {}
+
+        io = {}
+        for device, counters in diskstats.iteritems():
+            last_counters = last_diskstats.get(device)
+            # Skip the new devices, and the ones which counters were reset
+            if last_counters is None or any(c < l for c, l in zip(counters, last_counters)):
+                continue
+            io[device] = self._diskstats_rates(last_counters, counters, now - last_ts)
+        return io
 
     def _parse_linux2(self, output):
         recentStats = output.split('Device:')[2].split('\n')
@@ -113,24 +227,7 @@ class IO(Check):
         io = {}
         try:
             if Platform.is_linux():
-                stdout, _, _ = get_subprocess_output(['iostat', '-d', '1', '2', '-x', '-k'], self.logger)
-
-                #                 Linux 2.6.32-343-ec2 (ip-10-35-95-10)   12/11/2012      _x86_64_        (2 CPU)
-                #
-                # Device:         rrqm/s   wrqm/s     r/s     w/s    rkB/s    wkB/s avgrq-sz avgqu-sz   await  svctm  %util
-                # sda1              0.00    17.61    0.26   32.63     4.23   201.04    12.48     0.16    4.81   0.53   1.73
-                # sdb               0.00     2.68    0.19    3.84     5.79    26.07    15.82     0.02    4.93   0.22   0.09
-                # sdg               0.00     0.13    2.29    3.84   100.53    30.61    42.78     0.05    8.41   0.88   0.54
-                # sdf               0.00     0.13    2.30    3.84   100.54    30.61    42.78     0.06    9.12   0.90   0.55
-                # md0               0.00     0.00    0.05    3.37     1.41    30.01    18.35     0.00    0.00   0.00   0.00
-                #
-                # Device:         rrqm/s   wrqm/s     r/s     w/s    rkB/s    wkB/s avgrq-sz avgqu-sz   await  svctm  %util
-                # sda1              0.00     0.00    0.00   10.89     0.00    43.56     8.00     0.03    2.73   2.73   2.97
-                # sdb               0.00     0.00    0.00    2.97     0.00    11.88     8.00     0.00    0.00   0.00   0.00
-                # sdg               0.00     0.00    0.00    0.00     0.00     0.00     0.00     0.00    0.00   0.00   0.00
-                # sdf               0.00     0.00    0.00    0.00     0.00     0.00     0.00     0.00    0.00   0.00   0.00
-                # md0               0.00     0.00    0.00    0.00     0.00     0.00     0.00     0.00    0.00   0.00   0.00
-                io.update(self._parse_linux2(stdout))
+                io.update(self._check_linux())
 
             elif sys.platform == "sunos5":
                 output, _, _ = get_subprocess_output(["iostat", "-x", "-d", "1", "2"], self.logger)
@@ -281,8 +378,7 @@ class Memory(Check):
     def check(self, agentConfig):
         if Platform.is_linux():
             try:
-                with open('/proc/meminfo', 'r') as mem_info:
-                    lines = mem_info.readlines()
+                lines = get_proc_snapshot().get('meminfo')
             except Exception:
                 self.logger.exception('Cannot get memory metrics from /proc/meminfo')
                 return False
@@ -534,7 +630,153 @@ class Memory(Check):
 
 class Processes(Check):
 
+    def __init__(self, logger):
+        Check.__init__(self, logger)
+        self._user_names = {}  # uid: user name
+        if Platform.is_linux():
+            self._clock_ticks = os.sysconf('SC_CLK_TCK')
+            self._page_size = os.sysconf('SC_PAGE_SIZE')
+
+    def _get_user_name(self, uid):
+        name = self._user_names.get(uid)
+        if name is None:
+            try:
+                name = pwd.getpwuid(uid).pw_name
+            except KeyError:
+                name = str(uid)
+            self._user_names[uid] = name
+        return name
+
+    @staticmethod
+    def _format_tty(tty_nr):
+        major, minor = (tty_nr >> 8) & 0xfff, (tty_nr & 0xff) | ((tty_nr >> 12) & 0xfff00)
+        if 136 <= major <= 143:
+            return 'pts/%d' % (minor + (major - 136) * 256)
+        if major == 4:
+            return 'tty%d' % minor if minor < 64 else 'ttyS%d' % (minor - 64)
+        return '?'
+
+    @staticmethod
+    def _format_start(start, now):
+        # Like ps: the time if it started today, the day if it started this year
+        start_tm, now_tm = time.localtime(start), time.localtime(now)
+        if start_tm[:3] == now_tm[:3]:
+            return time.strftime('%H:%M', start_tm)
+        if start_tm.tm_year == now_tm.tm_year:
+            return time.strftime('%b%d', start_tm)
+        return str(start_tm.tm_year)
+
+    @staticmethod
+    def _parse_uptime(lines):
+        return float(lines[0].split()[0])
+
+    def _read_process(self, procfs_path, pid, exclude_args, boot_time, uptime, mem_total, now):
+        """
+        Return the `ps aux` columns of a process from its /proc/[pid] files:
+        USER PID %CPU %MEM VSZ RSS TTY STAT START TIME COMMAND
+        """
+        proc_path = os.path.join(procfs_path, str(pid))
+        uid = os.stat(proc_path).st_uid
+        with open(proc_path + '/stat', 'r') as f:
+            stat = f.read()
+        with open(proc_path + '/cmdline', 'r') as f:
+            cmdline = f.read()
+
+        # The command name is between parentheses, and can contain spaces and parentheses
+        comm = stat[stat.index('(') + 1:stat.rindex(')')]
+        fields = stat[stat.rindex(')') + 2:].split()
+        state, pgrp, session, tty_nr, tpgid = fields[0], int(fields[2]), int(fields[3]), \
+            int(fields[4]), int(fields[5])
+        cpu_time = (int(fields[11]) + int(fields[12])) / float(self._clock_ticks)
+        nice, num_threads = int(fields[16]), int(fields[17])
+        start_time = int(fields[19]) / float(self._clock_ticks)
+        vsz = int(fields[20]) / 1024
+        rss = int(fields[21]) * self._page_size / 1024
+
+        flags = state
+        if nice < 0:
+            flags += '<'
+        elif nice > 0:
+            flags += 'N'
+        if session == pid:
+            flags += 's'
+        if num_threads > 1:
+            flags += 'l'
+        if tpgid == pgrp:
+            flags += '+'
+
+        elapsed = uptime - start_time
+        args = cmdline.rstrip('\0').split('\0')
+        if not args[0]:
+            command = '[%s]' % comm
+        elif exclude_args:
+            command = args[0]
+        else:
+            command = ' '.join(args)
+
+        return [
+            self._get_user_name(uid),
+            str(pid),
+            '%.1f' % (cpu_time * 100.0 / elapsed if elapsed > 0 else 0),
+            '%.1f' % (rss * 100.0 / mem_total if mem_total else 0),
+            str(vsz),
+            str(rss),
+            self._format_tty(tty_nr),
+            flags,
+            self._format_start(boot_time + start_time, now),
+            '%d:%02d' % divmod(int(cpu_time), 60),
+            command,
+        ]
+
+    def _check_linux(self, agentConfig):
+        """
+        List the processes like `ps auxww` (or `ps aux` if the arguments are
+        excluded), reading /proc instead of forking ps.
+        """
+        proc_snapshot = get_proc_snapshot()
+        uptime = proc_snapshot.get('uptime', self._parse_uptime)
+        boot_time = None
+        for line in proc_snapshot.get('stat'):
+            if line.startswith('btime'):
+                boot_time = int(line.split()[1])
+                break
+        mem_total = None
+        for line in proc_snapshot.get('meminfo'):
+            if line.startswith('MemTotal:'):
+                mem_total = int(line.split()[1])
+                break
+        now = time.time()
+        if boot_time is None:
+            boot_time = now - uptime
+
+        exclude_args = agentConfig.get('exclude_process_args', False)
+        processes = []
+        for pid in sorted(proc_snapshot.get_pids()):
+            try:
+                processes.append(self._read_process(proc_snapshot.procfs_path, pid, exclude_args,
+                                                    boot_time, uptime, mem_total, now))
+            except (IOError, OSError):
+                # The process is gone
+                continue
+        return processes
+
     def check(self, agentConfig):
+        if Platform.is_linux():
+            try:
+                processes = self._check_linux(agentConfig)
+            except StandardError:
+                self.logger.exception('getProcesses')
+                return False
+        else:
+            processes = self._check_ps(agentConfig)
+            if processes is False:
+                return False
+
+        return {'processes':   processes,
+                'apiKey':      agentConfig['api_key'],
+                'host':        get_hostname(agentConfig)}
+
+    def _check_ps(self, agentConfig):
         process_exclude_args = agentConfig.get('exclude_process_args', False)
         if process_exclude_args:
             ps_arg = 'aux'
@@ -556,13 +798,71 @@ class Processes(Check):
             line = line.split(None, 10)
             processes.append(map(lambda s: s.strip(), line))
 
-        return {'processes':   processes,
-                'apiKey':      agentConfig['api_key'],
-                'host':        get_hostname(agentConfig)}
+        return processes
 
 
 class Cpu(Check):
 
+    def __init__(self, logger):
+        Check.__init__(self, logger)
+        # Times of the `cpu` line of /proc/stat at the previous run
+        self._last_cpu_times = None
+
+    @staticmethod
+    def _parse_proc_stat(lines):
+        """
+        Return the aggregated CPU times from the lines of /proc/stat, in
+        jiffies: user, nice, system, idle, iowait, irq, softirq, steal,
+        guest, guest_nice. The ones older kernels don't have are 0.
+        """
+        for line in lines:
+            if line.startswith('cpu '):
+                times = [int(t) for t in line.split()[1:11]]
+                return times + [0] * (10 - len(times))
+        return None
+
+    @staticmethod
+    def _cpu_percents(last_times, times):
+        """
+        Compute the mpstat percentages from two readings of the CPU times,
+        None if no time elapsed between them.
+        """
+        user, nice, system, idle, iowait, irq, softirq, steal, guest, guest_nice = \
+            [t - l for t, l in zip(times, last_times)]
+        # Guest times are already counted in the user and nice times
+        total = float(user + nice + system + idle + iowait + irq + softirq + steal)
+        if total <= 0:
+            return None
+
+        def pct(t):
+            return round(max(t, 0) * 100 / total, 2)
+
+        return {
+            '%usr': pct(user - guest), '%nice': pct(nice - guest_nice),
+            '%sys': pct(system), '%iowait': pct(iowait), '%irq': pct(irq),
+            '%soft': pct(softirq), '%steal': pct(steal), '%guest': pct(guest),
+            '%idle': pct(idle),
+        }
+
+    def _check_linux(self):
+        """
+        Compute the CPU stats from /proc/stat, over the time elapsed since
+        the previous run. The first run reads the CPU times twice,
+        `FIRST_RUN_INTERVAL` seconds apart.
+        """
+        proc_snapshot = get_proc_snapshot()
+        times = proc_snapshot.get('stat', self._parse_proc_stat)
+        if self._last_cpu_times is None and times is not None:
+            self._last_cpu_times = times
+            time.sleep(FIRST_RUN_INTERVAL)
+            proc_snapshot.invalidate('stat')
+            times = proc_snapshot.get('stat', self._parse_proc_stat)
+
+        last_times, self._last_cpu_times = self._last_cpu_times, times
+        if last_times is None or times is None:
+            return None
+        return self._cpu_percents(last_times, times)
+
     def check(self, agentConfig):
         """Return an aggregate of CPU stats across all CPUs
         When figures are not available, False is sent back.
@@ -586,61 +886,14 @@ class Cpu(Check):
                 return 0.0
         try:
             if Platform.is_linux():
-                output, _, _ = get_subprocess_output(['mpstat', '1', '3'], self.logger)
-                mpstat = output.splitlines()
-                # topdog@ip:~$ mpstat 1 3
-                # Linux 2.6.32-341-ec2 (ip)   01/19/2012  _x86_64_  (2 CPU)
-                #
-                # 04:22:41 PM  CPU    %usr   %nice    %sys %iowait    %irq   %soft  %steal  %guest   %idle
-                # 04:22:42 PM  all    0.00    0.00    0.00    0.00    0.00    0.00    0.00    0.00  100.00
-                # 04:22:43 PM  all    0.00    0.00    0.00    0.00    0.00    0.00    0.00    0.00  100.00
-                # 04:22:44 PM  all    0.00    0.00    0.00    0.00    0.00    0.00    0.00    0.00  100.00
-                # Average:     all    0.00    0.00    0.00    0.00    0.00    0.00    0.00    0.00  100.00
-                #
-                # OR
-                #
-                # Thanks to Mart Visser to spotting this one.
-                # blah:/etc/dd-agent# mpstat
-                # Linux 2.6.26-2-xen-amd64 (atira)  02/17/2012  _x86_64_
-                #
-                # 05:27:03 PM  CPU    %user   %nice   %sys %iowait    %irq   %soft  %steal  %idle   intr/s
-                # 05:27:03 PM  all    3.59    0.00    0.68    0.69    0.00   0.00    0.01   95.03    43.65
-                #
-                legend = [l for l in mpstat if "%usr" in l or "%user" in l]
-                avg = [l for l in mpstat if "Average" in l]
-                if len(legend) == 1 and len(avg) == 1:
-                    headers = [h for h in legend[0].split() if h not in ("AM", "PM")]
-                    data = avg[0].split()
-
-                    # Userland
-                    # Debian lenny says %user so we look for both
-                    # One of them will be 0
-                    cpu_metrics = {
-                        "%usr": None, "%user": None, "%nice": None,
-                        "%iowait": None, "%idle": None, "%sys": None,
-                        "%irq": None, "%soft": None, "%steal": None,
-                        "%guest": None
-                    }
-
-                    for cpu_m in cpu_metrics:
-                        cpu_metrics[cpu_m] = get_value(headers, data, cpu_m, filter_value=110)
-
-                    if any([v is None for v in cpu_metrics.values()]):
-                        self.logger.warning("Invalid mpstat data: %s" % data)
-
-                    cpu_user = cpu_metrics["%usr"] + cpu_metrics["%user"] + cpu_metrics["%nice"]
-                    cpu_system = cpu_metrics["%sys"] + cpu_metrics["%irq"] + cpu_metrics["%soft"]
-                    cpu_wait = cpu_metrics["%iowait"]
-                    cpu_idle = cpu_metrics["%idle"]
-                    cpu_stolen = cpu_metrics["%steal"]
-                    cpu_guest = cpu_metrics["%guest"]
-
-                    return format_results(cpu_user,
-                                          cpu_system,
-                                          cpu_wait,
-                                          cpu_idle,
-                                          cpu_stolen,
-                                          cpu_guest)
+                cpu_metrics = self._check_linux()
+                if cpu_metrics:
+                    return format_results(cpu_metrics['%usr'] + cpu_metrics['%nice'],
+                                          cpu_metrics['%sys'] + cpu_metrics['%irq'] + cpu_metrics['%soft'],
+                                          cpu_metrics['%iowait'],
+                                          cpu_metrics['%idle'],
+                                          cpu_metrics['%steal'],
+                                          cpu_metrics['%guest'])
                 else:
                     return False
 
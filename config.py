@@ -37,6 +37,7 @@ DATADOG_CONF = "datadog.conf"
 UNIX_CONFIG_PATH = '/etc/dd-agent'
 MAC_CONFIG_PATH = '/opt/datadog-agent/etc'
 DEFAULT_CHECK_FREQUENCY = 15   # seconds
+DEFAULT_CHECK_TIMEOUT = 10   # seconds
 LOGGING_MAX_BYTES = 5 * 1024 * 1024
 
 log = logging.getLogger(__name__)
@@ -312,6 +313,18 @@ def get_histogram_percentiles(configstr=None):
 
     return result
 
+def get_histogram_backend(configstr=None):
+    if configstr is None:
+        return None
+
+    valid_values = ['exact', 'sketch']
+    backend = configstr.strip().lower()
+    if backend not in valid_values:
+        log.warning("Ignored histogram backend {0}, must be one of {1}".format(configstr, valid_values))
+        return None
+
+    return backend
+
 def get_config(parse_args=True, cfg_path=None, options=None):
     if parse_args:
         options, _ = get_parsed_args()
@@ -418,6 +431,16 @@ def get_config(parse_args=True, cfg_path=None, options=None):
             except Exception:
                 pass
 
+        # Number of threads running the checks.d checks in parallel
+        agentConfig['check_runners'] = 1
+        if config.has_option('Main', 'check_runners'):
+            agentConfig['check_runners'] = max(1, int(config.get('Main', 'check_runners')))
+
+        # How long a collection run waits for each check when they run in parallel
+        agentConfig['check_timeout'] = DEFAULT_CHECK_TIMEOUT
+        if config.has_option('Main', 'check_timeout'):
+            agentConfig['check_timeout'] = float(config.get('Main', 'check_timeout'))
+
         # Custom histogram aggregate/percentile metrics
         if config.has_option('Main', 'histogram_aggregates'):
             agentConfig['histogram_aggregates'] = get_histogram_aggregates(config.get('Main', 'histogram_aggregates'))
@@ -425,6 +448,9 @@ def get_config(parse_args=True, cfg_path=None, options=None):
         if config.has_option('Main', 'histogram_percentiles'):
             agentConfig['histogram_percentiles'] = get_histogram_percentiles(config.get('Main', 'histogram_percentiles'))
 
+        if config.has_option('Main', 'histogram_backend'):
+            agentConfig['histogram_backend'] = get_histogram_backend(config.get('Main', 'histogram_backend'))
+
         # Disable Watchdog (optionally)
         if config.has_option('Main', 'watchdog'):
             if config.get('Main', 'watchdog').lower() in ('no', 'false'):
@@ -458,6 +484,25 @@ def get_config(parse_args=True, cfg_path=None, options=None):
             if config.has_option('Main', 'statsd_forward_port'):
                 agentConfig['statsd_forward_port'] = int(config.get('Main', 'statsd_forward_port'))
 
+        # Number of dogstatsd listener processes
+        agentConfig['dogstatsd_workers'] = 1
+        if config.has_option('Main', 'dogstatsd_workers'):
+            agentConfig['dogstatsd_workers'] = max(1, int(config.get('Main', 'dogstatsd_workers')))
+
+        # Size of the dogstatsd UDP receive buffer, the OS default if unset
+        if config.has_option('Main', 'dogstatsd_so_rcvbuf'):
+            agentConfig['dogstatsd_so_rcvbuf'] = int(config.get('Main', 'dogstatsd_so_rcvbuf'))
+
+        # Unix socket dogstatsd also listens to, and its permissions
+        if config.has_option('Main', 'dogstatsd_socket'):
+            agentConfig['dogstatsd_socket'] = config.get('Main', 'dogstatsd_socket')
+        if config.has_option('Main', 'dogstatsd_socket_mode'):
+            agentConfig['dogstatsd_socket_mode'] = int(config.get('Main', 'dogstatsd_socket_mode'), 8)
+
+        # Max size of the compressed series payloads posted by dogstatsd
+        if config.has_option('Main', 'dogstatsd_max_payload_size'):
+            agentConfig['dogstatsd_max_payload_size'] = int(config.get('Main', 'dogstatsd_max_payload_size'))
+
         # optionally send dogstatsd data directly to the agent.
         if config.has_option('Main', 'dogstatsd_use_ddurl'):
             if _is_affirmative(config.get('Main', 'dogstatsd_use_ddurl')):
@@ -514,6 +559,24 @@ def get_config(parse_args=True, cfg_path=None, options=None):
             for key, value in config.items('WMI'):
                 agentConfig['WMI'][key] = value
 
+        # Maximum number of transactions the forwarder sends in parallel
+        agentConfig["forwarder_max_in_flight"] = 1
+        if config.has_option("Main", "forwarder_max_in_flight"):
+            agentConfig["forwarder_max_in_flight"] = max(1, int(config.get("Main", "forwarder_max_in_flight")))
+
+        # Maximum size of the series payloads the forwarder sends together, 0 to send them one by one
+        agentConfig["forwarder_coalesce_max_size"] = 0
+        if config.has_option("Main", "forwarder_coalesce_max_size"):
+            agentConfig["forwarder_coalesce_max_size"] = int(config.get("Main", "forwarder_coalesce_max_size"))
+
+        # Directory where the forwarder writes the transactions that don't fit
+        # in memory, they're dropped if unset
+        if config.has_option("Main", "forwarder_spill_dir"):
+            agentConfig["forwarder_spill_dir"] = config.get("Main", "forwarder_spill_dir")
+        agentConfig["forwarder_spill_max_size"] = 256 * 1024 * 1024
+        if config.has_option("Main", "forwarder_spill_max_size"):
+            agentConfig["forwarder_spill_max_size"] = int(config.get("Main", "forwarder_spill_max_size")) * 1024 * 1024
+
         if (config.has_option("Main", "limit_memory_consumption") and
                 config.get("Main", "limit_memory_consumption") is not None):
             agentConfig["limit_memory_consumption"] = int(config.get("Main", "limit_memory_consumption"))
@@ -523,6 +586,15 @@ def get_config(parse_args=True, cfg_path=None, options=None):
         if config.has_option("Main", "skip_ssl_validation"):
             agentConfig["skip_ssl_validation"] = _is_affirmative(config.get("Main", "skip_ssl_validation"))
 
+        # Connections kept open to post to Datadog
+        agentConfig["http_pool_size"] = 4
+        if config.has_option("Main", "http_pool_size"):
+            agentConfig["http_pool_size"] = max(1, int(config.get("Main", "http_pool_size")))
+
+        agentConfig["http_keep_alive"] = True
+        if config.has_option("Main", "http_keep_alive"):
+            agentConfig["http_keep_alive"] = _is_affirmative(config.get("Main", "http_keep_alive"))
+
         agentConfig["collect_instance_metadata"] = True
         if config.has_option("Main", "collect_instance_metadata"):
             agentConfig["collect_instance_metadata"] = _is_affirmative(config.get("Main", "collect_instance_metadata"))
@@ -878,6 +950,8 @@ def load_check_directory(agentConfig, hostname):
                 c = check_class(check_name, init_config=init_config,
                                 agentConfig=agentConfig)
                 c.instances = instances
+            # Freeze the instances now rather than at each run
+            c.freeze_instances()
         except Exception, e:
             log.exception('Unable to initialize check %s' % check_name)
             traceback_message = traceback.format_exc()
@@ -14,6 +14,7 @@ from config import initialize_logging  # noqa
 initialize_logging('forwarder')
 
 # stdlib
+from bisect import bisect_left
 from datetime import timedelta
 import logging
 import os
@@ -21,6 +22,7 @@ from Queue import Full, Queue
 from socket import error as socket_error, gaierror
 import sys
 import threading
+import time
 import zlib
 
 # For pickle & PID files, see issue 293
@@ -36,6 +38,7 @@ from tornado.escape import json_decode
 import tornado.httpclient
 import tornado.httpserver
 import tornado.ioloop
+import tornado.simple_httpclient
 from tornado.options import define, options, parse_command_line
 import tornado.web
 
@@ -57,6 +60,7 @@ from util import (
     Watchdog,
 )
 from utils.logger import RedactedLogRecord
+from utils.spill_queue import SpillQueue
 
 
 logging.LogRecord = RedactedLogRecord
@@ -71,6 +75,8 @@ HEADERS_TO_REMOVE = [
     'Host',
     'Content-Length',
 ]
+# Headers which don't describe a payload anymore once it's merged with others
+COALESCE_DROPPED_HEADERS = set(HEADERS_TO_REMOVE + ['Content-Encoding'])
 
 
 # Maximum delay before replaying a transaction
@@ -81,6 +87,9 @@ MAX_QUEUE_SIZE = 30 * 1024 * 1024  # 30MB
 
 THROTTLING_DELAY = timedelta(microseconds=1000000/2)  # 2 msg/second
 
+# Upper bounds of the buckets of the request latency histograms, in ms
+LATENCY_BUCKETS = [50, 100, 250, 500, 1000, 2500, 5000, 10000, 20000]
+
 
 class EmitterThread(threading.Thread):
 
@@ -144,10 +153,105 @@ class EmitterManager(object):
             emitterThread.enqueue(data, headers)
 
 
+class EndpointClient(object):
+    """
+    The HTTP client posting the transactions to an endpoint.
+    It's configured once for all, the transactions only hand it the url,
+    body and headers of their request. It keeps the stats of the requests.
+    """
+
+    def __init__(self, endpoint, agentConfig, skip_ssl_validation=False,
+                 use_simple_http_client=False, io_loop=None):
+        self.endpoint = endpoint
+        defaults = {
+            'validate_cert': not skip_ssl_validation,
+        }
+
+        # Getting proxy settings
+        proxy_settings = agentConfig.get('proxy_settings', None)
+        force_use_curl = False
+        if proxy_settings is not None:
+            force_use_curl = True
+            if pycurl is not None:
+                log.debug("Configuring tornado to use proxy settings: %s:****@%s:%s" % (proxy_settings['user'],
+                          proxy_settings['host'], proxy_settings['port']))
+                defaults['proxy_host'] = proxy_settings['host']
+                defaults['proxy_port'] = proxy_settings['port']
+                defaults['proxy_username'] = proxy_settings['user']
+                defaults['proxy_password'] = proxy_settings['password']
+
+                if agentConfig.get('proxy_forbid_method_switch'):
+                    # See http://stackoverflow.com/questions/8156073/curl-violate-rfc-2616-10-3-2-and-switch-from-post-to-get
+                    defaults['prepare_curl_callback'] = lambda curl: curl.setopt(pycurl.POSTREDIR, pycurl.REDIR_POST_ALL)
+
+        if (not use_simple_http_client or force_use_curl) and pycurl is not None:
+            defaults['ca_certs'] = agentConfig.get('ssl_certificate', None)
+
+        use_curl = force_use_curl or agentConfig.get("use_curl_http_client") and not use_simple_http_client
+        client_class = tornado.simple_httpclient.SimpleAsyncHTTPClient
+        if use_curl:
+            if pycurl is None:
+                log.error("dd-agent is configured to use the Curl HTTP Client, but pycurl is not available on this system.")
+            else:
+                log.debug("Using CurlAsyncHTTPClient for %s", endpoint)
+                from tornado.curl_httpclient import CurlAsyncHTTPClient
+                client_class = CurlAsyncHTTPClient
+        if client_class is tornado.simple_httpclient.SimpleAsyncHTTPClient:
+            log.debug("Using SimpleHTTPClient for %s", endpoint)
+
+        # The manager never has more transactions in flight than that. The
+        # curl client keeps the connection of each of its handles open for
+        # the next requests, the simple client opens one per request.
+        self._client = client_class(io_loop=io_loop, force_instance=True,
+                                    max_clients=agentConfig.get('forwarder_max_in_flight', 1),
+                                    defaults=defaults)
+
+        self.request_count = 0
+        self.error_count = 0
+        self.in_flight = 0
+        self.total_latency = 0.0
+        self.latency_histogram = [0] * (len(LATENCY_BUCKETS) + 1)
+
+    def fetch(self, url, body, headers, callback):
+        req = tornado.httpclient.HTTPRequest(url, method='POST', body=body, headers=headers)
+        start_time = time.time()
+        self.in_flight += 1
+
+        def on_response(response):
+            self._record(response, (time.time() - start_time) * 1000.0)
+            callback(response)
+
+        self._client.fetch(req, callback=on_response)
+
+    def _record(self, response, latency):
+        self.in_flight -= 1
+        self.request_count += 1
+        if response.error:
+            self.error_count += 1
+        self.total_latency += latency
+        self.latency_histogram[bisect_left(LATENCY_BUCKETS, latency)] += 1
+
+    def get_stats(self):
+        avg_latency = None
+        if self.request_count:
+            avg_latency = round(self.total_latency / self.request_count, 2)
+        return {
+            'request_count': self.request_count,
+            'error_count': self.error_count,
+            'in_flight': self.in_flight,
+            'avg_latency_ms': avg_latency,
+            'latency_histogram': zip(LATENCY_BUCKETS + [None], self.latency_histogram),
+        }
+
+    def close(self):
+        self._client.close()
+
+
 class AgentTransaction(Transaction):
     _application = None
     _trManager = None
     _endpoints = []
+    _clients = {}
     _emitter_manager = None
     _type = None
 
@@ -174,6 +278,22 @@ class AgentTransaction(Transaction):
             return
 
         cls._endpoints.append(DD_ENDPOINT)
+        cls.set_clients()
+
+    @classmethod
+    def set_clients(cls):
+        """ Build the HTTP client of each endpoint, shared by all the transactions """
+        app = cls._application
+        cls._clients = dict(
+            (endpoint, EndpointClient(endpoint, app._agentConfig,
+                                      skip_ssl_validation=app.skip_ssl_validation,
+                                      use_simple_http_client=app.use_simple_http_client))
+            for endpoint in cls._endpoints
+        )
+
+    @classmethod
+    def get_endpoint_stats(cls):
+        return dict((endpoint, client.get_stats()) for endpoint, client in cls._clients.iteritems())
 
     def __init__(self, data, headers, msg_type=""):
         self._data = data
@@ -196,6 +316,13 @@ class AgentTransaction(Transaction):
     def __sizeof__(self):
         return sys.getsizeof(self._data)
 
+    def __getstate__(self):
+        # Transactions are pickled when spilled to disk, tornado's HTTPHeaders
+        # don't unpickle so keep them as a plain dict
+        state = self.__dict__.copy()
+        state['_headers'] = dict(self._headers)
+        return state
+
     def get_url(self, endpoint):
         endpoint_base_url = get_url_endpoint(self._application._agentConfig[endpoint])
         api_key = self._application._agentConfig.get('api_key')
@@ -211,62 +338,25 @@ class AgentTransaction(Transaction):
                 self._type, endpoint, url
             )
 
-            # Getting proxy settings
-            proxy_settings = self._application._agentConfig.get('proxy_settings', None)
-
-            tornado_client_params = {
-                'url': url,
-                'method': 'POST',
-                'body': self._data,
-                'headers': self._headers,
-                'validate_cert': not self._application.skip_ssl_validation,
-            }
-
             # Remove headers that were passed by the emitter. Those don't apply anymore
             # This is pretty hacky though as it should be done in pycurl or curl or tornado
+            headers = self._headers
             for h in HEADERS_TO_REMOVE:
-                if h in tornado_client_params['headers']:
-                    del tornado_client_params['headers'][h]
+                if h in headers:
+                    del headers[h]
                     log.debug("Removing {0} header.".format(h))
 
-            force_use_curl = False
-
-            if proxy_settings is not None:
-                force_use_curl = True
-                if pycurl is not None:
-                    log.debug("Configuring tornado to use proxy settings: %s:****@%s:%s" % (proxy_settings['user'],
-                              proxy_settings['host'], proxy_settings['port']))
-                    tornado_client_params['proxy_host'] = proxy_settings['host']
-                    tornado_client_params['proxy_port'] = proxy_settings['port']
-                    tornado_client_params['proxy_username'] = proxy_settings['user']
-                    tornado_client_params['proxy_password'] = proxy_settings['password']
-
-                    if self._application._agentConfig.get('proxy_forbid_method_switch'):
-                        # See http://stackoverflow.com/questions/8156073/curl-violate-rfc-2616-10-3-2-and-switch-from-post-to-get
-                        tornado_client_params['prepare_curl_callback'] = lambda curl: curl.setopt(pycurl.POSTREDIR, pycurl.REDIR_POST_ALL)
-
-            if (not self._application.use_simple_http_client or force_use_curl) and pycurl is not None:
-                ssl_certificate = self._application._agentConfig.get('ssl_certificate', None)
-                tornado_client_params['ca_certs'] = ssl_certificate
-
-            req = tornado.httpclient.HTTPRequest(**tornado_client_params)
-            use_curl = force_use_curl or self._application._agentConfig.get("use_curl_http_client") and not self._application.use_simple_http_client
-
-            if use_curl:
-                if pycurl is None:
-                    log.error("dd-agent is configured to use the Curl HTTP Client, but pycurl is not available on this system.")
-                else:
-                    log.debug("Using CurlAsyncHTTPClient")
-                    tornado.httpclient.AsyncHTTPClient.configure("tornado.curl_httpclient.CurlAsyncHTTPClient")
-            else:
-                log.debug("Using SimpleHTTPClient")
-            http = tornado.httpclient.AsyncHTTPClient()
-            http.fetch(req, callback=self.on_response)
+            self._clients[endpoint].fetch(url, self._data, headers, callback=self.on_response)
 
     def on_response(self, response):
-        if response.error:
+        if response.error and len(self.get_parts()) > 1 and response.code in (400, 413):
+            # The payload made of several transactions may be too big, or only one of them bad
+            log.warning("Response: %s" % response)
+            self._trManager.tr_split(self)
+        elif response.error:
             log.error("Response: %s" % response)
-            self._trManager.tr_error(self)
+            # Server errors and timeouts (599) mean the intake needs some slack
+            self._trManager.tr_error(self, throttle=response.code >= 500)
         else:
             self._trManager.tr_success(self)
 
@@ -289,6 +379,35 @@ class APIMetricTransaction(MetricTransaction):
     def get_data(self):
         return self._data
 
+    def _get_kept_headers(self):
+        """ The headers which still apply once the payload is merged with others """
+        return dict((h, v) for h, v in self._headers.iteritems() if h not in COALESCE_DROPPED_HEADERS)
+
+    def get_coalesce_key(self):
+        if not self._coalescable:
+            return None
+        # Only payloads sent with the same headers are merged
+        return ('series', tuple(sorted(self._get_kept_headers().iteritems())))
+
+    def coalesce(self, trs):
+        series = []
+        for tr in trs:
+            data = tr._data
+            if tr._headers.get('Content-Encoding') == 'deflate':
+                data = zlib.decompress(data)
+            series.extend(json.loads(data)['series'])
+
+        # Not queued, only its parts are
+        coalesced = self.__class__.__new__(self.__class__)
+        Transaction.__init__(coalesced)
+        coalesced._data = zlib.compress(json.dumps({'series': series}))
+        coalesced._headers = self._get_kept_headers()
+        coalesced._headers['Content-Encoding'] = 'deflate'
+        coalesced._headers['DD-Forwarder-Version'] = get_version()
+        coalesced._msg_type = self._msg_type
+        coalesced._parts = trs
+        return coalesced
+
 
 class APIServiceCheckTransaction(AgentTransaction):
     _type = "service checks"
@@ -308,6 +427,11 @@ class StatusHandler(tornado.web.RequestHandler):
 
         m = MetricTransaction.get_tr_manager()
 
+        self.write("<p>In flight: %s/%s, flush rate: %.2f transactions/s</p>" %
+            (m.get_in_flight(), m.get_window_size(), m.get_flush_rate()))
+        for endpoint, stats in sorted(AgentTransaction.get_endpoint_stats().iteritems()):
+            self.write("<p>%s: %s requests, %s errors, %sms avg latency</p>" %
+                (endpoint, stats['request_count'], stats['error_count'], stats['avg_latency_ms']))
         self.write("<table><tr><td>Id</td><td>Size</td><td>Error count</td><td>Next flush</td></tr>")
         transactions = m.get_transactions()
         for tr in transactions:
@@ -389,15 +513,23 @@ class Application(tornado.web.Application):
         self._port = int(port)
         self._agentConfig = agentConfig
         self._metrics = {}
+        self.skip_ssl_validation = skip_ssl_validation or agentConfig.get('skip_ssl_validation', False)
+        self.use_simple_http_client = use_simple_http_client
         AgentTransaction.set_application(self)
         AgentTransaction.set_endpoints()
+        spill_queue = None
+        if agentConfig.get('forwarder_spill_dir'):
+            spill_queue = SpillQueue(agentConfig['forwarder_spill_dir'],
+                                     agentConfig['forwarder_spill_max_size'])
         self._tr_manager = TransactionManager(MAX_WAIT_FOR_REPLAY,
-                                              MAX_QUEUE_SIZE, THROTTLING_DELAY)
+                                              MAX_QUEUE_SIZE, THROTTLING_DELAY,
+                                              spill_queue=spill_queue,
+                                              max_in_flight=agentConfig.get('forwarder_max_in_flight', 1),
+                                              max_coalesced_size=agentConfig.get('forwarder_coalesce_max_size', 0),
+                                              get_endpoint_stats=AgentTransaction.get_endpoint_stats)
         AgentTransaction.set_tr_manager(self._tr_manager)
 
         self._watchdog = None
-        self.skip_ssl_validation = skip_ssl_validation or agentConfig.get('skip_ssl_validation', False)
-        self.use_simple_http_client = use_simple_http_client
         if self.skip_ssl_validation:
             log.info("Skipping SSL hostname validation, useful when using a transparent proxy")
 
@@ -526,6 +658,8 @@ class Application(tornado.web.Application):
         tr_sched.start()
 
         self.mloop.start()
+        # Keep the queued transactions for the next run
+        self._tr_manager.spill_all()
         log.info("Stopped")
 
     def stop(self):
@@ -12,12 +12,15 @@ from utils.proxy import set_no_proxy_settings  # noqa
 set_no_proxy_settings()
 
 # stdlib
+import errno
 import logging
+import multiprocessing
 import optparse
 import os
 import select
 import signal
 import socket
+import stat
 import sys
 import threading
 from time import sleep, time
@@ -28,7 +31,6 @@ import zlib
 os.umask(022)
 
 # 3rd party
-import requests
 import simplejson as json
 
 # project
@@ -38,7 +40,9 @@ from checks.metric_types import MetricTypes
 from config import get_config, get_version
 from daemon import AgentSupervisor, Daemon
 from util import chunks, get_hostname, get_uuid, plural
+from utils.http import get_http_session, HTTPSession
 from utils.pidfile import PidFile
+from utils.platform import Platform
 
 # urllib3 logs a bunch of stuff at the info level
 requests_log = logging.getLogger("requests.packages.urllib3")
@@ -57,6 +61,26 @@ DOGSTATSD_AGGREGATOR_BUCKET_SIZE = 10
 
 WATCHDOG_TIMEOUT = 120
 UDP_SOCKET_TIMEOUT = 5
+# How long the reporter waits for each worker to hand over its aggregator shard
+SHARD_COLLECT_TIMEOUT = 2
+# Not exposed by the socket module of python 2, value used by Linux >= 3.9.
+# Workers are only run on Linux, the value differs on the other platforms.
+SO_REUSEPORT = getattr(socket, 'SO_REUSEPORT', 15)
+# Max number of datagrams read in a row before going back to select
+RECV_BATCH_SIZE = 1024
+PROC_NET_UDP = '/proc/net/udp'
+# Permissions of the dogstatsd Unix socket: only the agent's user and group
+# can send metrics to it, unless dogstatsd_socket_mode says otherwise
+DEFAULT_SOCKET_MODE = 0660
+# Max size of the datagrams forwarded to another statsd server: the
+# Ethernet MTU minus the IP and UDP headers
+FORWARD_PACKET_SIZE = 1472
+# Max number of bytes of packets waiting to be forwarded, the next ones are dropped
+FORWARD_QUEUE_SIZE = 8 * 1024 * 1024
+# Min delay between two warnings about dropped forwarded packets, in seconds
+FORWARD_DROP_LOG_INTERVAL = 60
+# How long the server waits for the forwarder to send what's left when stopping, in seconds
+FORWARD_STOP_TIMEOUT = 5
 # Since we call flush more often than the metrics aggregation interval, we should
 #  log a bunch of flushes in a row every so often.
 FLUSH_LOGGING_PERIOD = 70
@@ -64,6 +88,8 @@ FLUSH_LOGGING_INITIAL = 10
 FLUSH_LOGGING_COUNT = 5
 EVENT_CHUNK_SIZE = 50
 COMPRESS_THRESHOLD = 1024
+# Max size of a series payload, once compressed
+MAX_PAYLOAD_SIZE = 2 * 1024 * 1024
 
 
 def add_serialization_status_metric(status, hostname):
@@ -99,33 +125,166 @@ def unicode_metrics(metrics):
     return metrics
 
 
-def serialize_metrics(metrics, hostname):
+def _deflate_bound(size):
+    """ Upper bound of the size of `size` bytes once deflated, flushed and closed """
+    return size + (size >> 12) + 64
+
+
+class SeriesPayload(object):
+    """
+    A series payload being built: the series are compressed as they're
+    added, once the payload is bigger than COMPRESS_THRESHOLD.
+    """
+    HEAD = '{"series": ['
+    SEPARATOR = ', '
+    TAIL = ']}'
+
+    def __init__(self, max_size=None):
+        self.max_size = max_size
+        self.count = 0
+        # Uncompressed payload, until it's big enough to be compressed
+        self._raw = [self.HEAD]
+        self._raw_size = len(self.HEAD)
+        self._compressor = None
+        self._compressed = []
+        self._compressed_size = 0
+        # Bytes passed to the compressor which may not be in `_compressed` yet
+        self._pending_size = 0
+
+    def _compress(self, data):
+        compressed = self._compressor.compress(data)
+        if compressed:
+            self._compressed.append(compressed)
+            self._compressed_size += len(compressed)
+        self._pending_size += len(data)
+
+    def _sync(self):
+        compressed = self._compressor.flush(zlib.Z_SYNC_FLUSH)
+        self._compressed.append(compressed)
+        self._compressed_size += len(compressed)
+        self._pending_size = 0
+
+    def has_room_for(self, serialized):
+        """ Whether the `serialized` series can be added without going over `max_size` """
+        if self.max_size is None or self.count == 0:
+            return True
+
+        added_size = len(self.SEPARATOR) + len(serialized) + len(self.TAIL)
+        if self._compressor is None:
+            return _deflate_bound(self._raw_size + added_size) <= self.max_size
+
+        if self._compressed_size + _deflate_bound(self._pending_size + added_size) <= self.max_size:
+            return True
+        # Flush what the compressor holds to know how much room is left
+        if self._pending_size:
+            self._sync()
+        return self._compressed_size + _deflate_bound(added_size) <= self.max_size
+
+    def add(self, serialized):
+        data = serialized if self.count == 0 else self.SEPARATOR + serialized
+        self.count += 1
+        if self._compressor is not None:
+            self._compress(data)
+            return
+
+        self._raw.append(data)
+        self._raw_size += len(data)
+        if self._raw_size > COMPRESS_THRESHOLD:
+            self._compressor = zlib.compressobj()
+            self._compress(''.join(self._raw))
+            self._raw = None
+
+    def close(self):
+        """ Return the payload and its headers """
+        if self._compressor is None:
+            return ''.join(self._raw) + self.TAIL, {'Content-Type': 'application/json'}
+
+        self._compress(self.TAIL)
+        self._compressed.append(self._compressor.flush())
+        headers = {'Content-Type': 'application/json',
+                   'Content-Encoding': 'deflate'}
+        return ''.join(self._compressed), headers
+
+
+def serialize_series(metric, statuses):
+    """
+    JSON of a series, None if it can't be serialized.
+    Bad characters are replaced if needed, `statuses` tells if it happened.
+    """
     try:
-        metrics.append(add_serialization_status_metric("success", hostname))
-        serialized = json.dumps({"series": metrics})
+        return json.dumps(metric)
     except UnicodeDecodeError as e:
-        log.exception("Unable to serialize payload. Trying to replace bad characters. %s", e)
-        metrics.append(add_serialization_status_metric("failure", hostname))
+        log.exception("Unable to serialize series. Trying to replace bad characters. %s", e)
+        statuses.add("failure")
         try:
-            log.error(metrics)
-            serialized = json.dumps({"series": unicode_metrics(metrics)})
+            log.error(metric)
+            return json.dumps(unicode_metrics([metric])[0])
         except Exception as e:
-            log.exception("Unable to serialize payload. Giving up. %s", e)
-            serialized = json.dumps({"series": [add_serialization_status_metric("permanent_failure", hostname)]})
+            log.exception("Unable to serialize series. Giving up. %s", e)
+            statuses.add("permanent_failure")
+            return None
 
-    if len(serialized) > COMPRESS_THRESHOLD:
-        headers = {'Content-Type': 'application/json',
-                   'Content-Encoding': 'deflate'}
-        serialized = zlib.compress(serialized)
-    else:
-        headers = {'Content-Type': 'application/json'}
-    return serialized, headers
+
+def serialize_metrics_payloads(metrics, hostname, max_payload_size=MAX_PAYLOAD_SIZE):
+    """
+    Serialize the metrics to series payloads of at most `max_payload_size`
+    bytes. They're yielded as (payload, headers) as soon as each of them is
+    complete, so the serialized metrics are never held in memory all at once.
+    """
+    statuses = set(["success"])
+    payload = SeriesPayload(max_payload_size)
+    for metric in metrics:
+        serialized = serialize_series(metric, statuses)
+        if serialized is None:
+            continue
+        if not payload.has_room_for(serialized):
+            yield payload.close()
+            payload = SeriesPayload(max_payload_size)
+        payload.add(serialized)
+
+    # The status of the serialization of the whole flush closes it
+    for status in ("success", "failure", "permanent_failure"):
+        if status not in statuses:
+            continue
+        serialized = json.dumps(add_serialization_status_metric(status, hostname))
+        if not payload.has_room_for(serialized):
+            yield payload.close()
+            payload = SeriesPayload(max_payload_size)
+        payload.add(serialized)
+    yield payload.close()
+
+
+def serialize_metrics(metrics, hostname):
+    """ Serialize the metrics to a single series payload """
+    return next(serialize_metrics_payloads(metrics, hostname, max_payload_size=None))
 
 
 def serialize_event(event):
     return json.dumps(event)
 
 
+def get_udp_drop_count(port, proc_net_udp=PROC_NET_UDP):
+    """
+    Number of datagrams dropped by the kernel on the UDP sockets bound to
+    `port`, as reported in the last column of /proc/net/udp.
+    Returns None where this file isn't available.
+    """
+    try:
+        with open(proc_net_udp) as f:
+            lines = f.readlines()
+    except IOError:
+        return None
+
+    hex_port = ':%04X' % int(port)
+    drops = 0
+    for line in lines[1:]:
+        fields = line.split()
+        # local_address is the 2nd field, e.g. 0100007F:1FBD
+        if len(fields) > 12 and fields[1].endswith(hex_port):
+            drops += int(fields[-1])
+    return drops
+
+
 class Reporter(threading.Thread):
     """
     The reporter periodically sends the aggregated metrics to the
@@ -133,11 +292,18 @@ class Reporter(threading.Thread):
     """
 
     def __init__(self, interval, metrics_aggregator, api_host, api_key=None,
-                 use_watchdog=False, event_chunk_size=None):
+                 use_watchdog=False, event_chunk_size=None, shard_conns=None,
+                 udp_port=None, max_payload_size=None, http_session=None, forwarding=False):
         threading.Thread.__init__(self)
         self.interval = int(interval)
         self.finished = threading.Event()
         self.metrics_aggregator = metrics_aggregator
+        # Pipes to the dogstatsd workers, when running with several of them
+        self.shard_conns = shard_conns or []
+        # Port dogstatsd listens to, used to report the kernel drops
+        self.udp_port = udp_port
+        # Whether the packets are forwarded to another statsd server
+        self.forwarding = forwarding
         self.flush_count = 0
         self.log_count = 0
         self.hostname = get_hostname()
@@ -150,6 +316,9 @@ class Reporter(threading.Thread):
         self.api_key = api_key
         self.api_host = api_host
         self.event_chunk_size = event_chunk_size or EVENT_CHUNK_SIZE
+        self.max_payload_size = max_payload_size or MAX_PAYLOAD_SIZE
+        # Connections to the api host are kept open between the flushes
+        self.http_session = http_session or HTTPSession()
 
     def stop(self):
         log.info("Stopping reporter")
@@ -165,6 +334,7 @@ class Reporter(threading.Thread):
 
         while not self.finished.isSet():  # Use camel case isSet for 2.4 support.
             self.finished.wait(self.interval)
+            self.merge_shards()
             self.metrics_aggregator.send_packet_count('datadog.dogstatsd.packet.count')
             self.flush()
             if self.watchdog:
@@ -174,6 +344,32 @@ class Reporter(threading.Thread):
         log.debug("Stopped reporter")
         DogstatsdStatus.remove_latest_status()
 
+    def merge_shards(self):
+        """
+        Pull the aggregator shards of the dogstatsd workers into our own
+        aggregator, which then flushes them as a whole.
+        """
+        if not self.shard_conns:
+            return
+
+        for conn in self.shard_conns:
+            try:
+                conn.send(True)
+            except Exception:
+                log.exception("Unable to reach a dogstatsd worker")
+
+        for conn in self.shard_conns:
+            try:
+                if not conn.poll(SHARD_COLLECT_TIMEOUT):
+                    log.warning("A dogstatsd worker didn't hand over its metrics in time,"
+                                " they will be reported with the next flush")
+                    continue
+                # Also pick up the late answers of previous flushes
+                while conn.poll(0):
+                    self.metrics_aggregator.merge_shard_state(conn.recv())
+            except Exception:
+                log.exception("Unable to merge the metrics of a dogstatsd worker")
+
     def flush(self):
         try:
             self.flush_count += 1
@@ -206,6 +402,25 @@ class Reporter(threading.Thread):
             if self.flush_count == FLUSH_LOGGING_INITIAL:
                 log.info("First flushes done, %s flushes will be logged every %s flushes." % (FLUSH_LOGGING_COUNT, FLUSH_LOGGING_PERIOD))
 
+            udp_drop_count = None
+            if self.udp_port is not None:
+                udp_drop_count = get_udp_drop_count(self.udp_port)
+
+            # Unix socket clients are blocked rather than losing packets, the kernel drops nothing there
+            listener_stats = {}
+            for listener, listener_packet_count in self.metrics_aggregator.listener_packet_counts.items():
+                listener_stats[listener] = {
+                    'packet_count': listener_packet_count,
+                    'drop_count': udp_drop_count if listener == 'udp' else 0,
+                }
+
+            forwarder_stats = None
+            if self.forwarding:
+                forwarder_stats = {
+                    'forwarded_count': self.metrics_aggregator.forwarded_count,
+                    'dropped_count': self.metrics_aggregator.forward_dropped_count,
+                }
+
             # Persist a status message.
             packet_count = self.metrics_aggregator.total_count
             DogstatsdStatus(
@@ -215,6 +430,10 @@ class Reporter(threading.Thread):
                 metric_count=count,
                 event_count=event_count,
                 service_check_count=service_check_count,
+                udp_drop_count=udp_drop_count,
+                listener_stats=listener_stats,
+                forwarder_stats=forwarder_stats,
+                http_stats=self.http_session.get_stats(),
             ).persist()
 
         except Exception:
@@ -224,12 +443,13 @@ class Reporter(threading.Thread):
                 log.exception("Error flushing metrics")
 
     def submit(self, metrics):
-        body, headers = serialize_metrics(metrics, self.hostname)
         params = {}
         if self.api_key:
             params['api_key'] = self.api_key
         url = '%s/api/v1/series?%s' % (self.api_host, urlencode(params))
-        self.submit_http(url, body, headers)
+        # Each payload is posted as soon as it's serialized
+        for body, headers in serialize_metrics_payloads(metrics, self.hostname, self.max_payload_size):
+            self.submit_http(url, body, headers)
 
     def submit_events(self, events):
         headers = {'Content-Type':'application/json'}
@@ -256,7 +476,7 @@ class Reporter(threading.Thread):
         log.debug("Posting payload to %s" % url)
         try:
             start_time = time()
-            r = requests.post(url, data=data, timeout=5, headers=headers)
+            r = self.http_session.post(url, data=data, timeout=5, headers=headers)
             r.raise_for_status()
 
             if r.status_code >= 200 and r.status_code < 205:
@@ -283,41 +503,201 @@ class Reporter(threading.Thread):
         self.submit_http(url, json.dumps(service_checks), headers)
 
 
+def coalesce_packets(messages, max_size=FORWARD_PACKET_SIZE):
+    """
+    Join the statsd `messages` with newlines into datagrams of at most
+    `max_size` bytes. A message bigger than that is sent on its own.
+    """
+    datagram = []
+    size = 0
+    for message in messages:
+        message = message.rstrip('\n')
+        if not message:
+            continue
+        if datagram and size + 1 + len(message) > max_size:
+            yield '\n'.join(datagram)
+            datagram = []
+            size = 0
+        if datagram:
+            size += 1
+        datagram.append(message)
+        size += len(message)
+    if datagram:
+        yield '\n'.join(datagram)
+
+
+class StatsdForwarder(threading.Thread):
+    """
+    Forwards the packets received by dogstatsd to another statsd server.
+    They're queued by the server and sent by this thread, coalesced into
+    datagrams of up to `max_packet_size` bytes. Packets are dropped rather
+    than queued beyond `queue_size` bytes, so the server is never slowed
+    down. What's queued when the forwarder is stopped is still sent.
+    """
+
+    def __init__(self, host, port, max_packet_size=FORWARD_PACKET_SIZE, queue_size=FORWARD_QUEUE_SIZE):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.address = (host, port)
+        self.max_packet_size = max_packet_size
+        self.queue_size = queue_size
+
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.connect(self.address)
+
+        self._pending = []
+        self._pending_size = 0
+        self._pending_cond = threading.Condition()
+        self.running = True
+
+        self.forwarded_count = 0
+        # Only updated by the server thread
+        self.dropped_count = 0
+        self._last_drop_log = 0
+        # Counts already handed over by `pop_counts`
+        self._popped_forwarded_count = 0
+        self._popped_dropped_count = 0
+
+    def enqueue(self, messages):
+        """ Queue packets to forward, called by the server """
+        with self._pending_cond:
+            room = self.queue_size - self._pending_size
+            size = sum(len(message) for message in messages)
+            if size > room:
+                # Keep the packets which fit
+                size = 0
+                for kept, message in enumerate(messages):
+                    if size + len(message) > room:
+                        break
+                    size += len(message)
+                dropped = len(messages) - kept
+                messages = messages[:kept]
+            else:
+                dropped = 0
+            if messages:
+                self._pending.extend(messages)
+                self._pending_size += size
+                self._pending_cond.notify()
+
+        if dropped:
+            self.dropped_count += dropped
+            now = time()
+            if now - self._last_drop_log >= FORWARD_DROP_LOG_INTERVAL:
+                self._last_drop_log = now
+                log.warning("Forwarding to %s:%s can't keep up, %s packets dropped so far"
+                            % (self.address[0], self.address[1], self.dropped_count))
+
+    def pop_counts(self):
+        """ The number of packets forwarded and dropped since the previous call """
+        forwarded_count, dropped_count = self.forwarded_count, self.dropped_count
+        counts = (forwarded_count - self._popped_forwarded_count,
+                  dropped_count - self._popped_dropped_count)
+        self._popped_forwarded_count, self._popped_dropped_count = forwarded_count, dropped_count
+        return counts
+
+    def run(self):
+        running = True
+        while running:
+            with self._pending_cond:
+                while self.running and not self._pending:
+                    self._pending_cond.wait()
+                # Once stopped, send what's left one last time
+                running = self.running
+                messages, self._pending = self._pending, []
+                self._pending_size = 0
+
+            for datagram in coalesce_packets(messages, self.max_packet_size):
+                try:
+                    self.sock.send(datagram)
+                except socket.error, e:
+                    log.debug("Unable to forward a packet to %s:%s: %s"
+                              % (self.address[0], self.address[1], e))
+            self.forwarded_count += len(messages)
+
+    def stop(self):
+        with self._pending_cond:
+            self.running = False
+            self._pending_cond.notify()
+
+
 class Server(object):
     """
     A statsd udp server.
+    It also listens to a Unix datagram socket if it's given a `socket_path`,
+    where local clients are blocked instead of losing packets when dogstatsd
+    can't keep up.
     """
 
-    def __init__(self, metrics_aggregator, host, port, forward_to_host=None, forward_to_port=None):
+    def __init__(self, metrics_aggregator, host, port, forward_to_host=None, forward_to_port=None,
+                 reuse_port=False, shard_conn=None, so_rcvbuf=None, socket_path=None,
+                 socket_mode=None):
         self.host = host
         self.port = int(port)
         self.address = (self.host, self.port)
         self.metrics_aggregator = metrics_aggregator
         self.buffer_size = 1024 * 8
+        self.so_rcvbuf = so_rcvbuf
+        # Set when running as one of several workers sharing the port
+        self.reuse_port = reuse_port
+        self.shard_conn = shard_conn
+        self.socket_path = socket_path
+        self.socket_mode = socket_mode if socket_mode is not None else DEFAULT_SOCKET_MODE
+        self.unix_socket = None
 
         self.running = False
 
-        self.should_forward = forward_to_host is not None
-
-        self.forward_udp_sock = None
+        self.forwarder = None
         # In case we want to forward every packet received to another statsd server
-        if self.should_forward:
+        if forward_to_host is not None:
             if forward_to_port is None:
                 forward_to_port = 8125
 
             log.info("External statsd forwarding enabled. All packets received will be forwarded to %s:%s" % (forward_to_host, forward_to_port))
             try:
-                self.forward_udp_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-                self.forward_udp_sock.connect((forward_to_host, forward_to_port))
+                self.forwarder = StatsdForwarder(forward_to_host, forward_to_port)
             except Exception:
                 log.exception("Error while setting up connection to external statsd server")
 
+    def _bind_unix_socket(self):
+        # Remove the socket left by a previous run
+        try:
+            if stat.S_ISSOCK(os.stat(self.socket_path).st_mode):
+                os.unlink(self.socket_path)
+        except OSError:
+            pass
+
+        unix_socket = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        unix_socket.setblocking(0)
+        if self.so_rcvbuf:
+            unix_socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, self.so_rcvbuf)
+        unix_socket.bind(self.socket_path)
+        os.chmod(self.socket_path, self.socket_mode)
+        log.info('Listening on Unix socket: %s' % self.socket_path)
+        return unix_socket
+
+    def _close_unix_socket(self):
+        if self.unix_socket is None:
+            return
+        self.unix_socket.close()
+        self.unix_socket = None
+        try:
+            os.unlink(self.socket_path)
+        except OSError:
+            pass
+
     def start(self):
         """ Run the server. """
         # Bind to the UDP socket.
         # IPv4 only
         self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
         self.socket.setblocking(0)
+        if self.reuse_port:
+            self.socket.setsockopt(socket.SOL_SOCKET, SO_REUSEPORT, 1)
+        if self.so_rcvbuf:
+            self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, self.so_rcvbuf)
+            # The kernel caps it to net.core.rmem_max
+            log.info("UDP receive buffer size: %s bytes" %
+                     self.socket.getsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF))
         try:
             self.socket.bind(self.address)
         except socket.gaierror:
@@ -328,38 +708,146 @@ class Server(object):
 
         log.info('Listening on host & port: %s' % str(self.address))
 
+        if self.socket_path:
+            self.unix_socket = self._bind_unix_socket()
+
         # Inline variables for quick look-up.
         buffer_size = self.buffer_size
-        aggregator_submit = self.metrics_aggregator.submit_packets
-        sock = [self.socket]
-        socket_recv = self.socket.recv
+        # Datagrams are read into this buffer, which is reused across reads
+        buf = bytearray(buffer_size)
+        buf_view = memoryview(buf)
+        batch_range = range(RECV_BATCH_SIZE)
+        aggregator_submit_batch = self.metrics_aggregator.submit_packet_batch
+        # (socket, its recv_into, listener name) of each socket we read datagrams from
+        listeners = [(self.socket, self.socket.recv_into, 'udp')]
+        if self.unix_socket is not None:
+            listeners.append((self.unix_socket, self.unix_socket.recv_into, 'unix'))
+        sock = [listener[0] for listener in listeners]
+        socket_error = socket.error
+        would_block = (errno.EAGAIN, errno.EWOULDBLOCK)
+        shard_conn = self.shard_conn
+        if shard_conn is not None:
+            sock.append(shard_conn)
         select_select = select.select
         select_error = select.error
         timeout = UDP_SOCKET_TIMEOUT
-        should_forward = self.should_forward
-        forward_udp_sock = self.forward_udp_sock
+        forwarder = self.forwarder
+        aggregator_count_forwarded = self.metrics_aggregator.count_forwarded_packets
+        if forwarder is not None:
+            # Started from here, the server may run in a worker process
+            forwarder.start()
 
         # Run our select loop.
         self.running = True
         while self.running:
             try:
-                ready = select_select(sock, [], [], timeout)
-                if ready[0]:
-                    message = socket_recv(buffer_size)
-                    aggregator_submit(message)
-
-                    if should_forward:
-                        forward_udp_sock.send(message)
+                ready = select_select(sock, [], [], timeout)[0]
+                if forwarder is not None:
+                    aggregator_count_forwarded(*forwarder.pop_counts())
+                for listener_sock, socket_recv_into, listener in listeners:
+                    if listener_sock not in ready:
+                        continue
+                    # Drain every pending datagram before going back to select
+                    messages = []
+                    try:
+                        for _ in batch_range:
+                            nbytes = socket_recv_into(buf, buffer_size)
+                            messages.append(buf_view[:nbytes].tobytes())
+                    except socket_error, e:
+                        if e.args[0] not in would_block:
+                            raise
+                    aggregator_submit_batch(messages, listener)
+
+                    if forwarder is not None:
+                        forwarder.enqueue(messages)
+                if shard_conn is not None and shard_conn in ready:
+                    # The reporter asks for what we aggregated so far
+                    shard_conn.recv()
+                    shard_conn.send(self.metrics_aggregator.pop_shard_state())
             except select_error, se:
                 # Ignore interrupted system calls from sigterm.
-                errno = se[0]
-                if errno != 4:
+                if se[0] != errno.EINTR:
                     raise
             except (KeyboardInterrupt, SystemExit):
                 break
             except Exception:
                 log.exception('Error receiving datagram')
 
+        if forwarder is not None:
+            forwarder.stop()
+            # It's a daemon thread, wait for it to send what's left before the process exits
+            forwarder.join(FORWARD_STOP_TIMEOUT)
+        self._close_unix_socket()
+
+    def stop(self):
+        self.running = False
+
+
+class ServerWorker(multiprocessing.Process):
+    """
+    A process running a `Server` with its own aggregator shard.
+    """
+
+    def __init__(self, server):
+        multiprocessing.Process.__init__(self)
+        self.server = server
+        self.daemon = True
+
+    def _handle_sigterm(self, signum, frame):
+        self.server.stop()
+
+    def run(self):
+        signal.signal(signal.SIGTERM, self._handle_sigterm)
+        # The parent process stops us on keyboard interrupts
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        self.server.start()
+
+
+class ShardedServer(object):
+    """
+    Spreads the statsd traffic over several worker processes bound to the
+    same port with SO_REUSEPORT, the kernel balancing datagrams between them.
+    Each worker aggregates in its own shard, the `Reporter` merges them
+    at flush time.
+    """
+
+    def __init__(self, workers):
+        self.workers = workers
+        self.running = False
+
+    def start_workers(self):
+        """
+        Fork the workers. To be called before any thread is started, a
+        child could inherit a lock held by another thread otherwise.
+        """
+        log.info("Starting %s dogstatsd worker%s" % (len(self.workers), plural(len(self.workers))))
+        for worker in self.workers:
+            worker.start()
+
+    def start(self):
+        """ Watch the workers until we're stopped or one of them dies """
+        if not any(worker.pid for worker in self.workers):
+            self.start_workers()
+
+        self.running = True
+        try:
+            while self.running:
+                if not all(worker.is_alive() for worker in self.workers):
+                    log.error("A dogstatsd worker died, stopping")
+                    break
+                sleep(1)
+        except (KeyboardInterrupt, SystemExit):
+            pass
+        finally:
+            self.stop_workers()
+
+    def stop_workers(self):
+        for worker in self.workers:
+            if worker.is_alive():
+                worker.terminate()
+        for worker in self.workers:
+            worker.join(UDP_SOCKET_TIMEOUT + 1)
+
     def stop(self):
         self.running = False
 
@@ -383,6 +871,10 @@ class Dogstatsd(Daemon):
         # Handle Keyboard Interrupt
         signal.signal(signal.SIGINT, self._handle_sigterm)
 
+        # Workers are forked before the reporting thread is started
+        if isinstance(self.server, ShardedServer):
+            self.server.start_workers()
+
         # Start the reporting thread before accepting data
         self.reporter.start()
 
@@ -433,6 +925,11 @@ def init(config_path=None, use_watchdog=False, use_forwarder=False, args=None):
     forward_to_port = c.get('statsd_forward_port')
     event_chunk_size = c.get('event_chunk_size')
     recent_point_threshold = c.get('recent_point_threshold', None)
+    workers = c.get('dogstatsd_workers', 1)
+    so_rcvbuf = c.get('dogstatsd_so_rcvbuf')
+    max_payload_size = c.get('dogstatsd_max_payload_size')
+    socket_path = c.get('dogstatsd_socket')
+    socket_mode = c.get('dogstatsd_socket_mode')
 
     target = c['dd_url']
     if use_forwarder:
@@ -444,18 +941,19 @@ def init(config_path=None, use_watchdog=False, use_forwarder=False, args=None):
     # server and reporting threads.
     assert 0 < interval
 
-    aggregator = MetricsBucketAggregator(
-        hostname,
-        aggregator_interval,
-        recent_point_threshold=recent_point_threshold,
-        formatter=get_formatter(c),
-        histogram_aggregates=c.get('histogram_aggregates'),
-        histogram_percentiles=c.get('histogram_percentiles'),
-        utf8_decoding=c['utf8_decoding']
-    )
+    def create_aggregator():
+        return MetricsBucketAggregator(
+            hostname,
+            aggregator_interval,
+            recent_point_threshold=recent_point_threshold,
+            formatter=get_formatter(c),
+            histogram_aggregates=c.get('histogram_aggregates'),
+            histogram_percentiles=c.get('histogram_percentiles'),
+            utf8_decoding=c['utf8_decoding'],
+            histogram_backend=c.get('histogram_backend')
+        )
 
-    # Start the reporting thread.
-    reporter = Reporter(interval, aggregator, target, api_key, use_watchdog, event_chunk_size)
+    aggregator = create_aggregator()
 
     # Start the server on an IPv4 stack
     # Default to loopback
@@ -464,7 +962,33 @@ def init(config_path=None, use_watchdog=False, use_forwarder=False, args=None):
     if non_local_traffic:
         server_host = ''
 
-    server = Server(aggregator, server_host, port, forward_to_host=forward_to_host, forward_to_port=forward_to_port)
+    if workers > 1 and not Platform.is_linux():
+        log.warning("dogstatsd_workers is only supported on Linux, running a single dogstatsd process")
+        workers = 1
+
+    shard_conns = []
+    if workers > 1:
+        # Each worker gets its own aggregator shard, `aggregator` only
+        # receives the merged shards and flushes them
+        server_workers = []
+        for i in range(workers):
+            reporter_conn, worker_conn = multiprocessing.Pipe()
+            shard_conns.append(reporter_conn)
+            # Only one process can bind the Unix socket
+            server_workers.append(ServerWorker(Server(
+                create_aggregator(), server_host, port,
+                forward_to_host=forward_to_host, forward_to_port=forward_to_port,
+                reuse_port=True, shard_conn=worker_conn, so_rcvbuf=so_rcvbuf,
+                socket_path=socket_path if i == 0 else None, socket_mode=socket_mode)))
+        server = ShardedServer(server_workers)
+    else:
+        server = Server(aggregator, server_host, port, forward_to_host=forward_to_host, forward_to_port=forward_to_port,
+                        so_rcvbuf=so_rcvbuf, socket_path=socket_path, socket_mode=socket_mode)
+
+    # Start the reporting thread.
+    reporter = Reporter(interval, aggregator, target, api_key, use_watchdog, event_chunk_size,
+                        shard_conns=shard_conns, udp_port=port, max_payload_size=max_payload_size,
+                        http_session=get_http_session(c), forwarding=forward_to_host is not None)
 
     return reporter, server, c
 
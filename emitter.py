@@ -5,11 +5,11 @@ import re
 import zlib
 
 # 3p
-import requests
 import simplejson as json
 
 # project
 from config import get_version
+from utils.http import get_http_session
 
 from utils.proxy import set_no_proxy_settings
 set_no_proxy_settings()
@@ -54,7 +54,7 @@ def http_emitter(message, log, agentConfig, endpoint):
 
     try:
         headers = post_headers(agentConfig, zipped)
-        r = requests.post(url, data=zipped, timeout=5, headers=headers)
+        r = get_http_session(agentConfig).post(url, data=zipped, timeout=5, headers=headers)
 
         r.raise_for_status()
 
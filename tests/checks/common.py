@@ -16,6 +16,7 @@ from checks import AgentCheck
 from config import get_checksd_path
 from util import get_hostname, get_os
 from utils.debug import get_check  # noqa -  FIXME 5.5.0 AgentCheck tests should not use this
+from utils.proc_snapshot import invalidate_proc_snapshots
 
 log = logging.getLogger('tests')
 
@@ -187,6 +188,9 @@ class AgentCheckTest(unittest.TestCase):
                 else:
                     setattr(self.check, func_name, mock)
 
+        # Like the collector, don't reuse what was read from /proc by the previous run
+        invalidate_proc_snapshots()
+
         error = None
         for instance in self.check.instances:
             try:
@@ -7,6 +7,7 @@ from utils.dockerutil import get_client, set_docker_settings, get_docker_setting
     image_tag_extractor, container_name_extractor
 
 # 3rd party
+import mock
 from nose.plugins.attrib import attr
 
 log = logging.getLogger('tests')
@@ -147,6 +148,88 @@ class TestCheckDockerDaemon(AgentCheckTest):
                 expected_tags += tags
             self.assertMetric(mname, tags=expected_tags, count=1, at_least=1)
 
+    def test_container_index(self):
+        config = {
+            "init_config": {},
+            "instances": [{
+                "url": "unix://var/run/docker.sock",
+            },
+            ],
+        }
+        self.run_check(config, force_reload=True)
+
+        container_ids = set(c['Id'] for c in self.containers)
+        self.assertTrue(container_ids <= set(self.check._container_pids))
+        cgroup_files = dict(self.check._cgroup_files)
+        self.assertTrue(container_ids <= set(key[0] for key in cgroup_files))
+
+        # The index and the cgroup files are reused by the next runs
+        self.run_check(config)
+        self.assertEquals(self.check._cgroup_files, cgroup_files)
+        self.assertMetric('docker.cpu.user', at_least=1)
+
+        # Until the container is stopped
+        stopped = self.containers[0]['Id']
+        self.docker_client.stop(stopped)
+        self.run_check(config)
+        self.assertNotIn(stopped, self.check._container_pids)
+        self.assertNotIn(stopped, set(key[0] for key in self.check._cgroup_files))
+        self.assertTrue(all(fp.closed for key, fp in cgroup_files.iteritems() if key[0] == stopped))
+
+    def test_container_restart_events(self):
+        config = {
+            "init_config": {},
+            "instances": [{
+                "url": "unix://var/run/docker.sock",
+                "collect_events": False,
+            },
+            ],
+        }
+        self.run_check(config, force_reload=True)
+        restarted = self.containers[0]['Id']
+        cgroup_files = dict((key, fp) for key, fp in self.check._cgroup_files.iteritems()
+                            if key[0] == restarted)
+        self.assertTrue(cgroup_files)
+
+        # The cgroup files of a restarted container are opened again, even
+        # when the events aren't collected
+        self.docker_client.restart(restarted)
+        self.run_check(config)
+        self.assertTrue(all(fp.closed for fp in cgroup_files.itervalues()))
+        self.assertIn(restarted, set(key[0] for key in self.check._cgroup_files))
+        self.assertMetric('docker.cpu.user', at_least=1)
+
+    def test_no_events_without_collect_events(self):
+        config = {
+            "init_config": {},
+            "instances": [{
+                "url": "unix://var/run/docker.sock",
+                "collect_events": False,
+            },
+            ],
+        }
+        self.run_check(config, force_reload=True)
+
+        # The restarts are noticed from the indexed PIDs, the events aren't needed
+        with mock.patch.object(self.check, '_get_events') as get_events:
+            self.run_check(config)
+        self.assertFalse(get_events.called)
+        self.assertMetric('docker.cpu.user', at_least=1)
+
+    def test_max_open_cgroup_files(self):
+        config = {
+            "init_config": {},
+            "instances": [{
+                "url": "unix://var/run/docker.sock",
+                "max_open_cgroup_files": 2,
+            },
+            ],
+        }
+        self.run_check(config, force_reload=True)
+        self.assertEquals(len(self.check._cgroup_files), 2)
+        self.assertMetric('docker.cpu.user', at_least=1)
+        self.assertMetric('docker.mem.rss', at_least=1)
+
     def test_exclude_filter(self):
         expected_metrics = [
             ('docker.containers.running', ['docker_image:nginx', 'image_name:nginx']),
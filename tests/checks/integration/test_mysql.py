@@ -365,6 +365,25 @@ class TestMySql(AgentCheckTest):
         # Raises when COVERAGE=true and coverage < 100%
         self.coverage_report()
 
+    def test_connection_reuse(self):
+        config = {'instances': self.MYSQL_CONFIG}
+        self.run_check(config)
+        self.assertEquals(len(self.check.connections), 1)
+        db = self.check.connections.values()[0]
+
+        # The connection is kept for the next runs
+        self.run_check(config)
+        self.assertTrue(self.check.connections.values()[0] is db)
+        self.assertServiceCheck('mysql.can_connect', status=AgentCheck.OK,
+                                tags=self.SC_TAGS, count=1)
+
+        # And replaced when it's closed
+        db.close()
+        self.run_check(config)
+        self.assertFalse(self.check.connections.values()[0] is db)
+        self.assertServiceCheck('mysql.can_connect', status=AgentCheck.OK,
+                                tags=self.SC_TAGS, count=1)
+
     def test_connection_failure(self):
         """
         Service check reports connection failure
@@ -208,6 +208,31 @@ class ProcessCheckTest(AgentCheckTest):
         # Shouldn't throw an exception
         self.run_check(config)
 
+    def test_find_pids(self):
+        config = {
+            'instances': [{
+                'name': 'self_cmdline',
+                'search_string': ['test_find_pids_unknown', psutil.Process(os.getpid()).cmdline()[-1]],
+                'exact_match': False,
+            }, {
+                'name': 'self_name',
+                'search_string': [psutil.Process(os.getpid()).name()],
+            }]
+        }
+        self.run_check(config)
+
+        # The command lines of all the instances are matched in one pass
+        self.assertEquals(self.check._cmdline_matcher.patterns, set(config['instances'][0]['search_string']))
+        for instance in config['instances']:
+            exact_match = instance.get('exact_match', True)
+            pids = self.check.find_pids(instance['name'], instance['search_string'], exact_match)
+            self.assertIn(os.getpid(), pids)
+
+        # Patterns which weren't configured are added to the matcher
+        pids = self.check.find_pids('other', ['test_find_pids_unknown_2'], False)
+        self.assertEquals(pids, set())
+        self.assertIn('test_find_pids_unknown_2', self.check._cmdline_matcher.patterns)
+
     def mock_find_pids(self, name, search_string, exact_match=True, ignore_ad=True,
                        refresh_ad_cache=True):
         idx = search_string[0].split('_')[1]
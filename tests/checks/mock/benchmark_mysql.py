@@ -0,0 +1,42 @@
+"""
+Performance tests for the parsing of the InnoDB status in the MySQL check.
+"""
+# stdlib
+import os
+
+# 3p
+import mock
+
+# project
+from tests.checks.common import get_check_class
+
+
+class TestInnoDBStatusPerf(object):
+
+    # Transactions added to the captured status, one of them is ~20 lines
+    TRANSACTION_COUNT = 2000
+    PARSE_COUNT = 20
+
+    def test_innodb_status_perf(self):
+        fixture = os.path.join(os.path.dirname(__file__), '..', 'fixtures', 'mysql', 'innodb_status.txt')
+        with open(fixture) as f:
+            innodb_status_text = f.read()
+
+        # A busy server, with a long TRANSACTIONS section
+        start = innodb_status_text.index('---TRANSACTION 8384911259')
+        end = innodb_status_text.index('--------\nFILE I/O')
+        innodb_status_text = (innodb_status_text[:end] +
+                              innodb_status_text[start:end] * self.TRANSACTION_COUNT +
+                              innodb_status_text[end:])
+
+        db = mock.MagicMock()
+        db.cursor.return_value.fetchone.return_value = ('InnoDB', '', innodb_status_text)
+
+        check = get_check_class('mysql')('mysql', {}, {}, [{}])
+        for _ in xrange(self.PARSE_COUNT):
+            check._get_stats_from_innodb_status(db)
+
+
+if __name__ == '__main__':
+    t = TestInnoDBStatusPerf()
+    t.test_innodb_status_perf()
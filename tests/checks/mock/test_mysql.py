@@ -0,0 +1,134 @@
+# 3p
+import mock
+import pymysql
+
+# project
+from tests.checks.common import AgentCheckTest, Fixtures
+
+
+def innodb_status_db(innodb_status_text):
+    db = mock.MagicMock()
+    db.cursor.return_value.fetchone.return_value = ('InnoDB', '', innodb_status_text)
+    return db
+
+
+class TestMySqlInnoDBStatus(AgentCheckTest):
+    CHECK_NAME = 'mysql'
+
+    INNODB_STATUS_VALUES = {
+        # SEMAPHORES
+        'Innodb_mutex_spin_waits': '6549236',
+        'Innodb_s_lock_spin_rounds': '40283627',
+        'Innodb_x_lock_os_waits': '1056720',
+        'Innodb_semaphore_waits': '1',
+        'Innodb_semaphore_wait_time': '1000',
+        # TRANSACTIONS, the transactions of the deadlock section aren't counted
+        'Innodb_history_list_length': '1489',
+        'Innodb_current_transactions': '5',
+        'Innodb_active_transactions': '3',
+        'Innodb_row_lock_time': '32000',
+        'Innodb_tables_in_use': '5',
+        'Innodb_locked_tables': '5',
+        'Innodb_lock_structs': '152',
+        'Innodb_locked_transactions': '1',
+        # FILE I/O
+        'Innodb_os_file_reads': '8782182',
+        'Innodb_pending_normal_aio_reads': '0',
+        'Innodb_pending_ibuf_aio_reads': '0',
+        # INSERT BUFFER AND ADAPTIVE HASH INDEX
+        'Innodb_ibuf_merges': '593983',
+        'Innodb_ibuf_merged': '1054081',
+        'Innodb_hash_index_cells_used': '4229064',
+        # LOG
+        'Innodb_log_writes': '520835887',
+        'Innodb_lsn_flushed': '2737258862455',
+        'Innodb_checkpoint_age': '6023317',
+        # BUFFER POOL AND MEMORY
+        'Innodb_mem_total': '29642194944',
+        'Innodb_mem_page_hash': '11688584',
+        'Innodb_mem_thread_hash': '409336',
+        'Innodb_buffer_pool_pages_total': '1769471',
+        'Innodb_buffer_pool_pages_dirty': '160602',
+        'Innodb_pages_written': '21705836',
+        # ROW OPERATIONS
+        'Innodb_rows_read': '454561562',
+        'Innodb_queries_inside': '0',
+        'Innodb_read_views': '1',
+    }
+
+    def setUp(self):
+        self.load_check({'instances': [{'server': 'localhost', 'user': 'dog'}]})
+
+    def test_innodb_status(self):
+        db = innodb_status_db(Fixtures.read_file('innodb_status.txt'))
+        results = self.check._get_stats_from_innodb_status(db)
+        for metric, value in self.INNODB_STATUS_VALUES.iteritems():
+            self.assertEquals(results.get(metric), value, metric)
+        self.assertEquals(len(results), 69)
+
+    def test_innodb_status_legacy_formats(self):
+        innodb_status_text = "\n".join([
+            "RW-shared spins 3859028, OS waits 2100750; RW-excl spins 4641946, OS waits 1530310",
+            "Trx id counter 0 1170664159",
+            "---TRANSACTION 0 1170664158, ACTIVE 3 sec, process no 13510, OS thread id 1170446656",
+            "ROLLING BACK 127539 lock struct(s), heap size 15201832, 4411492 row lock(s), undo log entries 1042488",
+            "Pending normal aio reads: [1, 2, 3, 4] , aio writes: [5, 6, 7, 8] ,",
+            " ibuf aio reads:, log i/o's:, sync i/o's:",
+            "Ibuf for space 0: size 1, free list len 887, seg size 889, is not empty",
+            "19817685 inserts, 19817684 merged recs, 3552620 merges",
+            "Hash table size 57374437, node heap has 72964 buffer(s)",
+            "Pages read ahead 0.00/s, evicted without access 0.06/s",
+        ])
+        results = self.check._get_stats_from_innodb_status(innodb_status_db(innodb_status_text))
+
+        self.assertEquals(results['Innodb_s_lock_spin_waits'], '3859028')
+        self.assertEquals(results['Innodb_x_lock_os_waits'], '1530310')
+        self.assertEquals(results['Innodb_active_transactions'], '1')
+        self.assertEquals(results['Innodb_lock_structs'], '127539')
+        self.assertEquals(results['Innodb_pending_normal_aio_reads'], '10')
+        self.assertEquals(results['Innodb_pending_normal_aio_writes'], '26')
+        self.assertEquals(results['Innodb_pending_aio_sync_ios'], '0')
+        self.assertEquals(results['Innodb_ibuf_segment_size'], '889')
+        self.assertEquals(results['Innodb_ibuf_merged'], '19817684')
+        self.assertEquals(results['Innodb_hash_index_cells_used'], '0')
+        self.assertNotIn('Innodb_pages_read', results)
+
+
+class TestMySqlConnections(AgentCheckTest):
+    CHECK_NAME = 'mysql'
+
+    def setUp(self):
+        self.load_check({'instances': [{'server': 'localhost', 'user': 'dog'}]})
+
+    def test_stop(self):
+        db = mock.MagicMock()
+        self.check.connections[('localhost', 'dog')] = db
+        self.check.stop()
+        self.assertTrue(db.close.called)
+        self.assertEquals(self.check.connections, {})
+
+    def test_evict_connections(self):
+        kept, removed = mock.MagicMock(), mock.MagicMock()
+        self.check.connections[('localhost', 'dog')] = kept
+        self.check.connections[('otherhost:3307', 'dog')] = removed
+        self.check._evict_connections()
+        self.assertEquals(self.check.connections, {('localhost', 'dog'): kept})
+        self.assertFalse(kept.close.called)
+        self.assertTrue(removed.close.called)
+
+    def test_global_stats_fallback(self):
+        self.check._get_config(self.check.instances[0])
+        db = mock.MagicMock()
+        db.cursor.return_value.execute.side_effect = [
+            pymysql.err.OperationalError(2013, 'Lost connection'), None, None, None]
+        db.cursor.return_value.fetchall.side_effect = [[('Uptime', '10')], [('max_connections', '100')]]
+        db.cursor.return_value.rowcount = 1
+
+        results, innodb_enabled = self.check._get_global_stats(db)
+        self.assertEquals(results, {'Uptime': '10', 'max_connections': '100'})
+        self.assertTrue(innodb_enabled)
+        # The connection was reopened before the statements were sent one by one
+        self.assertTrue(db.close.called)
+        db.ping.assert_called_once_with(reconnect=True)
+        # and a server error doesn't stop the next runs from sending them together
+        self.assertNotIn('localhost', self.check.no_multi_statements)
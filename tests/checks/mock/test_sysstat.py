@@ -1,18 +1,27 @@
 # stdlib
 import logging
+import os
+import shutil
 import sys
+import tempfile
 import unittest
 
+# 3p
+import mock
+
 # project
 from checks.system.unix import (
+    Cpu,
     IO,
     Load,
     Memory,
+    Processes,
 )
 from checks.system.common import System
 from config import get_system_stats
 from tests.checks.common import get_check
 from utils.platform import Platform
+from utils.proc_snapshot import ProcSnapshot
 
 logging.basicConfig(level=logging.DEBUG)
 logger = logging.getLogger(__file__)
@@ -125,6 +134,112 @@ sda               0.00     0.00  0.00  0.00     0.00     0.00     0.00     0.00
             {'system.io.bytes_per_s': float(0),}
         )
 
+    def testDiskstats(self):
+        # /proc/diskstats, one second apart
+        first = """   8       0 sda 1000 10 80000 5000 500 50 40000 2000 0 3000 7000
+   8       1 sda1 900 10 70000 4500 500 50 40000 2000 0 2500 6500
+   8      16 sdb 0 0 0 0 0 0 0 0 0 0 0
+"""
+        second = """   8       0 sda 1100 20 88000 5500 600 50 48000 3000 2 3500 8500
+   8       1 sda1 900 10 70000 4500 500 50 40000 2000 0 2500 6500
+   8      16 sdb 0 0 0 0 0 0 0 0 0 0 0
+"""
+        last_diskstats = IO._parse_diskstats(first.splitlines())
+        diskstats = IO._parse_diskstats(second.splitlines())
+        # Devices without any I/O aren't reported
+        self.assertEqual(sorted(diskstats), ['sda', 'sda1'])
+
+        results = IO._diskstats_rates(last_diskstats['sda'], diskstats['sda'], 1.0)
+        self.assertEqual(results, {
+            'rrqm/s': '10.00', 'wrqm/s': '0.00',
+            'r/s': '100.00', 'w/s': '100.00',
+            'rkB/s': '4000.00', 'wkB/s': '4000.00',
+            'avgrq-sz': '80.00', 'avgqu-sz': '1.50',
+            'await': '7.50', 'r_await': '5.00', 'w_await': '10.00',
+            'svctm': '2.50', '%util': '50.00',
+        })
+
+        results = IO._diskstats_rates(last_diskstats['sda1'], diskstats['sda1'], 1.0)
+        self.assertEqual(set(results.values()), set(['0.00']))
+
+        # Partitions are left out, the devices are looked up in sysfs
+        sysfs_path = tempfile.mkdtemp()
+        try:
+            self.assertEqual(sorted(IO._filter_block_devices(diskstats, sysfs_path)), ['sda', 'sda1'])
+            os.makedirs(os.path.join(sysfs_path, 'block', 'sda'))
+            os.makedirs(os.path.join(sysfs_path, 'block', 'cciss!c0d0'))
+            diskstats['cciss/c0d0'] = diskstats['cciss/c0d0p1'] = diskstats['sda']
+            self.assertEqual(sorted(IO._filter_block_devices(diskstats, sysfs_path)), ['cciss/c0d0', 'sda'])
+        finally:
+            shutil.rmtree(sysfs_path)
+
+        if Platform.is_linux():
+            checker = IO(logger)
+            # The first run reads the counters twice
+            with mock.patch('time.sleep') as sleep:
+                for stats in checker.check({}).itervalues():
+                    self.assertTrue('%util' in stats)
+            sleep.assert_called_once_with(1)
+
+    def testCpuProcStat(self):
+        first = ["cpu  1000 100 500 8000 200 10 40 50 300 0\n", "cpu0 1000 100 500 8000 200 10 40 50 300 0\n"]
+        second = ["cpu  1500 100 700 8150 250 20 80 100 400 0\n", "intr 1\n"]
+        results = Cpu._cpu_percents(Cpu._parse_proc_stat(first), Cpu._parse_proc_stat(second))
+        # Guest time is part of the user time, mpstat reports it separately
+        self.assertEqual(results, {
+            '%usr': 40.0, '%nice': 0.0, '%sys': 20.0, '%iowait': 5.0,
+            '%irq': 1.0, '%soft': 4.0, '%steal': 5.0, '%guest': 10.0, '%idle': 15.0,
+        })
+        # Older kernels don't have all the times
+        self.assertEqual(Cpu._parse_proc_stat(["cpu  1 2 3 4\n"]), [1, 2, 3, 4, 0, 0, 0, 0, 0, 0])
+
+        if Platform.is_linux():
+            # The first run reads the CPU times twice
+            cpu = Cpu(logger)
+            res = cpu.check({})
+            self.assertTrue(abs(sum(res.values()) - 100) <= 1, res)
+            # Stats since boot
+            cpu._last_cpu_times = [0] * 10
+            res = cpu.check({})
+            self.assertTrue(abs(sum(res.values()) - 100) <= 1, res)
+
+    def testProcesses(self):
+        if Platform.is_linux():
+            res = Processes(logger).check({'api_key': 'apikey', 'hostname': 'foo'})
+            processes = dict((int(p[1]), p) for p in res['processes'])
+            self.assertTrue(os.getpid() in processes)
+            process = processes[os.getpid()]
+            # USER PID %CPU %MEM VSZ RSS TTY STAT START TIME COMMAND
+            self.assertEqual(len(process), 11)
+            self.assertTrue(process[7].startswith('R'))
+            self.assertTrue(int(process[5]) > 0)
+            self.assertTrue('python' in process[10])
+
+    def testProcessesProcfsPath(self):
+        if not Platform.is_linux():
+            return
+        procfs_path = tempfile.mkdtemp()
+        try:
+            with open(os.path.join(procfs_path, 'uptime'), 'w') as f:
+                f.write('1000.00 3000.00\n')
+            with open(os.path.join(procfs_path, 'stat'), 'w') as f:
+                f.write('cpu  1 2 3 4\nbtime 1400000000\n')
+            with open(os.path.join(procfs_path, 'meminfo'), 'w') as f:
+                f.write('MemTotal:        1000000 kB\n')
+            os.mkdir(os.path.join(procfs_path, '42'))
+            with open(os.path.join(procfs_path, '42', 'stat'), 'w') as f:
+                f.write('42 (host proc) S 1 42 42 0 -1 0 0 0 0 0 500 300 0 0 20 0 1 0 10000 4096000 250\n')
+            with open(os.path.join(procfs_path, '42', 'cmdline'), 'w') as f:
+                f.write('/usr/bin/host_proc\0--flag\0')
+
+            # Only the processes of the procfs path are listed
+            with mock.patch('checks.system.unix.get_proc_snapshot', return_value=ProcSnapshot(procfs_path)):
+                res = Processes(logger).check({'api_key': 'apikey', 'hostname': 'foo'})
+            self.assertEqual([p[1] for p in res['processes']], ['42'])
+            self.assertEqual(res['processes'][0][10], '/usr/bin/host_proc --flag')
+        finally:
+            shutil.rmtree(procfs_path)
+
     def testNetwork(self):
         # FIXME: cx_state to true, but needs sysstat installed
         config = """
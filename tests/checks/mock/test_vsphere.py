@@ -0,0 +1,95 @@
+# 3p
+import mock
+from pyVmomi import vim, vmodl
+
+# project
+from tests.checks.common import AgentCheckTest
+
+
+class FakePool(object):
+    """ Run the jobs right away """
+    def apply_async(self, func, args=(), kwds=dict(), callback=None):
+        func(*args, **kwds)
+
+
+class FakePerfManager(object):
+    """ Answer QueryPerf with one value per metric of each queried entity, and count the calls """
+    def __init__(self, failing_entities=()):
+        self.query_perf_calls = []
+        self.failing_entities = set(failing_entities)
+
+    def QueryPerf(self, querySpec):
+        self.query_perf_calls.append(querySpec)
+        for query in querySpec:
+            if str(query.entity) in self.failing_entities:
+                raise vmodl.fault.InvalidArgument(invalidProperty='querySpec.entity')
+        results = []
+        for query in querySpec:
+            values = [
+                mock.Mock(id=metric_id, value=[int(query.entity._moId.split('-')[1]) + metric_id.counterId])
+                for metric_id in query.metricId
+            ]
+            results.append(mock.Mock(entity=query.entity, value=values))
+        return results
+
+
+class TestVSphereQueryPerf(AgentCheckTest):
+    CHECK_NAME = 'vsphere'
+
+    INSTANCE = {'name': 'vsphere_mock', 'host': 'vcenter.example.com'}
+    MOR_COUNT = 150
+
+    def setUp(self):
+        self.load_check({'init_config': {'batch_query_perf_size': 64}, 'instances': [self.INSTANCE]})
+        self.check.pool = FakePool()
+        self.perf_manager = FakePerfManager()
+        self.check.server_instances['vsphere_mock'] = mock.Mock(**{'content.perfManager': self.perf_manager})
+
+        # Counter 1 is a rate, 2 is a gauge in percents
+        self.check.metrics_metadata['vsphere_mock'] = {
+            1: {'name': 'cpu.usagemhz', 'unit': 'megaHertz'},
+            2: {'name': 'mem.usage', 'unit': 'percent'},
+        }
+        metrics = [vim.PerformanceManager.MetricId(counterId=counter_id, instance='')
+                   for counter_id in (1, 2)]
+        self.check.morlist['vsphere_mock'] = {}
+        for i in xrange(self.MOR_COUNT):
+            mor = vim.VirtualMachine('vm-%d' % (i * 10))
+            self.check.morlist['vsphere_mock'][str(mor)] = {
+                'mor_type': 'vm',
+                'mor': mor,
+                'hostname': 'vm%d' % i,
+                'metrics': metrics,
+            }
+
+    def test_batched_query_perf(self):
+        self.check.collect_metrics(self.INSTANCE)
+
+        # The MORs are queried by batches
+        batch_sizes = sorted(len(query) for query in self.perf_manager.query_perf_calls)
+        self.assertEquals(batch_sizes, [22, 64, 64])
+
+        # And their values are reported for each of them
+        self.metrics = self.check.get_metrics()
+        for i in xrange(self.MOR_COUNT):
+            self.assertMetric('vsphere.mem.usage', value=(i * 10 + 2) / 100.0,
+                              hostname='vm%d' % i, tags=['instance:none'])
+        self.assertMetric('vsphere.vm.count', value=self.MOR_COUNT)
+
+    def test_failing_entity(self):
+        failing = vim.VirtualMachine('vm-%d' % 700)
+        self.perf_manager.failing_entities.add(str(failing))
+        self.check.collect_metrics(self.INSTANCE)
+
+        # The batch of the failing entity is queried again one MOR at a time
+        batch_sizes = sorted(len(query) for query in self.perf_manager.query_perf_calls)
+        self.assertEquals(batch_sizes, [1] * 64 + [22, 64, 64])
+
+        # And the values of the other MORs are still reported
+        self.metrics = self.check.get_metrics()
+        for i in xrange(self.MOR_COUNT):
+            if i == 70:
+                self.assertMetric('vsphere.mem.usage', count=0, hostname='vm%d' % i)
+                continue
+            self.assertMetric('vsphere.mem.usage', value=(i * 10 + 2) / 100.0,
+                              hostname='vm%d' % i, tags=['instance:none'])
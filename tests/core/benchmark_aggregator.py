@@ -2,6 +2,11 @@
 """
 Performance tests for the agent/dogstatsd metrics aggregator.
 """
+# stdlib
+import random
+import time
+
+# project
 from aggregator import MetricsAggregator, MetricsBucketAggregator
 
 
@@ -51,6 +56,46 @@ class TestAggregatorPerf(object):
                     ma.set('set.%s' % j, float(i))
             ma.flush()
 
+    def create_tagged_packets(self, count):
+        """
+        Packets looking like the traffic of a web application: a few hundred
+        contexts, most of them tagged, some with sample rates or magic tags.
+        """
+        random.seed(42)
+        tag_sets = [
+            '#env:prod,service:web,endpoint:/api/v1/users,status:200',
+            '#env:prod,service:web,endpoint:/api/v1/orders,status:500',
+            '#env:prod,service:worker,queue:emails,role:consumer,az:us-east-1a',
+            '#env:staging,service:web,version:1.2.3',
+            '#env:prod,service:db,host:db-1,device:sda1',
+            '#env:prod,service:cache,cluster:main,shard:12',
+        ]
+        types = ['c', 'g', 'h', 'ms', 's']
+        packets = []
+        for i in xrange(count):
+            mtype = types[i % len(types)]
+            value = random.randint(0, 1000) if i % 3 else random.random() * 1000
+            packet = 'app.metric.%s:%s|%s' % (i % 50, value, mtype)
+            if i % 4 == 0:
+                packet += '|@0.5'
+            if i % 10:
+                packet += '|' + tag_sets[i % len(tag_sets)]
+            packets.append(packet)
+        return packets
+
+    def test_dogstatsd_tagged_packets_perf(self):
+        ma = MetricsBucketAggregator('my.host')
+        packets = self.create_tagged_packets(self.LOOPS_PER_FLUSH * 10)
+
+        start = time.time()
+        for _ in xrange(self.FLUSH_COUNT):
+            for packet in packets:
+                ma.submit_packets(packet)
+            ma.flush()
+        duration = time.time() - start
+
+        print "Tagged dogstatsd traffic: %d packets/s" % (len(packets) * self.FLUSH_COUNT / duration)
+
     def create_event_packet(self, title, text):
         p = "_e{{{title_len},{text_len}}}:{title}|{text}".format(
             title_len=len(title),
@@ -110,4 +155,5 @@ if __name__ == '__main__':
     t = TestAggregatorPerf()
     #t.test_dogstatsd_aggregation_perf()
     #t.test_checksd_aggregation_perf()
-    t.test_dogstatsd_utf8_events()
+    #t.test_dogstatsd_utf8_events()
+    t.test_dogstatsd_tagged_packets_perf()
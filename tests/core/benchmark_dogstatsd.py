@@ -0,0 +1,84 @@
+"""
+Performance tests for the dogstatsd server: packets received per second
+depending on the number of worker processes.
+"""
+# stdlib
+import multiprocessing
+import socket
+import time
+
+# project
+import dogstatsd
+from dogstatsd import MetricsBucketAggregator, Reporter, Server, ServerWorker, ShardedServer
+
+
+def send_packets(port, count):
+    client = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    for i in xrange(count):
+        client.sendto('bench.counter:%s|c|#worker' % i, ('127.0.0.1', port))
+    client.close()
+
+
+class TestDogstatsdWorkersPerf(object):
+
+    # Packets sent by each sender process, from its own socket
+    PACKET_COUNT = 100000
+    SENDER_COUNT = 8
+
+    def get_free_port(self):
+        probe = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        probe.bind(('127.0.0.1', 0))
+        port = probe.getsockname()[1]
+        probe.close()
+        return port
+
+    def run_workers(self, worker_count):
+        """ Packets received per second by `worker_count` workers, and the number of packets lost """
+        port = self.get_free_port()
+        merged = MetricsBucketAggregator('my.host')
+        shard_conns = []
+        workers = []
+        for _ in range(worker_count):
+            reporter_conn, worker_conn = multiprocessing.Pipe()
+            shard_conns.append(reporter_conn)
+            workers.append(ServerWorker(Server(MetricsBucketAggregator('my.host'), '127.0.0.1', port,
+                                               reuse_port=True, shard_conn=worker_conn,
+                                               so_rcvbuf=8 * 1024 * 1024)))
+        server = ShardedServer(workers)
+        reporter = Reporter(10, merged, 'http://localhost', shard_conns=shard_conns)
+
+        old_timeout, dogstatsd.UDP_SOCKET_TIMEOUT = dogstatsd.UDP_SOCKET_TIMEOUT, 0.1
+        try:
+            server.start_workers()
+            time.sleep(1)
+
+            start = time.time()
+            senders = [multiprocessing.Process(target=send_packets, args=(port, self.PACKET_COUNT))
+                       for _ in range(self.SENDER_COUNT)]
+            for sender in senders:
+                sender.start()
+            for sender in senders:
+                sender.join()
+            elapsed = time.time() - start
+            # Give the workers the time to drain their sockets
+            time.sleep(1)
+            reporter.merge_shards()
+        finally:
+            server.stop_workers()
+            dogstatsd.UDP_SOCKET_TIMEOUT = old_timeout
+
+        sent = self.PACKET_COUNT * self.SENDER_COUNT
+        return merged.count / elapsed, sent - merged.count
+
+    def test_workers_scaling(self):
+        baseline = None
+        for worker_count in (1, 2, 4):
+            rate, lost = self.run_workers(worker_count)
+            baseline = baseline or rate
+            print "%s worker(s): %d packets/s (x%.2f), %d packets lost" % (
+                worker_count, rate, rate / baseline, lost)
+
+
+if __name__ == '__main__':
+    t = TestDogstatsdWorkersPerf()
+    t.test_workers_scaling()
@@ -0,0 +1,50 @@
+"""
+Performance tests for the forwarder transaction queue.
+"""
+# stdlib
+from datetime import timedelta
+
+# project
+from ddagent import MAX_QUEUE_SIZE
+from transaction import Transaction, TransactionManager
+
+
+class benchTransaction(Transaction):
+    def __init__(self, manager, size, is_flushable):
+        Transaction.__init__(self)
+        self._trManager = manager
+        self._size = size
+        self.is_flushable = is_flushable
+
+    def flush(self):
+        # Don't call flush_next, the manager keeps going on its own as long
+        # as the transaction isn't in flight anymore
+        if self.is_flushable:
+            self._trManager.tr_success(self)
+        else:
+            self._trManager.tr_error(self)
+
+
+class TestTransactionManagerPerf(object):
+
+    QUEUED_COUNT = 100000
+    FLUSH_COUNT = 5
+
+    def test_backlog_perf(self):
+        # No throttling, no delay for replay
+        trManager = TransactionManager(timedelta(seconds=0), MAX_QUEUE_SIZE, timedelta(seconds=0))
+        trManager._flush_without_ioloop = True
+
+        # Enough to overflow the queue and drop a quarter of the backlog
+        size = MAX_QUEUE_SIZE * 4 / (3 * self.QUEUED_COUNT)
+        for i in xrange(self.QUEUED_COUNT):
+            trManager.append(benchTransaction(trManager, size, i % 2 == 0))
+
+        # Half of them fail, and are replayed at each flush
+        for _ in xrange(self.FLUSH_COUNT):
+            trManager.flush()
+
+
+if __name__ == '__main__':
+    t = TestTransactionManagerPerf()
+    t.test_backlog_perf()
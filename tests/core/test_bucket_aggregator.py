@@ -1,6 +1,7 @@
 # -*- coding: utf-8 -*-
 # stdlib
 import random
+import threading
 import time
 import unittest
 
@@ -1027,6 +1028,135 @@ class TestUnitMetricsBucketAggregator(unittest.TestCase):
         nt.assert_equal(h1['points'][0][0], h4['points'][0][0])
         nt.assert_equal(h1['points'][0][0], h5['points'][0][0])
 
+    def test_merge_shards(self):
+        ag_interval = self.interval
+        histogram_aggregates = DEFAULT_HISTOGRAM_AGGREGATES + ['min']
+        reference = MetricsBucketAggregator('myhost', interval=ag_interval,
+            histogram_aggregates=histogram_aggregates)
+        merged = MetricsBucketAggregator('myhost', interval=ag_interval,
+            histogram_aggregates=histogram_aggregates)
+        shards = [MetricsBucketAggregator('myhost', interval=ag_interval,
+            histogram_aggregates=histogram_aggregates) for _ in range(3)]
+
+        packets = []
+        for i in xrange(300):
+            packets.append('my.counter:%s|c|#shard' % i)
+            packets.append('my.sampled.counter:1|c|@0.5')
+            packets.append('my.histogram:%s|h|#host:otherhost' % i)
+            packets.append('my.set:%s|s' % (i % 7))
+            packets.append('my.gauge:%s|g' % i)
+        packets.append('_e{5,4}:title|text')
+        packets.append('_sc|check|0')
+
+        self.wait_for_bucket_boundary(ag_interval)
+        for i, packet in enumerate(packets):
+            reference.submit_packets(packet)
+            shards[i % len(shards)].submit_packets(packet)
+        for shard in shards:
+            merged.merge_shard_state(shard.pop_shard_state())
+
+        # Shards are emptied when handing over their state
+        for shard in shards:
+            nt.assert_equal(shard.metric_by_bucket, {})
+            nt.assert_equal(shard.count, 0)
+
+        self.sleep_for_interval_length(ag_interval)
+        nt.assert_equal(merged.count, reference.count)
+        nt.assert_equal(self.sort_metrics(merged.flush()), self.sort_metrics(reference.flush()))
+        nt.assert_equal(len(merged.flush_events()), 1)
+        nt.assert_equal(len(merged.flush_service_checks()), 1)
+
+    def test_server_workers(self):
+        import socket
+        import dogstatsd
+        from dogstatsd import Reporter, Server, ServerWorker, ShardedServer
+        import multiprocessing
+
+        ag_interval = 2
+        histogram_aggregates = DEFAULT_HISTOGRAM_AGGREGATES + ['min']
+
+        def create_aggregator():
+            return MetricsBucketAggregator('myhost', interval=ag_interval,
+                histogram_aggregates=histogram_aggregates)
+
+        probe = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        probe.bind(('127.0.0.1', 0))
+        port = probe.getsockname()[1]
+        probe.close()
+
+        reference = create_aggregator()
+        merged = create_aggregator()
+        shard_conns = []
+        workers = []
+        for _ in range(2):
+            reporter_conn, worker_conn = multiprocessing.Pipe()
+            shard_conns.append(reporter_conn)
+            workers.append(ServerWorker(Server(create_aggregator(), '127.0.0.1', port,
+                                               reuse_port=True, shard_conn=worker_conn)))
+        server = ShardedServer(workers)
+        reporter = Reporter(10, merged, 'http://localhost', shard_conns=shard_conns)
+
+        old_timeout, dogstatsd.UDP_SOCKET_TIMEOUT = dogstatsd.UDP_SOCKET_TIMEOUT, 0.1
+        try:
+            server.start_workers()
+            # Let them bind the port
+            time.sleep(1)
+
+            packets = []
+            for i in xrange(200):
+                packets.append('my.counter:%s|c|#shard' % i)
+                packets.append('my.histogram:%s|h|#host:otherhost' % i)
+                packets.append('my.set:%s|s' % (i % 7))
+
+            # Several client sockets, so that the kernel spreads them over the workers
+            clients = [socket.socket(socket.AF_INET, socket.SOCK_DGRAM) for _ in range(10)]
+            self.wait_for_bucket_boundary(ag_interval)
+            for i, packet in enumerate(packets):
+                reference.submit_packets(packet)
+                clients[i % len(clients)].sendto(packet, ('127.0.0.1', port))
+            for client in clients:
+                client.close()
+            time.sleep(0.5)
+
+            reporter.merge_shards()
+        finally:
+            server.stop_workers()
+            dogstatsd.UDP_SOCKET_TIMEOUT = old_timeout
+
+        nt.assert_false(any(worker.is_alive() for worker in workers))
+        self.sleep_for_interval_length(ag_interval)
+        nt.assert_equal(merged.count, reference.count)
+        nt.assert_equal(self.sort_metrics(merged.flush()), self.sort_metrics(reference.flush()))
+
+    def test_flush_during_ingest(self):
+        # Flushing from another thread while packets are submitted must not
+        # lose nor count twice any of them
+        stats = MetricsBucketAggregator('myhost', interval=self.interval)
+        packets = '\n'.join(['my.counter:1|c', 'my.set:1|s', 'my.histogram:1|h'])
+        nb_submits = 20000
+
+        def ingest():
+            for _ in xrange(nb_submits):
+                stats.submit_packets(packets)
+
+        ingest_thread = threading.Thread(target=ingest)
+        ingest_thread.start()
+        metrics = []
+        while ingest_thread.is_alive():
+            metrics += stats.flush()
+            time.sleep(0.01)
+        ingest_thread.join()
+        self.sleep_for_interval_length()
+        metrics += stats.flush()
+
+        counter_total = sum(m['points'][0][1] for m in metrics if m['metric'] == 'my.counter')
+        nt.assert_equal(counter_total, nb_submits)
+        histogram_total = sum(m['points'][0][1] for m in metrics if m['metric'] == 'my.histogram.count')
+        nt.assert_equal(histogram_total, nb_submits)
+        # One set point per bucket, whichever flush swapped it out
+        set_buckets = [m['points'][0][0] for m in metrics if m['metric'] == 'my.set']
+        nt.assert_equal(len(set_buckets), len(set(set_buckets)))
+
     def test_calculate_bucket_start(self):
         stats = MetricsBucketAggregator('myhost', interval=10)
         nt.assert_equal(stats.calculate_bucket_start(13284283), 13284280)
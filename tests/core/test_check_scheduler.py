@@ -0,0 +1,86 @@
+# stdlib
+import unittest
+
+# project
+from checks import AgentCheck
+from checks.scheduler import CheckScheduler, next_run_time
+
+
+class DummyCheck(AgentCheck):
+    def check(self, instance):
+        self.gauge('dummy.metric', 1, tags=['instance:%s' % instance['name']])
+
+
+def make_check(instances):
+    return DummyCheck('dummy', {}, {}, instances)
+
+
+class CheckSchedulerTestCase(unittest.TestCase):
+
+    def test_next_run_time(self):
+        # On time or early, the next run is one interval later
+        self.assertEqual(next_run_time(100, 15, 100), 115)
+        self.assertEqual(next_run_time(100, 15, 99), 115)
+        # Late, the runs stay aligned on the initial schedule
+        self.assertEqual(next_run_time(100, 15, 104), 115)
+        # Missed runs are skipped
+        self.assertEqual(next_run_time(100, 15, 131), 145)
+
+    def test_instance_intervals(self):
+        check = make_check([
+            {'name': 'default'},
+            {'name': 'slow', 'min_collection_interval': 60},
+        ])
+        scheduler = CheckScheduler(15)
+        scheduler.set_checks([check], now=0)
+
+        runs = {}
+        for now in xrange(0, 121, 5):
+            for i, _ in scheduler.pop_due(now).get(check, []):
+                runs.setdefault(i, []).append(now)
+
+        self.assertEqual(runs[0], range(0, 121, 15))
+        self.assertEqual(runs[1], [0, 60, 120])
+        self.assertEqual(scheduler.get_next_run_time(), 135)
+
+    def test_lag_and_drift(self):
+        check = make_check([{'name': 'default'}])
+        scheduler = CheckScheduler(15)
+        scheduler.set_checks([check], now=0)
+        scheduler.pop_due(0)
+
+        # Popped late, the lag is reported but doesn't delay the next runs
+        self.assertEqual(scheduler.pop_due(10), {})
+        self.assertEqual(scheduler.pop_due(18), {check: [(0, 3)]})
+        self.assertEqual(scheduler.get_next_run_time(), 30)
+
+        # Way too late, the missed runs are skipped
+        self.assertEqual(scheduler.pop_due(70), {check: [(0, 40)]})
+        self.assertEqual(scheduler.get_next_run_time(), 75)
+
+    def test_removed_checks(self):
+        check = make_check([{'name': 'default'}])
+        scheduler = CheckScheduler(15)
+        scheduler.set_checks([check], now=0)
+        scheduler.set_checks([], now=0)
+
+        self.assertEqual(scheduler.pop_due(0), {})
+        self.assertEqual(scheduler.get_next_run_time(), None)
+
+    def test_run_instance_indexes(self):
+        check = make_check([
+            {'name': 'first', 'min_collection_interval': 60},
+            {'name': 'second', 'min_collection_interval': 60},
+        ])
+
+        statuses = check.run(instance_indexes=[1])
+        self.assertEqual([s.instance_id for s in statuses], [1])
+        self.assertEqual([m[3]['tags'] for m in check.get_metrics()], [['instance:second']])
+
+        # Scheduled runs don't depend on when the instance last ran
+        statuses = check.run(instance_indexes=[0, 1])
+        self.assertEqual([s.instance_id for s in statuses], [0, 1])
+        check.get_metrics()
+
+        # Unscheduled runs still skip the instances which ran too recently
+        self.assertEqual(check.run(), [])
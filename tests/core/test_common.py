@@ -22,6 +22,12 @@ from utils.proxy import get_proxy
 logger = logging.getLogger()
 
 
+class SleepCheck(AgentCheck):
+    def check(self, instance):
+        time.sleep(instance['sleep'])
+        self.gauge('sleep.time', instance['sleep'])
+
+
 class TestCore(unittest.TestCase):
     "Tests to validate the core check logic"
 
@@ -179,6 +185,69 @@ class TestCore(unittest.TestCase):
             tag = "check:%s" % check.name
             assert tag in all_tags, all_tags
 
+    def test_parallel_checks(self):
+        agentConfig = {
+            'api_key': 'test_apikey',
+            'check_runners': 3,
+            'check_timeout': 1,
+            'check_freq': 1,
+            'collect_ec2_tags': False,
+            'collect_instance_metadata': False,
+            'create_dd_check_tags': False,
+            'version': 'test',
+            'tags': '',
+        }
+        checks = [SleepCheck('sleep%s' % i, {}, agentConfig, instances=[{'sleep': sleep}])
+                  for i, sleep in enumerate([0.5, 0.5, 2])]
+
+        c = Collector(agentConfig, [], {}, 'foo')
+        c.initialized_checks_d = checks
+        c._scheduler.set_checks(checks)
+        try:
+            # Checks run in parallel, up to the timeout
+            start = time.time()
+            results = list(c._run_checks_d())
+            self.assertTrue(time.time() - start < 1.5)
+            self.assertEquals([check for check, _ in results], checks)
+            for _, result in results[:2]:
+                self.assertEquals(len(result[1]), 1)
+            self.assertTrue(results[2][1] is None)
+
+            # The slow check isn't run again, its result comes with the next run
+            time.sleep(1.5)
+            results = list(c._run_checks_d())
+            for _, result in results:
+                self.assertEquals(len(result[1]), 1)
+            self.assertEquals(results[2][1][1][0][2], 2)
+        finally:
+            c.stop()
+
+    def test_queued_check_timeout(self):
+        agentConfig = {
+            'api_key': 'test_apikey',
+            'check_runners': 2,
+            'check_timeout': 1,
+            'check_freq': 1,
+            'collect_ec2_tags': False,
+            'collect_instance_metadata': False,
+            'create_dd_check_tags': False,
+            'version': 'test',
+            'tags': '',
+        }
+        checks = [SleepCheck('sleep%s' % i, {}, agentConfig, instances=[{'sleep': sleep}])
+                  for i, sleep in enumerate([0.8, 0.8, 0.8])]
+
+        c = Collector(agentConfig, [], {}, 'foo')
+        c.initialized_checks_d = checks
+        c._scheduler.set_checks(checks)
+        try:
+            # The third check waits for a runner, its timeout starts when it runs
+            results = list(c._run_checks_d())
+            for _, result in results:
+                self.assertEquals(len(result[1]), 1)
+        finally:
+            c.stop()
+
     def test_apptags(self):
         '''
         Tests that the app tags are sent if specified so
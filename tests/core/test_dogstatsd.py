@@ -1,6 +1,7 @@
 # -*- coding: utf-8 -*-
 # stdlib
 import random
+import tempfile
 import time
 import unittest
 
@@ -9,7 +10,8 @@ from nose.plugins.attrib import attr
 import nose.tools as nt
 
 # project
-from aggregator import DEFAULT_HISTOGRAM_AGGREGATES, get_formatter, MetricsAggregator
+import aggregator
+from aggregator import DEFAULT_HISTOGRAM_AGGREGATES, get_formatter, MetricsAggregator, MetricsBucketAggregator
 
 
 class TestUnitDogStatsd(unittest.TestCase):
@@ -170,6 +172,57 @@ class TestUnitDogStatsd(unittest.TestCase):
         serialized = dogstatsd.serialize_metrics([api_formatter("foo", 12, 1, ('tag',), 'host')], "test-host")
         assert '"tags": ["tag"]' in serialized[0]
 
+    def test_serialize_metrics_payloads(self):
+        import json
+        import zlib
+        import dogstatsd
+        from aggregator import api_formatter
+
+        metrics = [api_formatter("my.metric.%s" % i, i, 1, ('tag:%s' % random.random(),), 'host')
+                   for i in xrange(2000)]
+        payloads = list(dogstatsd.serialize_metrics_payloads(metrics, "test-host", max_payload_size=8192))
+        assert len(payloads) > 1
+
+        series = []
+        for body, headers in payloads:
+            assert len(body) <= 8192
+            nt.assert_equal(headers['Content-Encoding'], 'deflate')
+            series.extend(json.loads(zlib.decompress(body))['series'])
+
+        # Every series is sent once, the serialization status closes the last payload
+        nt.assert_equal([s['metric'] for s in series[:-1]], [m['metric'] for m in metrics])
+        nt.assert_equal(series[-1]['metric'], 'datadog.dogstatsd.serialization_status')
+        nt.assert_equal(series[-1]['tags'], ['status:success'])
+        nt.assert_equal(len(metrics), 2000)
+
+    def test_serialize_metrics_payloads_small(self):
+        import json
+        import dogstatsd
+        from aggregator import api_formatter
+
+        payloads = list(dogstatsd.serialize_metrics_payloads([api_formatter("foo", 12, 1, None, 'host')], "test-host"))
+        nt.assert_equal(len(payloads), 1)
+        body, headers = payloads[0]
+        assert 'Content-Encoding' not in headers
+        nt.assert_equal([s['metric'] for s in json.loads(body)['series']],
+                        ['foo', 'datadog.dogstatsd.serialization_status'])
+
+    def test_serialize_metrics_payloads_bad_series(self):
+        import json
+        import dogstatsd
+        from aggregator import api_formatter
+
+        metrics = [api_formatter("foo", 1, 1, None, 'host'),
+                   api_formatter("bar", 2, 1, ('tag:\xe9',), 'host')]
+        body, _ = dogstatsd.serialize_metrics(metrics, "test-host")
+        series = json.loads(body)['series']
+
+        # Only the bad series is fixed
+        nt.assert_equal([s['metric'] for s in series[:2]], ['foo', 'bar'])
+        nt.assert_equal(series[1]['tags'], [u'tag:\ufffd'])
+        nt.assert_equal(sorted(s['tags'][0] for s in series[2:]),
+                        ['status:failure', 'status:success'])
+
     def test_counter(self):
         stats = MetricsAggregator('myhost')
 
@@ -832,6 +885,254 @@ class TestUnitDogStatsd(unittest.TestCase):
         nt.assert_equals(third['metric'], 'line_ending.windows')
         nt.assert_equals(third['points'][0][1], 300)
 
+    def test_parse_metric_packet(self):
+        stats = MetricsAggregator('myhost')
+
+        nt.assert_equal(stats.parse_metric_packet('my.count:3|c'),
+            [('my.count', 3, 'c', None, None, None, 1)])
+        nt.assert_equal(stats.parse_metric_packet('my.gauge:-1.5|g|@0.5|#b:x,a,host:h,device:d'),
+            [('my.gauge', -1.5, 'g', 'h', 'd', ('a', 'b:x'), 0.5)])
+        # Several values, with tags containing ':'
+        nt.assert_equal(stats.parse_metric_packet('my.hist:1|h|#url:http://a:2|ms|#b:c'),
+            [('my.hist', 1, 'h', None, None, ('url:http://a',), 1),
+             ('my.hist', 2, 'ms', None, None, ('b:c',), 1)])
+
+    def test_tags_cache(self):
+        stats = MetricsAggregator('myhost')
+
+        for _ in range(2):
+            stats.submit_packets('my.count:1|c|#tag2,tag1,host:otherhost')
+            stats.submit_packets('my.count:1|c|#tag1,tag2,host:otherhost')
+        nt.assert_equal(len(stats._tags_cache), 2)
+
+        metrics = stats.flush()
+        nt.assert_equal(len(metrics), 1)
+        nt.assert_equal(metrics[0]['tags'], ('tag1', 'tag2'))
+        nt.assert_equal(metrics[0]['host'], 'otherhost')
+        nt.assert_equal(metrics[0]['points'][0][1], 4)
+
+        # The cache is bounded
+        for i in xrange(aggregator.TAGS_CACHE_SIZE + 1):
+            stats.submit_packets('my.count:1|c|#tag:%s' % i)
+        assert len(stats._tags_cache) <= aggregator.TAGS_CACHE_SIZE
+
+    def test_context_registry(self):
+        registry = aggregator.ContextRegistry(expiry_seconds=300, max_size=2)
+
+        context = registry.get_context('my.metric', ['b', 'a', 'b'], 'myhost', None)
+        nt.assert_equal(context, ('my.metric', ('a', 'b'), 'myhost', None))
+        # Known contexts are interned
+        assert registry.get_context('my.metric', ('b', 'a', 'b'), 'myhost', None) is context
+        nt.assert_equal(registry.get_context('my.metric', None, 'myhost', None),
+                        ('my.metric', (), 'myhost', None))
+
+        # A full generation is rotated, its contexts can still be found once
+        registry.get_context('other.metric', None, 'myhost', None)
+        nt.assert_equal(len(registry), 1)
+        assert registry.get_context('my.metric', ['b', 'a', 'b'], 'myhost', None) is context
+
+        # Contexts unused for expiry_seconds are forgotten
+        registry.expire(time.time() + 301)
+        registry.expire(time.time() + 602)
+        assert registry.get_context('my.metric', ['b', 'a', 'b'], 'myhost', None) is not context
+
+    def test_metric_by_raw_key(self):
+        # Known series resolve straight to their metric, whatever the order of their tags
+        stats = MetricsBucketAggregator('myhost', interval=10)
+        stats.submit_metric('my.counter', 1, 'c', tags=['b', 'a'], timestamp=time.time())
+        stats.submit_metric('my.counter', 2, 'c', tags=['a', 'b'], timestamp=time.time())
+        stats.submit_metric('my.counter', 3, 'c', tags=('b', 'a'), timestamp=time.time())
+        table, bucket, metric_by_context, metric_by_raw_key = stats.current_bucket
+        nt.assert_equal(len(metric_by_context), 1)
+        nt.assert_equal(len(metric_by_raw_key), 2)
+        metric = metric_by_context.values()[0]
+        assert all(m is metric for m in metric_by_raw_key.itervalues())
+
+        # They're dropped when the bucket rolls
+        stats.submit_metric('my.counter', 4, 'c', tags=['b', 'a'], timestamp=bucket - 5)
+        nt.assert_equal(stats.current_bucket[3].values(), [stats.metric_by_bucket[bucket - 10].values()[0]])
+        metrics = self.sort_metrics(stats.flush())
+        # Only the past bucket is due
+        nt.assert_equal([m['points'][0][1] for m in metrics], [0.4])
+
+        stats = MetricsAggregator('myhost')
+        stats.submit_metric('my.gauge', 1, 'g', tags=['b', 'a'])
+        stats.submit_metric('my.gauge', 2, 'g', tags=['a', 'b'])
+        nt.assert_equal(len(stats.metrics), 1)
+        nt.assert_equal(len(stats._metric_by_raw_key), 2)
+        # And when metrics expire
+        stats.submit_metric('old.gauge', 1, 'g')
+        stats.metrics[('old.gauge', (), 'myhost', None)].last_sample_time = 0
+        stats.flush()
+        nt.assert_equal(stats._metric_by_raw_key, {})
+
+    def test_packet_batch(self):
+        stats = MetricsAggregator('myhost')
+
+        stats.submit_packet_batch([
+            'batch.first:1|c',
+            'batch.bad:1|c|@2',
+            'batch.second:2|c\nbatch.third:3|c',
+        ])
+
+        metrics = self.sort_metrics(stats.flush())
+
+        # The bad datagram is skipped, not the rest of the batch
+        nt.assert_equal([m['metric'] for m in metrics], ['batch.first', 'batch.second', 'batch.third'])
+        nt.assert_equal([m['points'][0][1] for m in metrics], [1, 2, 3])
+
+    def test_udp_drop_count(self):
+        from dogstatsd import get_udp_drop_count
+
+        proc_net_udp = tempfile.NamedTemporaryFile()
+        proc_net_udp.write(
+            "   sl  local_address rem_address   st tx_queue rx_queue tr tm->when retrnsmt   uid  timeout inode ref pointer drops\n"
+            "  135: 0100007F:1FBD 00000000:0000 07 00000000:00000000 00:00000000 00000000   999        0 16403 2 ffff880036c4d840 12\n"
+            "  135: 00000000:1FBD 00000000:0000 07 00000000:00000000 00:00000000 00000000   999        0 16404 2 ffff880036c4d880 30\n"
+            "  230: 00000000:0044 00000000:0000 07 00000000:00000000 00:00000000 00000000     0        0 10948 2 ffff880036c4d8c0 7\n"
+        )
+        proc_net_udp.flush()
+
+        nt.assert_equal(get_udp_drop_count(8125, proc_net_udp.name), 42)
+        nt.assert_equal(get_udp_drop_count(8126, proc_net_udp.name), 0)
+        nt.assert_equal(get_udp_drop_count(8125, '/does/not/exist'), None)
+
+    def test_unix_socket_listener(self):
+        import os
+        import shutil
+        import socket
+        import stat
+        import threading
+        import dogstatsd
+
+        socket_dir = tempfile.mkdtemp()
+        socket_path = os.path.join(socket_dir, 'dogstatsd.sock')
+        stats = MetricsAggregator('myhost')
+        server = dogstatsd.Server(stats, '127.0.0.1', 0, socket_path=socket_path, socket_mode=0700)
+        old_timeout, dogstatsd.UDP_SOCKET_TIMEOUT = dogstatsd.UDP_SOCKET_TIMEOUT, 0.1
+        thread = threading.Thread(target=server.start)
+        thread.start()
+        try:
+            for _ in range(50):
+                if server.unix_socket is not None:
+                    break
+                time.sleep(0.1)
+            nt.assert_equal(stat.S_IMODE(os.stat(socket_path).st_mode), 0700)
+
+            client = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+            client.sendto('unix.counter:1|c', socket_path)
+            client.sendto('unix.counter:2|c', socket_path)
+            client.close()
+            client = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            client.sendto('udp.counter:3|c', server.socket.getsockname())
+            client.close()
+
+            for _ in range(50):
+                if sum(stats.listener_packet_counts.values()) == 3:
+                    break
+                time.sleep(0.1)
+        finally:
+            server.stop()
+            thread.join()
+            dogstatsd.UDP_SOCKET_TIMEOUT = old_timeout
+
+        # Both listeners feed the same aggregator, and are counted apart
+        nt.assert_equal(stats.listener_packet_counts, {'unix': 2, 'udp': 1})
+        metrics = self.sort_metrics(stats.flush())
+        nt.assert_equal([(m['metric'], m['points'][0][1]) for m in metrics],
+                        [('udp.counter', 3), ('unix.counter', 3)])
+
+        # The socket is removed on exit
+        assert not os.path.exists(socket_path)
+        shutil.rmtree(socket_dir)
+
+    def test_coalesce_packets(self):
+        from dogstatsd import coalesce_packets
+
+        messages = ['a:1|c', 'b:2|c\n', '', 'c:3|c', 'x' * 20, 'd:4|c']
+        nt.assert_equal(list(coalesce_packets(messages, max_size=12)),
+                        ['a:1|c\nb:2|c', 'c:3|c', 'x' * 20, 'd:4|c'])
+        nt.assert_equal(list(coalesce_packets([])), [])
+
+    def test_statsd_forwarder(self):
+        import socket
+        import threading
+        import dogstatsd
+
+        upstream = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        upstream.bind(('127.0.0.1', 0))
+        upstream.settimeout(5)
+
+        forwarder = dogstatsd.StatsdForwarder('127.0.0.1', upstream.getsockname()[1], queue_size=16)
+        # Nothing is sent yet, what doesn't fit in the 16 bytes of the queue is dropped
+        forwarder.enqueue(['a:1|c', 'b:2|c'])
+        forwarder.enqueue(['c:3|c', 'd:4|c'])
+        nt.assert_equal(forwarder.dropped_count, 1)
+        nt.assert_equal(forwarder.pop_counts(), (0, 1))
+
+        forwarder.start()
+        try:
+            nt.assert_equal(upstream.recv(dogstatsd.FORWARD_PACKET_SIZE), 'a:1|c\nb:2|c\nc:3|c')
+        finally:
+            forwarder.stop()
+            forwarder.join(5)
+        nt.assert_equal(forwarder.forwarded_count, 3)
+        nt.assert_equal(forwarder.pop_counts(), (3, 0))
+
+        # What's queued when the forwarder is stopped is still sent
+        forwarder = dogstatsd.StatsdForwarder('127.0.0.1', upstream.getsockname()[1])
+        forwarder.enqueue(['e:5|c'])
+        forwarder.stop()
+        forwarder.start()
+        forwarder.join(5)
+        try:
+            assert not forwarder.is_alive()
+            nt.assert_equal(upstream.recv(dogstatsd.FORWARD_PACKET_SIZE), 'e:5|c')
+        finally:
+            upstream.close()
+        nt.assert_equal(forwarder.forwarded_count, 1)
+
+        # The server waits for its forwarder to send what's left when it stops
+        upstream = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        upstream.bind(('127.0.0.1', 0))
+        upstream.settimeout(5)
+        stats = MetricsAggregator('myhost')
+        server = dogstatsd.Server(stats, '127.0.0.1', 0, forward_to_host='127.0.0.1',
+                                  forward_to_port=upstream.getsockname()[1])
+        old_timeout, dogstatsd.UDP_SOCKET_TIMEOUT = dogstatsd.UDP_SOCKET_TIMEOUT, 0.1
+        thread = threading.Thread(target=server.start)
+        thread.start()
+        try:
+            for _ in range(50):
+                if getattr(server, 'socket', None) is not None:
+                    break
+                time.sleep(0.1)
+            client = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            client.sendto('f:6|c', server.socket.getsockname())
+            client.close()
+            for _ in range(50):
+                if stats.listener_packet_counts:
+                    break
+                time.sleep(0.1)
+        finally:
+            server.stop()
+            thread.join()
+            dogstatsd.UDP_SOCKET_TIMEOUT = old_timeout
+        try:
+            assert not server.forwarder.is_alive()
+            nt.assert_equal(upstream.recv(dogstatsd.FORWARD_PACKET_SIZE), 'f:6|c')
+        finally:
+            upstream.close()
+
+        # The counts are handed over with the aggregator shards
+        shard = MetricsBucketAggregator('myhost')
+        shard.count_forwarded_packets(3, 1)
+        stats = MetricsBucketAggregator('myhost')
+        stats.count_forwarded_packets(1, 0)
+        stats.merge_shard_state(shard.pop_shard_state())
+        nt.assert_equal((stats.forwarded_count, stats.forward_dropped_count), (4, 1))
+        nt.assert_equal((shard.forwarded_count, shard.forward_dropped_count), (0, 0))
+
     def test_no_proxy(self):
         """ Starting with Agent 5.0.0, there should always be a local forwarder
         running and all payloads should go through it. So we should make sure
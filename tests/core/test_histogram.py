@@ -1,9 +1,16 @@
 # stdlib
+import random
 import unittest
 
 # project
-from aggregator import Histogram, MetricsAggregator
-from config import get_histogram_aggregates, get_histogram_percentiles
+from aggregator import (
+    Histogram,
+    MetricsAggregator,
+    QuantileSketch,
+    SKETCH_RELATIVE_ACCURACY,
+    SketchHistogram,
+)
+from config import get_histogram_aggregates, get_histogram_backend, get_histogram_percentiles
 
 class TestHistogram(unittest.TestCase):
     def test_default(self):
@@ -151,3 +158,64 @@ class TestHistogram(unittest.TestCase):
         self.assertEquals(value_by_type['median'], 9, value_by_type)
         self.assertEquals(value_by_type['max'], 19, value_by_type)
         self.assertEquals(value_by_type['95percentile'], 18, value_by_type)
+
+    def test_backend_config(self):
+        self.assertEquals(get_histogram_backend(' Sketch'), 'sketch')
+        self.assertEquals(get_histogram_backend('exact'), 'exact')
+        self.assertEquals(get_histogram_backend('tdigest'), None)
+
+        stats = MetricsAggregator('myhost', histogram_backend='sketch')
+        stats.submit_packets('myhistogram:1|h')
+        self.assertTrue(isinstance(stats.metrics.values()[0], SketchHistogram))
+
+    def test_sketch_backend(self):
+        stats = MetricsAggregator(
+            'myhost',
+            histogram_backend='sketch',
+            histogram_aggregates=get_histogram_aggregates('min, max, median, avg, count'),
+            histogram_percentiles=get_histogram_percentiles('0.5, 0.95, 0.99')
+        )
+
+        random.seed(1)
+        samples = [random.lognormvariate(3, 2) for _ in xrange(10000)]
+        samples += [-value for value in samples[:500]] + [0] * 100
+        for value in samples:
+            stats.submit_packets('myhistogram:%r|ms' % value)
+
+        metrics = stats.flush()
+        self.assertEquals(len(metrics), 8, metrics)
+        value_by_type = {}
+        for k in metrics:
+            value_by_type[k['metric'][len('myhistogram')+1:]] = k['points'][0][1]
+
+        # Same values as the exact histogram, to the relative accuracy of the sketch
+        samples.sort()
+        length = len(samples)
+        self.assertEquals(value_by_type['min'], samples[0])
+        self.assertEquals(value_by_type['max'], samples[-1])
+        self.assertAlmostEquals(value_by_type['avg'], sum(samples) / length)
+        self.assertEquals(value_by_type['count'], length)
+        expected = {
+            'median': samples[length / 2 - 1],
+            '50percentile': samples[int(round(0.5 * length - 1))],
+            '95percentile': samples[int(round(0.95 * length - 1))],
+            '99percentile': samples[int(round(0.99 * length - 1))],
+        }
+        for name, value in expected.iteritems():
+            self.assertTrue(abs(value_by_type[name] - value) <= SKETCH_RELATIVE_ACCURACY * abs(value),
+                            (name, value_by_type[name], value))
+
+    def test_sketch_merge_and_bounded_memory(self):
+        sketch, other = QuantileSketch(max_bins=64), QuantileSketch(max_bins=64)
+        for i in xrange(1, 10001):
+            sketch.add(i)
+            other.add(i * 1000.0)
+        self.assertEquals(len(sketch.positive_bins), 64)
+
+        sketch.merge(other)
+        self.assertEquals(len(sketch.positive_bins), 64)
+        self.assertEquals(sketch.count, 20000)
+        self.assertEquals((sketch.min, sketch.max), (1, 10000000.0))
+        # Collapsing only affects the lowest values
+        p99 = sketch.values_at_ranks([19799])[0]
+        self.assertTrue(abs(p99 - 9800000) <= SKETCH_RELATIVE_ACCURACY * 9800000, p99)
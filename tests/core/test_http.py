@@ -0,0 +1,55 @@
+# stdlib
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+import threading
+import unittest
+
+# project
+from utils.http import HTTPSession
+
+
+class OkHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.getheader('Content-Length', 0)))
+        self.send_response(202)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+class HTTPSessionTestCase(unittest.TestCase):
+    def setUp(self):
+        self.server = HTTPServer(('127.0.0.1', 0), OkHandler)
+        self.url = 'http://127.0.0.1:%s/intake' % self.server.server_port
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_keep_alive(self):
+        session = HTTPSession()
+        self.assertEqual(session.get_stats()['avg_latency_ms'], None)
+        for _ in range(3):
+            self.assertEqual(session.post(self.url, data='{}').status_code, 202)
+
+        stats = session.get_stats()
+        self.assertEqual(stats['request_count'], 3)
+        self.assertEqual(stats['reused_connection_count'], 2)
+        self.assertTrue(stats['avg_latency_ms'] >= 0)
+        session.close()
+
+    def test_no_keep_alive(self):
+        session = HTTPSession(keep_alive=False)
+        for _ in range(3):
+            session.post(self.url, data='{}')
+
+        stats = session.get_stats()
+        self.assertEqual(stats['request_count'], 3)
+        self.assertEqual(stats['reused_connection_count'], 0)
+        session.close()
@@ -0,0 +1,83 @@
+# stdlib
+import copy
+import pickle
+import unittest
+
+# project
+from checks import AgentCheck
+from checks.instance_config import freeze, FrozenDict, thaw
+
+
+class MutatingCheck(AgentCheck):
+    def check(self, instance):
+        instance['name'] = instance.get('name', 'default')
+        instance['tags'].append('run')
+        instance['metrics'][0]['name'] = 'changed'
+        instance.setdefault('timeout', 5)
+        self.gauge('metric.count', len(instance['metrics']), tags=instance['tags'])
+
+
+class InstanceConfigTestCase(unittest.TestCase):
+
+    INSTANCE = {
+        'host': 'localhost',
+        'tags': ['foo:bar'],
+        'metrics': [{'name': 'metric', 'oid': '1.3.6.1'}],
+        'options': {'nested': {'list': [1, 2]}},
+    }
+
+    def test_frozen(self):
+        frozen = freeze(self.INSTANCE)
+        self.assertTrue(isinstance(frozen, FrozenDict))
+        self.assertRaises(TypeError, frozen.__setitem__, 'host', 'other')
+        self.assertRaises(TypeError, frozen['metrics'][0].update, {'name': 'other'})
+        self.assertEqual(frozen['options']['nested']['list'], (1, 2))
+        self.assertTrue(copy.deepcopy(frozen) is frozen)
+
+    def test_thaw(self):
+        frozen = freeze(self.INSTANCE)
+
+        instance = thaw(frozen)
+        instance['host'] = 'other'
+        instance['tags'].append('new:tag')
+        instance['metrics'][0]['name'] = 'other'
+        instance.get('options')['nested']['list'].append(3)
+        del instance['metrics']
+        self.assertEqual(instance.pop('options'), {'nested': {'list': [1, 2, 3]}})
+        self.assertEqual(instance, {'host': 'other', 'tags': ['foo:bar', 'new:tag']})
+
+        # The frozen instance isn't changed, a new copy sees the original config
+        instance = thaw(frozen)
+        self.assertEqual(instance, self.INSTANCE)
+        self.assertEqual(pickle.loads(pickle.dumps(instance)), self.INSTANCE)
+
+    def test_plain_copies(self):
+        # Copies of the instance made by the checks hold plain lists and dicts
+        instance = thaw(freeze(self.INSTANCE))
+        for copied in (dict(instance), dict(**instance), copy.copy(instance)):
+            self.assertTrue(isinstance(copied['tags'], list))
+            self.assertTrue(type(copied['options']) is dict)
+            copied['tags'].append('copied')
+            copied.get('options')['nested']['list'].append(3)
+        other = {}
+        other.update(instance)
+        other.get('metrics').append({'name': 'other'})
+        self.assertEqual(instance['tags'], ['foo:bar', 'copied', 'copied', 'copied'])
+        self.assertEqual(len(instance['metrics']), 2)
+
+    def test_check_runs(self):
+        instance = copy.deepcopy(self.INSTANCE)
+        check = MutatingCheck('mutating', {}, {}, [instance])
+        for _ in xrange(2):
+            check.run()
+            check.last_collection_time[0] = 0
+            metrics = check.get_metrics()
+            self.assertEqual(metrics[0][3]['tags'], ['foo:bar', 'run'])
+
+        # The check didn't change its configuration
+        self.assertEqual(instance, self.INSTANCE)
+
+        # Unless the instances are replaced, they're frozen at the first run
+        check.instances = [dict(self.INSTANCE, tags=['other'])]
+        check.run()
+        self.assertEqual(check.get_metrics()[0][3]['tags'], ['other', 'run'])
@@ -0,0 +1,78 @@
+# stdlib
+import os
+import shutil
+import tempfile
+import unittest
+
+# project
+from utils.proc_snapshot import get_proc_snapshot, invalidate_proc_snapshots, ProcSnapshot
+
+
+def count_lines(lines):
+    count_lines.calls += 1
+    return len(lines)
+
+
+count_lines.calls = 0
+
+
+class ProcSnapshotTestCase(unittest.TestCase):
+    def setUp(self):
+        self.procfs_path = tempfile.mkdtemp()
+        self.write('stat', 'cpu  1 2 3 4\nbtime 1000\n')
+        for pid, cgroup in ((1, '4:cpuacct:/\n'), (42, '4:cpu,cpuacct:/docker/abc\n')):
+            os.mkdir(os.path.join(self.procfs_path, str(pid)))
+            self.write('%s/cgroup' % pid, cgroup)
+        count_lines.calls = 0
+
+    def tearDown(self):
+        shutil.rmtree(self.procfs_path)
+
+    def write(self, source, content):
+        with open(os.path.join(self.procfs_path, source), 'w') as f:
+            f.write(content)
+
+    def test_read_once(self):
+        snapshot = ProcSnapshot(self.procfs_path)
+        self.assertEqual(snapshot.get('stat'), ['cpu  1 2 3 4\n', 'btime 1000\n'])
+
+        # Changes aren't seen until the source is invalidated
+        self.write('stat', 'cpu  5 6 7 8\n')
+        self.assertEqual(len(snapshot.get('stat')), 2)
+        self.assertEqual(snapshot.get('stat', count_lines), 2)
+        self.assertEqual(snapshot.get('stat', count_lines), 2)
+        self.assertEqual(count_lines.calls, 1)
+
+        snapshot.invalidate('stat')
+        self.assertEqual(snapshot.get('stat', count_lines), 1)
+        self.assertEqual(count_lines.calls, 2)
+
+    def test_max_age(self):
+        snapshot = ProcSnapshot(self.procfs_path)
+        snapshot.get('stat')
+        self.write('stat', 'cpu  5 6 7 8\n')
+        self.assertEqual(len(snapshot.get('stat', max_age=60)), 2)
+        self.assertEqual(len(snapshot.get('stat', max_age=0)), 1)
+
+    def test_errors_not_cached(self):
+        snapshot = ProcSnapshot(self.procfs_path)
+        self.assertRaises(IOError, snapshot.get, 'net/dev')
+        os.mkdir(os.path.join(self.procfs_path, 'net'))
+        self.write('net/dev', 'header\n')
+        self.assertEqual(snapshot.get('net/dev'), ['header\n'])
+
+    def test_pid_cgroups(self):
+        snapshot = ProcSnapshot(self.procfs_path)
+        self.assertEqual(snapshot.get('pid_cgroups'), {
+            1: ['4:cpuacct:/\n'],
+            42: ['4:cpu,cpuacct:/docker/abc\n'],
+        })
+
+    def test_shared_snapshots(self):
+        snapshot = get_proc_snapshot(self.procfs_path)
+        self.assertTrue(get_proc_snapshot(self.procfs_path + '/') is snapshot)
+
+        snapshot.get('stat')
+        self.write('stat', 'cpu  5 6 7 8\n')
+        invalidate_proc_snapshots()
+        self.assertEqual(len(snapshot.get('stat')), 1)
@@ -0,0 +1,103 @@
+# stdlib
+import os
+import shutil
+import tempfile
+import unittest
+
+# project
+from utils.spill_queue import RECORD_HEADER, SpillQueue
+
+
+class SpillQueueTest(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def segment_files(self):
+        return sorted(os.listdir(self.path))
+
+    def test_fifo_across_segments(self):
+        queue = SpillQueue(self.path, 1024 * 1024, segment_size=64)
+        payloads = ['payload %s' % i for i in xrange(20)]
+        for payload in payloads:
+            queue.append(payload)
+
+        self.assertEqual(len(queue), 20)
+        self.assertTrue(len(self.segment_files()) > 1)
+        self.assertEqual([queue.popleft() for _ in xrange(20)], payloads)
+        self.assertEqual(queue.popleft(), None)
+        self.assertEqual(len(queue), 0)
+        # Consumed segments are removed
+        self.assertEqual(self.segment_files(), [])
+
+    def test_big_payload(self):
+        queue = SpillQueue(self.path, 1024 * 1024, segment_size=64)
+        queue.append('small')
+        queue.append('x' * 1000)
+        queue.append('small again')
+        self.assertEqual(queue.popleft(), 'small')
+        self.assertEqual(queue.popleft(), 'x' * 1000)
+        self.assertEqual(queue.popleft(), 'small again')
+
+    def test_reload(self):
+        queue = SpillQueue(self.path, 1024 * 1024, segment_size=64)
+        for i in xrange(10):
+            queue.append('payload %s' % i)
+        self.assertEqual(queue.popleft(), 'payload 0')
+        queue.prepend(['first', 'second'])
+        queue.close()
+
+        # Consumed payloads aren't replayed, prepended ones come first
+        queue = SpillQueue(self.path, 1024 * 1024, segment_size=64)
+        self.assertEqual(len(queue), 11)
+        payloads = [queue.popleft() for _ in xrange(11)]
+        self.assertEqual(payloads, ['first', 'second'] + ['payload %s' % i for i in xrange(1, 10)])
+
+    def test_torn_write(self):
+        queue = SpillQueue(self.path, 1024 * 1024)
+        queue.append('complete')
+        queue.append('torn')
+        queue.close()
+
+        # Corrupt the last payload, as if the agent died while writing it
+        segment_path = os.path.join(self.path, self.segment_files()[0])
+        with open(segment_path, 'r+b') as f:
+            f.seek(RECORD_HEADER.size * 2 + len('complete'))
+            f.write('corrupt')
+
+        queue = SpillQueue(self.path, 1024 * 1024)
+        self.assertEqual(len(queue), 1)
+        self.assertEqual(queue.popleft(), 'complete')
+        self.assertEqual(queue.popleft(), None)
+
+    def test_max_size(self):
+        queue = SpillQueue(self.path, 256, segment_size=64)
+        for i in xrange(100):
+            queue.append('payload %s' % i)
+
+        # Oldest segments are dropped to stay under the maximum size
+        self.assertTrue(queue.get_size() <= 256)
+        self.assertEqual(len(self.segment_files()) * 64, queue.get_size())
+        payloads = []
+        while len(queue):
+            payloads.append(queue.popleft())
+        self.assertEqual(payloads[-1], 'payload 99')
+        self.assertEqual(payloads, sorted(payloads, key=lambda p: int(p.split()[1])))
+
+    def test_prepend_to_full_queue(self):
+        queue = SpillQueue(self.path, 256, segment_size=64)
+        for i in xrange(100):
+            queue.append('payload %s' % i)
+        self.assertTrue(queue.get_size() > 256 - 64)
+
+        # The prepended payloads are the newest ones, the oldest spilled ones are dropped instead
+        queue.prepend(['shutdown %s' % i for i in xrange(3)])
+        self.assertTrue(queue.get_size() <= 256)
+        payloads = []
+        while len(queue):
+            payloads.append(queue.popleft())
+        self.assertEqual(payloads[:3], ['shutdown 0', 'shutdown 1', 'shutdown 2'])
+        self.assertEqual(payloads[-1], 'payload 99')
+        self.assertEqual(payloads[3:], sorted(payloads[3:], key=lambda p: int(p.split()[1])))
@@ -1,23 +1,36 @@
 # stdlib
 from datetime import datetime, timedelta
+import shutil
+import tempfile
 import unittest
+import zlib
 
 # 3rd party
 from nose.plugins.attrib import attr
 import requests
 import simplejson as json
-from tornado.web import Application
+from tornado.httpserver import HTTPServer
+from tornado.ioloop import IOLoop
+from tornado.testing import bind_unused_port
+from tornado.web import Application, RequestHandler
 
 # project
 from config import get_version
 from ddagent import (
     APIMetricTransaction,
     APIServiceCheckTransaction,
+    EndpointClient,
     MAX_QUEUE_SIZE,
     MetricTransaction,
     THROTTLING_DELAY,
 )
-from transaction import Transaction, TransactionManager
+from transaction import FLUSH_RATE_PERIOD, Transaction, TransactionManager, TransactionQueue
+from utils.spill_queue import SpillQueue
+
+
+class IntakeHandler(RequestHandler):
+    def post(self):
+        self.set_status(202)
 
 
 class memTransaction(Transaction):
@@ -39,6 +52,58 @@ class memTransaction(Transaction):
         self._trManager.flush_next()
 
 
+class spillTransaction(memTransaction):
+    # Class attribute so that it isn't pickled along with the transaction
+    _trManager = None
+
+    def __init__(self, size, payload):
+        Transaction.__init__(self)
+        self._size = size
+        self._flush_count = 0
+        self.payload = payload
+
+        self.is_flushable = True
+
+
+class asyncTransaction(Transaction):
+    """ A transaction which stays in flight until the test completes it """
+    def __init__(self, manager, in_flight):
+        Transaction.__init__(self)
+        self._trManager = manager
+        self._size = 1
+        self._in_flight = in_flight
+
+    def flush(self):
+        self._in_flight.append(self)
+
+    def complete(self, success, throttle=True):
+        self._in_flight.remove(self)
+        if success:
+            self._trManager.tr_success(self)
+        else:
+            self._trManager.tr_error(self, throttle=throttle)
+        self._trManager.flush_next()
+
+
+class coalesceTransaction(asyncTransaction):
+    def __init__(self, manager, in_flight, size):
+        asyncTransaction.__init__(self, manager, in_flight)
+        self._size = size
+
+    def get_coalesce_key(self):
+        return 'test' if self._coalescable else None
+
+    def coalesce(self, trs):
+        tr = coalesceTransaction(self._trManager, self._in_flight, sum(t.get_size() for t in trs))
+        tr._parts = trs
+        return tr
+
+    def reject(self):
+        self._in_flight.remove(self)
+        self._trManager.tr_split(self)
+        self._trManager.flush_next()
+
+
 @attr(requires='core_integration')
 class TestTransaction(unittest.TestCase):
 
@@ -88,6 +153,240 @@ class TestTransaction(unittest.TestCase):
         trManager.flush()
         self.assertEqual(len(trManager._transactions), 0)
 
+    def testTransactionQueue(self):
+        """Test due transactions selection and eviction order"""
+        queue = TransactionQueue()
+        now = datetime.utcnow()
+        trs = []
+        for i in xrange(5):
+            tr = Transaction()
+            tr.set_id(i + 1)
+            tr._next_flush = now - timedelta(seconds=10)
+            queue.add(tr)
+            trs.append(tr)
+
+        # Transaction 2 failed, it's replayed later
+        trs[1]._next_flush = now + timedelta(seconds=10)
+        queue.reschedule(trs[1])
+        queue.remove(trs[3])
+        self.assertEqual(len(queue), 4)
+        self.assertFalse(trs[3] in queue)
+
+        due = queue.pop_due(now)
+        self.assertEqual([due_tr.get_id() for due_tr in due], [1, 3, 5])
+        # Due transactions stay queued until they're flushed
+        self.assertEqual(len(queue), 4)
+        self.assertEqual(queue.pop_due(now), [])
+
+        # The transaction to flush last is dropped first, then the oldest ones
+        self.assertEqual(queue.pop_latest().get_id(), 2)
+        self.assertEqual(queue.pop_latest().get_id(), 1)
+        self.assertEqual(len(queue), 2)
+        self.assertFalse(queue.remove(trs[0]))
+
+    def testTransactionQueueBounded(self):
+        """Test that removed transactions don't pile up in the heaps"""
+        trManager = TransactionManager(timedelta(seconds=0), MAX_QUEUE_SIZE, timedelta(seconds=0))
+        queue = trManager._transactions
+        for i in xrange(5000):
+            tr = memTransaction(10, trManager)
+            trManager.append(tr)
+            trManager.tr_success(tr)
+            trManager.append(memTransaction(10, trManager))
+            # Failed transactions are rescheduled
+            queue.reschedule(tr)
+
+        self.assertEqual(len(queue), 5000)
+        self.assertTrue(len(queue._due_heap) <= 2 * len(queue))
+        self.assertTrue(len(queue._drop_heap) <= 2 * len(queue))
+
+        for tr in list(queue):
+            trManager.tr_success(tr)
+        self.assertEqual(len(queue), 0)
+        self.assertTrue(len(queue._due_heap) <= 1)
+        self.assertTrue(len(queue._drop_heap) <= 1)
+        # What's left doesn't hold the transactions
+        self.assertTrue(all(entry[2] is None for entry in queue._due_heap))
+
+    def testSpillQueue(self):
+        """Test that transactions overflow to disk and are replayed in order"""
+        spill_dir = tempfile.mkdtemp()
+        try:
+            trManager = TransactionManager(timedelta(seconds=0), MAX_QUEUE_SIZE, timedelta(seconds=0),
+                                           spill_queue=SpillQueue(spill_dir, MAX_QUEUE_SIZE))
+            spillTransaction._trManager = trManager
+
+            step = 10
+            oneTrSize = MAX_QUEUE_SIZE / 4
+            for i in xrange(step):
+                trManager.append(spillTransaction(oneTrSize, i))
+
+            # Only the first transactions fit in memory, nothing is dropped
+            self.assertEqual(len(trManager._transactions), 4)
+            self.assertEqual(len(trManager._spill_queue), step - 4)
+
+            # The forwarder is stopped with transactions still queued
+            trManager.spill_all()
+            self.assertEqual(len(trManager._transactions), 0)
+            trManager._spill_queue.close()
+
+            # And restarted
+            trManager = TransactionManager(timedelta(seconds=0), MAX_QUEUE_SIZE, timedelta(seconds=0),
+                                           spill_queue=SpillQueue(spill_dir, MAX_QUEUE_SIZE))
+            spillTransaction._trManager = trManager
+            # Transactions are loaded back in memory in the order they were received
+            loaded = []
+            while len(trManager._spill_queue) or trManager._transactions:
+                trManager.unspill()
+                self.assertTrue(len(trManager._transactions) <= 4)
+                for tr in list(trManager._transactions):
+                    loaded.append(tr.payload)
+                    trManager.tr_success(tr)
+
+            self.assertEqual(loaded, range(step))
+        finally:
+            shutil.rmtree(spill_dir)
+
+    def testInFlightWindow(self):
+        """Test that the number of transactions in flight grows on success and shrinks on errors"""
+        trManager = TransactionManager(timedelta(seconds=0), MAX_QUEUE_SIZE, timedelta(seconds=0),
+                                       max_in_flight=4)
+        in_flight = []
+        for i in xrange(50):
+            trManager.append(asyncTransaction(trManager, in_flight))
+
+        trManager.flush()
+        self.assertEqual(len(in_flight), 1)
+
+        # Window grows by about one per round of successes, up to the maximum
+        expected = [2, 2, 3, 4, 4]
+        for size in expected:
+            for tr in list(in_flight):
+                tr.complete(True)
+            self.assertEqual(len(in_flight), size)
+            self.assertEqual(trManager.get_in_flight(), size)
+
+        # Client errors don't throttle
+        in_flight[0].complete(False, throttle=False)
+        self.assertEqual(trManager.get_window_size(), 4)
+        self.assertEqual(len(in_flight), 4)
+
+        # Server errors halve the window
+        in_flight[0].complete(False)
+        self.assertEqual(trManager.get_window_size(), 2)
+        self.assertEqual(len(in_flight), 3)
+        in_flight[0].complete(False)
+        self.assertEqual(trManager.get_window_size(), 1)
+        self.assertEqual(len(in_flight), 2)
+        in_flight[0].complete(True)
+        self.assertEqual(trManager.get_window_size(), 2)
+        self.assertEqual(len(in_flight), 2)
+
+        # The flush is over once nothing is in flight anymore
+        while in_flight:
+            in_flight[0].complete(False)
+        self.assertTrue(trManager._trs_to_flush is None)
+
+    def testWindowBoundsInFlight(self):
+        """Test that above one transaction in flight, the window alone bounds the sends"""
+        trManager = TransactionManager(timedelta(seconds=0), MAX_QUEUE_SIZE, timedelta(seconds=3600),
+                                       max_in_flight=4)
+        trManager._last_flush = datetime.utcnow() - timedelta(seconds=3600)
+        in_flight = []
+        for i in xrange(10):
+            trManager.append(asyncTransaction(trManager, in_flight))
+
+        # The throttling delay holds back the second send while the window is one
+        trManager.flush()
+        self.assertEqual(len(in_flight), 1)
+
+        # Once the window grows, the transactions it allows are sent right away
+        in_flight[0].complete(True)
+        self.assertEqual(trManager.get_window_size(), 2)
+        self.assertEqual(len(in_flight), 2)
+
+        trManager._window = 4.0
+        in_flight[0].complete(True)
+        self.assertEqual(len(in_flight), 4)
+        self.assertEqual(trManager.get_in_flight(), 4)
+
+    def testFlushRate(self):
+        """Test that the flush rate is measured over a fixed period, not between flushes"""
+        trManager = TransactionManager(timedelta(seconds=0), MAX_QUEUE_SIZE, timedelta(seconds=0))
+        trManager._rate_last_time -= 1
+        trManager._transactions_flushed = 10
+        trManager.flush()
+        self.assertEqual(trManager.get_flush_rate(), 0.0)
+
+        trManager._rate_last_time -= FLUSH_RATE_PERIOD
+        trManager.flush()
+        self.assertTrue(0.8 < trManager.get_flush_rate() <= 10.0 / FLUSH_RATE_PERIOD)
+
+        trManager.flush()
+        self.assertTrue(trManager.get_flush_rate() > 0.8)
+
+    def testCoalescing(self):
+        """Test that due transactions are sent together, and separately when rejected"""
+        trManager = TransactionManager(timedelta(seconds=0), MAX_QUEUE_SIZE, timedelta(seconds=0),
+                                       max_in_flight=10, max_coalesced_size=250)
+        trManager._window = 10.0
+        in_flight = []
+        for i in xrange(5):
+            trManager.append(coalesceTransaction(trManager, in_flight, 100))
+
+        trManager.flush()
+        self.assertEqual(sorted(len(tr.get_parts()) for tr in in_flight), [1, 2, 2])
+
+        coalesced = [part for part in in_flight if len(part.get_parts()) == 2]
+        coalesced[0].reject()
+        # Its parts are sent right away, on their own
+        self.assertEqual(sorted(len(tr.get_parts()) for tr in in_flight), [1, 1, 1, 2])
+
+        failed_parts = coalesced[1].get_parts()
+        coalesced[1].complete(False, throttle=False)
+        while in_flight:
+            in_flight[0].complete(True)
+
+        self.assertEqual(sorted(trManager.get_transactions()), sorted(failed_parts))
+        self.assertEqual(trManager._transactions_flushed, 3)
+        for tr in failed_parts:
+            self.assertEqual(tr.get_error_count(), 1)
+
+    def testAPIMetricCoalescing(self):
+        def series_transaction(series, compress):
+            tr = APIMetricTransaction.__new__(APIMetricTransaction)
+            Transaction.__init__(tr)
+            tr._msg_type = ""
+            tr._data = json.dumps({'series': series})
+            tr._headers = {'Content-Type': 'application/json', 'Content-Length': str(len(tr._data)),
+                           'DD-Dogstatsd-Version': '5.0'}
+            if compress:
+                tr._data = zlib.compress(tr._data)
+                tr._headers['Content-Encoding'] = 'deflate'
+            return tr
+
+        trs = [
+            series_transaction([{'metric': 'foo', 'points': [[1, 1]]}], False),
+            series_transaction([{'metric': 'bar', 'points': [[1, 2]]},
+                                {'metric': 'baz', 'points': [[1, 3]]}], True),
+        ]
+        self.assertEqual(trs[0].get_coalesce_key(), trs[1].get_coalesce_key())
+
+        coalesced = trs[0].coalesce(trs)
+        self.assertEqual(coalesced.get_parts(), trs)
+        # The headers of the parts are kept, except the ones about their own payload
+        self.assertEqual(coalesced._headers['Content-Encoding'], 'deflate')
+        self.assertEqual(coalesced._headers['DD-Dogstatsd-Version'], '5.0')
+        self.assertEqual(coalesced._headers['Content-Type'], 'application/json')
+        self.assertTrue('Content-Length' not in coalesced._headers)
+        series = json.loads(zlib.decompress(coalesced.get_data()))['series']
+        self.assertEqual([s['metric'] for s in series], ['foo', 'bar', 'baz'])
+
+        # Payloads sent with other headers aren't merged
+        other = series_transaction([{'metric': 'qux', 'points': [[1, 4]]}], False)
+        other._headers['DD-Dogstatsd-Version'] = '5.1'
+        self.assertNotEqual(other.get_coalesce_key(), trs[0].get_coalesce_key())
+
     def testThrottling(self):
         """Test throttling while flushing"""
 
@@ -195,3 +494,34 @@ class TestTransaction(unittest.TestCase):
             r = requests.post(url, data=json.dumps({'check': 'test', 'status': 0}),
                               headers={'Content-Type': "application/json"})
             r.raise_for_status()
+
+    def testEndpointClient(self):
+        io_loop = IOLoop()
+        sock, port = bind_unused_port()
+        server = HTTPServer(Application([(r"/intake/?", IntakeHandler)]), io_loop=io_loop)
+        server.add_sockets([sock])
+
+        client = EndpointClient('dd_url', {'forwarder_max_in_flight': 2},
+                                use_simple_http_client=True, io_loop=io_loop)
+        codes = []
+
+        def on_response(response):
+            codes.append(response.code)
+            if len(codes) == 3:
+                io_loop.stop()
+
+        url = 'http://127.0.0.1:%s/intake/' % port
+        for _ in range(3):
+            client.fetch(url, '{}', {'Content-Type': 'application/json'}, callback=on_response)
+        io_loop.start()
+
+        self.assertEqual(codes, [202] * 3)
+        stats = client.get_stats()
+        self.assertEqual(stats['request_count'], 3)
+        self.assertEqual(stats['error_count'], 0)
+        self.assertEqual(stats['in_flight'], 0)
+        self.assertEqual(sum(count for _, count in stats['latency_histogram']), 3)
+
+        client.close()
+        server.stop()
+        io_loop.close(all_fds=True)
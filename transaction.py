@@ -1,7 +1,9 @@
 # stdlib
 from datetime import datetime, timedelta
+import heapq
 import logging
-from operator import attrgetter
+from operator import methodcaller
+import cPickle as pickle
 import sys
 import time
 
@@ -14,6 +16,11 @@ log = logging.getLogger(__name__)
 FLUSH_LOGGING_PERIOD = 20
 FLUSH_LOGGING_INITIAL = 5
 
+# Period over which the flush rate is measured, in seconds
+FLUSH_RATE_PERIOD = 10
+
+EPOCH = datetime(1970, 1, 1)
+
 class Transaction(object):
 
     def __init__(self):
@@ -23,6 +30,10 @@ class Transaction(object):
         self._next_flush = datetime.utcnow()
         self._size = None
 
+        # Transactions sent as part of this one, when it's made of several
+        self._parts = None
+        self._coalescable = True
+
     def get_id(self):
         return self._id
 
@@ -58,21 +69,157 @@ class Transaction(object):
     def time_to_flush(self,now = datetime.utcnow()):
         return self._next_flush < now
 
+    def get_parts(self):
+        """ Queued transactions this transaction is made of """
+        return self._parts or [self]
+
+    def get_coalesce_key(self):
+        """
+        Due transactions with the same key are sent as a single one, made by
+        `coalesce`. None if this transaction has to be sent on its own.
+        """
+        return None
+
+    def coalesce(self, trs):
+        raise NotImplementedError("To be implemented in a subclass")
+
     def flush(self):
         raise NotImplementedError("To be implemented in a subclass")
 
+class TransactionQueue(object):
+    """
+    Transactions indexed by id, and by next flush date in two heaps: one to
+    find the transactions due for a flush, the other one to find the
+    transactions to drop first when the queue is full.
+    Heap entries are never removed in place, they are flagged as removed and
+    skipped when they come at the top of a heap. A heap is rebuilt without
+    them once they outnumber its live entries.
+    """
+
+    def __init__(self):
+        self._by_id = {}
+        self._entries = {}  # Transaction id -> its current heap entry
+        self._due_heap = []  # [next flush, id, transaction, removed, in the due heap]
+        self._drop_heap = []  # (-next flush timestamp, id, entry)
+        # Number of removed entries still in each heap
+        self._due_stale = 0
+        self._drop_stale = 0
+
+    def __len__(self):
+        return len(self._by_id)
+
+    def __iter__(self):
+        return self._by_id.itervalues()
+
+    def __contains__(self, tr):
+        return tr.get_id() in self._by_id
+
+    def _push(self, tr):
+        next_flush = tr.get_next_flush()
+        entry = [next_flush, tr.get_id(), tr, False, True]
+        self._entries[tr.get_id()] = entry
+        heapq.heappush(self._due_heap, entry)
+        td = next_flush - EPOCH
+        timestamp = td.days * 86400 + td.seconds + td.microseconds / 10.0**6
+        # Among transactions flushed at the same time, drop the oldest first
+        heapq.heappush(self._drop_heap, (-timestamp, tr.get_id(), entry))
+
+    def _invalidate(self, tr, in_drop_heap=True):
+        entry = self._entries.pop(tr.get_id(), None)
+        if entry is None:
+            return
+        # Don't keep the transaction and its payload around until the entry is popped
+        entry[2] = None
+        entry[3] = True
+        if entry[4]:
+            self._due_stale += 1
+        if in_drop_heap:
+            self._drop_stale += 1
+        self._compact()
+
+    def _compact(self):
+        if self._due_stale > len(self._due_heap) - self._due_stale:
+            self._due_heap = [entry for entry in self._due_heap if not entry[3]]
+            heapq.heapify(self._due_heap)
+            self._due_stale = 0
+        if self._drop_stale > len(self._drop_heap) - self._drop_stale:
+            self._drop_heap = [item for item in self._drop_heap if not item[2][3]]
+            heapq.heapify(self._drop_heap)
+            self._drop_stale = 0
+
+    def add(self, tr):
+        self._by_id[tr.get_id()] = tr
+        self._push(tr)
+
+    def remove(self, tr):
+        """ Remove a transaction, return False if it wasn't queued (anymore) """
+        if self._by_id.pop(tr.get_id(), None) is None:
+            return False
+        self._invalidate(tr)
+        return True
+
+    def reschedule(self, tr):
+        """ Update the position of a transaction whose next flush date changed """
+        if tr not in self:
+            return
+        self._invalidate(tr)
+        self._push(tr)
+
+    def pop_due(self, now):
+        """
+        Return the transactions to flush before `now`, they stay in the
+        queue until they are removed or rescheduled.
+        """
+        due = []
+        heap = self._due_heap
+        while heap and heap[0][0] < now:
+            entry = heapq.heappop(heap)
+            if entry[3]:
+                self._due_stale -= 1
+            else:
+                entry[4] = False
+                due.append(entry[2])
+        return due
+
+    def pop_latest(self):
+        """ Remove and return the transaction to be flushed last, None if the queue is empty """
+        heap = self._drop_heap
+        while heap:
+            _, _, entry = heapq.heappop(heap)
+            if entry[3]:
+                self._drop_stale -= 1
+                continue
+            tr = entry[2]
+            del self._by_id[tr.get_id()]
+            self._invalidate(tr, in_drop_heap=False)
+            return tr
+        return None
+
+
 class TransactionManager(object):
     """Holds any transaction derived object list and make sure they
        are all commited, without exceeding parameters (throttling, memory consumption) """
 
-    def __init__(self, max_wait_for_replay, max_queue_size, throttling_delay):
+    def __init__(self, max_wait_for_replay, max_queue_size, throttling_delay, spill_queue=None,
+                 max_in_flight=1, max_coalesced_size=0, get_endpoint_stats=None):
         self._MAX_WAIT_FOR_REPLAY = max_wait_for_replay
         self._MAX_QUEUE_SIZE = max_queue_size
         self._THROTTLING_DELAY = throttling_delay
+        self._MAX_IN_FLIGHT = max(1, max_in_flight)
+        # Maximum size of the transactions sent together, 0 to send them one by one
+        self._MAX_COALESCED_SIZE = max_coalesced_size
+
+        # Optional utils.spill_queue.SpillQueue: transactions that don't fit
+        # in memory are written there instead of being dropped, and read back
+        # in order when the queue has room again
+        self._spill_queue = spill_queue
+
+        # Optional callable returning the stats of the HTTP client of each endpoint
+        self._get_endpoint_stats = get_endpoint_stats
 
         self._flush_without_ioloop = False # useful for tests
 
-        self._transactions = []  # List of all non commited transactions
+        self._transactions = TransactionQueue()  # All non commited transactions
         self._total_count = 0  # Maintain size/count not to recompute it everytime
         self._total_size = 0
         self._flush_count = 0
@@ -86,15 +233,39 @@ class TransactionManager(object):
         self._trs_to_flush = None # Current transactions being flushed
         self._last_flush = datetime.utcnow() # Last flush (for throttling)
 
+        # Number of transactions allowed in flight, grows by one per window
+        # of successful flushes and is halved when the intake is struggling.
+        # The throttling delay only applies when it's down to one.
+        self._window = 1.0
+        self._in_flight = 0
+        self._flush_next_scheduled = False
+
+        # Transactions flushed per second, measured over FLUSH_RATE_PERIOD
+        self._flush_rate = 0.0
+        self._rate_last_time = time.time()
+        self._rate_last_flushed = 0
+
         # Track an initial status message.
         ForwarderStatus().persist()
 
     def get_transactions(self):
         return self._transactions
 
+    def get_window_size(self):
+        return int(self._window)
+
+    def get_in_flight(self):
+        return self._in_flight
+
+    def get_flush_rate(self):
+        return self._flush_rate
+
     def print_queue_stats(self):
         log.debug("Queue size: at %s, %s transaction(s), %s KB" %
             (time.time(), self._total_count, (self._total_size/1024)))
+        if self._spill_queue:
+            log.debug("Spill queue: %s transaction(s), %s KB on disk" %
+                (len(self._spill_queue), self._spill_queue.get_size()/1024))
 
     def get_tr_id(self):
         self._counter = self._counter + 1
@@ -111,37 +282,81 @@ class TransactionManager(object):
         log.debug("New transaction to add, total size of queue would be: %s KB" %
             ((self._total_size + tr_size) / 1024))
 
+        if self._spill_queue is not None and \
+                (len(self._spill_queue) or (self._total_size + tr_size) > self._MAX_QUEUE_SIZE):
+            # Older transactions are already waiting on disk, queue this one behind them
+            self._spill_queue.append(pickle.dumps(tr, pickle.HIGHEST_PROTOCOL))
+            self._transactions_received += 1
+            log.debug("Transaction %s spilled to disk" % tr.get_id())
+            self.print_queue_stats()
+            return
+
         if (self._total_size + tr_size) > self._MAX_QUEUE_SIZE:
             log.warn("Queue is too big, removing old transactions...")
-            new_trs = sorted(self._transactions,key=attrgetter('_next_flush'), reverse = True)
-            for tr2 in new_trs:
-                if (self._total_size + tr_size) > self._MAX_QUEUE_SIZE:
-                    self._transactions.remove(tr2)
-                    self._total_count = self._total_count - 1
-                    self._total_size = self._total_size - tr2.get_size()
-                    log.warn("Removed transaction %s from queue" % tr2.get_id())
+            while (self._total_size + tr_size) > self._MAX_QUEUE_SIZE:
+                tr2 = self._transactions.pop_latest()
+                if tr2 is None:
+                    break
+                self._total_count = self._total_count - 1
+                self._total_size = self._total_size - tr2.get_size()
+                log.warn("Removed transaction %s from queue" % tr2.get_id())
 
         # Done
-        self._transactions.append(tr)
-        self._total_count += 1
+        self._add(tr)
         self._transactions_received += 1
-        self._total_size = self._total_size + tr_size
 
         log.debug("Transaction %s added" % (tr.get_id()))
         self.print_queue_stats()
 
+    def _add(self, tr):
+        self._transactions.add(tr)
+        self._total_count += 1
+        self._total_size = self._total_size + tr.get_size()
+
+    def unspill(self):
+        """ Move spilled transactions back in memory, as long as there is room for them """
+        if not self._spill_queue:
+            return
+
+        while self._spill_queue and self._total_size < self._MAX_QUEUE_SIZE:
+            data = self._spill_queue.popleft()
+            try:
+                tr = pickle.loads(data)
+            except Exception:
+                log.exception("Unable to load a spilled transaction, dropping it")
+                continue
+            # Ids are only unique within a run, the transaction may come from a previous one
+            tr._id = None
+            tr.set_id(self.get_tr_id())
+            self._add(tr)
+            log.debug("Transaction %s loaded from disk" % tr.get_id())
+
+    def spill_all(self):
+        """
+        Write the transactions held in memory ahead of the spilled ones, so
+        that they are replayed first after a restart.
+        """
+        if self._spill_queue is None:
+            return
+
+        trs = sorted(self._transactions, key=methodcaller('get_id'))
+        self._spill_queue.prepend([pickle.dumps(tr, pickle.HIGHEST_PROTOCOL) for tr in trs])
+        log.info("Spilled %s transaction%s to disk" % (self._total_count, plural(self._total_count)))
+        self._spill_queue.sync()
+        self._transactions = TransactionQueue()
+        self._total_count = 0
+        self._total_size = 0
+
     def flush(self):
 
         if self._trs_to_flush is not None:
             log.debug("A flush is already in progress, not doing anything")
             return
 
-        to_flush = []
+        self.unspill()
+
         # Do we have something to do ?
-        now = datetime.utcnow()
-        for tr in self._transactions:
-            if tr.time_to_flush(now):
-                to_flush.append(tr)
+        to_flush = self._coalesce(self._transactions.pop_due(datetime.utcnow()))
 
         count = len(to_flush)
         should_log = self._flush_count + 1 <= FLUSH_LOGGING_INITIAL or (self._flush_count + 1) % FLUSH_LOGGING_PERIOD == 0
@@ -163,59 +378,155 @@ class TransactionManager(object):
             log.info("First flushes done, next flushes will be logged every %s flushes." % FLUSH_LOGGING_PERIOD)
 
         self._flush_count += 1
+        self._update_flush_rate()
 
         ForwarderStatus(
             queue_length=self._total_count,
             queue_size=self._total_size,
             flush_count=self._flush_count,
             transactions_received=self._transactions_received,
-            transactions_flushed=self._transactions_flushed).persist()
+            transactions_flushed=self._transactions_flushed,
+            spilled_length=len(self._spill_queue) if self._spill_queue is not None else 0,
+            endpoint_stats=self._get_endpoint_stats() if self._get_endpoint_stats is not None else None).persist()
+
+    def _coalesce(self, trs):
+        """
+        Group the transactions that can be sent together, in batches of at
+        most `max_coalesced_size` bytes.
+        """
+        if not self._MAX_COALESCED_SIZE:
+            return trs
+
+        to_flush = []
+        batches = {}  # Coalesce key -> (transactions, size)
+        for tr in trs:
+            key = tr.get_coalesce_key()
+            if key is None:
+                to_flush.append(tr)
+                continue
+
+            batch, size = batches.get(key, ([], 0))
+            if batch and size + tr.get_size() > self._MAX_COALESCED_SIZE:
+                to_flush.extend(self._merge(batch))
+                batch, size = [], 0
+            batch.append(tr)
+            batches[key] = (batch, size + tr.get_size())
+
+        for batch, _ in batches.itervalues():
+            to_flush.extend(self._merge(batch))
+
+        return to_flush
+
+    def _merge(self, batch):
+        if len(batch) == 1:
+            return batch
+
+        try:
+            tr = batch[0].coalesce(batch)
+        except Exception:
+            log.exception("Unable to coalesce %s transactions, sending them separately" % len(batch))
+            for part in batch:
+                part._coalescable = False
+            return batch
+
+        tr.set_id(self.get_tr_id())
+        log.debug("Coalesced transactions %s into transaction %d" %
+            (", ".join(str(part.get_id()) for part in batch), tr.get_id()))
+        return [tr]
+
+    def _update_flush_rate(self):
+        now = time.time()
+        elapsed = now - self._rate_last_time
+        if elapsed >= FLUSH_RATE_PERIOD:
+            self._flush_rate = (self._transactions_flushed - self._rate_last_flushed) / elapsed
+            self._rate_last_time = now
+            self._rate_last_flushed = self._transactions_flushed
+
+    def _scheduled_flush_next(self):
+        self._flush_next_scheduled = False
+        self.flush_next()
 
     def flush_next(self):
 
-        if len(self._trs_to_flush) > 0:
+        while self._trs_to_flush and self._in_flight < self.get_window_size():
 
-            td = self._last_flush + self._THROTTLING_DELAY - datetime.utcnow()
+            # Once more than one transaction is allowed in flight, the window
+            # alone bounds the sends
+            if self.get_window_size() > 1:
+                td = timedelta(0)
+            else:
+                td = self._last_flush + self._THROTTLING_DELAY - datetime.utcnow()
             # Python 2.7 has this built in, python < 2.7 don't...
             if hasattr(td,'total_seconds'):
                 delay = td.total_seconds()
             else:
                 delay = (td.microseconds + (td.seconds + td.days * 24 * 3600) * 10**6) / 10.0**6
 
-            if delay <= 0:
-                tr = self._trs_to_flush.pop()
-                self._last_flush = datetime.utcnow()
-                log.debug("Flushing transaction %d" % tr.get_id())
-                try:
-                    tr.flush()
-                except Exception,e :
-                    log.exception(e)
-                    self.tr_error(tr)
-                    self.flush_next()
-            else:
+            if delay > 0:
                 # Wait a little bit more
+                if self._flush_next_scheduled:
+                    return
                 tornado_ioloop = get_tornado_ioloop()
                 if tornado_ioloop._running:
+                    self._flush_next_scheduled = True
                     tornado_ioloop.add_timeout(time.time() + delay,
-                        lambda: self.flush_next())
+                        lambda: self._scheduled_flush_next())
                 elif self._flush_without_ioloop:
                     # Tornado is no started (ie, unittests), do it manually: BLOCKING
                     time.sleep(delay)
                     self.flush_next()
-        else:
+                return
+
+            tr = self._trs_to_flush.pop()
+            self._last_flush = datetime.utcnow()
+            self._in_flight += 1
+            log.debug("Flushing transaction %d (%d in flight)" % (tr.get_id(), self._in_flight))
+            try:
+                tr.flush()
+            except Exception,e :
+                log.exception(e)
+                self.tr_error(tr)
+
+        if self._trs_to_flush is not None and not self._trs_to_flush and not self._in_flight:
             self._trs_to_flush = None
 
-    def tr_error(self,tr):
-        tr.inc_error_count()
-        tr.compute_next_flush(self._MAX_WAIT_FOR_REPLAY)
-        log.warn("Transaction %d in error (%s error%s), it will be replayed after %s" %
-          (tr.get_id(), tr.get_error_count(), plural(tr.get_error_count()),
-           tr.get_next_flush()))
+    def tr_error(self, tr, throttle=True):
+        """
+        `throttle` tells whether the error means the intake is overloaded or
+        unreachable (5xx, timeouts), in which case fewer transactions are sent
+        in parallel.
+        """
+        self._in_flight = max(0, self._in_flight - 1)
+        if throttle:
+            self._window = max(1.0, self._window / 2)
+
+        for part in tr.get_parts():
+            part.inc_error_count()
+            part.compute_next_flush(self._MAX_WAIT_FOR_REPLAY)
+            self._transactions.reschedule(part)
+            log.warn("Transaction %d in error (%s error%s), it will be replayed after %s" %
+              (part.get_id(), part.get_error_count(), plural(part.get_error_count()),
+               part.get_next_flush()))
+
+    def tr_split(self, tr):
+        """ The intake rejected a coalesced transaction, send its parts on their own """
+        self._in_flight = max(0, self._in_flight - 1)
+
+        parts = tr.get_parts()
+        log.warn("Transaction %d was rejected, sending the %s transactions it's made of separately" %
+            (tr.get_id(), len(parts)))
+        for part in parts:
+            part._coalescable = False
+        self._trs_to_flush.extend(parts)
 
     def tr_success(self,tr):
-        log.debug("Transaction %d completed" % tr.get_id())
-        self._transactions.remove(tr)
-        self._total_count -= 1
-        self._total_size -= tr.get_size()
-        self._transactions_flushed += 1
+        self._in_flight = max(0, self._in_flight - 1)
+        self._window = min(self._MAX_IN_FLIGHT, self._window + 1 / self._window)
+
+        for part in tr.get_parts():
+            log.debug("Transaction %d completed" % part.get_id())
+            if self._transactions.remove(part):
+                self._total_count -= 1
+                self._total_size -= part.get_size()
+            self._transactions_flushed += 1
         self.print_queue_stats()
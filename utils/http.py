@@ -1,6 +1,109 @@
+# stdlib
+import threading
+import time
+
+# 3p
 import requests
+from requests.adapters import HTTPAdapter
+
+DEFAULT_POOL_SIZE = 4
+
+_shared_session = None
+_shared_session_lock = threading.Lock()
+
 
 def retrieve_json(url):
     r = requests.get(url)
     r.raise_for_status()
     return r.json()
+
+
+class CountingHTTPAdapter(HTTPAdapter):
+    """ An HTTPAdapter which remembers its connection pools, to count the connections they opened """
+
+    def __init__(self, *args, **kwargs):
+        self.pools = set()
+        HTTPAdapter.__init__(self, *args, **kwargs)
+
+    def get_connection(self, url, proxies=None):
+        pool = HTTPAdapter.get_connection(self, url, proxies)
+        self.pools.add(pool)
+        return pool
+
+    def get_connection_count(self):
+        return sum(pool.num_connections for pool in self.pools)
+
+
+class HTTPSession(object):
+    """
+    A `requests.Session` keeping its connections open between requests,
+    along with the stats of the requests posted through it.
+    Without `keep_alive` each request gets its own connection, as with
+    `requests.post`.
+    """
+
+    def __init__(self, pool_size=DEFAULT_POOL_SIZE, keep_alive=True):
+        self.session = requests.Session()
+        self.adapter = CountingHTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount('http://', self.adapter)
+        self.session.mount('https://', self.adapter)
+        self.keep_alive = keep_alive
+
+        self._lock = threading.Lock()
+        self.request_count = 0
+        self.total_latency = 0.0
+        self.last_latency = None
+
+    def post(self, url, **kwargs):
+        start_time = time.time()
+        try:
+            if not self.keep_alive:
+                return requests.post(url, **kwargs)
+            return self.session.post(url, **kwargs)
+        finally:
+            latency = time.time() - start_time
+            with self._lock:
+                self.request_count += 1
+                self.total_latency += latency
+                self.last_latency = latency
+
+    def get_stats(self):
+        """ Number of requests, how many of them reused a connection, and their latency in ms """
+        with self._lock:
+            request_count = self.request_count
+            total_latency = self.total_latency
+            last_latency = self.last_latency
+        reused = 0
+        if self.keep_alive:
+            reused = max(0, request_count - self.adapter.get_connection_count())
+        stats = {
+            'request_count': request_count,
+            'reused_connection_count': reused,
+            'avg_latency_ms': None,
+            'last_latency_ms': None,
+        }
+        if request_count:
+            stats['avg_latency_ms'] = round(total_latency * 1000.0 / request_count, 2)
+            stats['last_latency_ms'] = round(last_latency * 1000.0, 2)
+        return stats
+
+    def close(self):
+        self.session.close()
+
+
+def get_http_session(agentConfig):
+    """ The HTTP session shared by everything posting to Datadog in this process """
+    global _shared_session
+    with _shared_session_lock:
+        if _shared_session is None:
+            _shared_session = HTTPSession(
+                pool_size=agentConfig.get('http_pool_size', DEFAULT_POOL_SIZE),
+                keep_alive=agentConfig.get('http_keep_alive', True))
+        return _shared_session
+
+
+def get_http_session_stats():
+    """ Stats of the shared HTTP session, None if nothing used it yet """
+    if _shared_session is None:
+        return None
+    return _shared_session.get_stats()
@@ -0,0 +1,182 @@
+"""
+Snapshots of /proc shared by the checks.
+
+Several checks read the same kernel data at each collection run: /proc/stat,
+/proc/meminfo, the list of processes... `ProcSnapshot` reads each source
+when a check first asks for it, and hands the same copy to the next checks
+asking for it, until it's older than the freshness window of the source or
+the next collection run starts.
+"""
+# stdlib
+from collections import namedtuple
+import logging
+import os
+import threading
+import time
+
+# 3p
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+log = logging.getLogger(__name__)
+
+DEFAULT_PROCFS_PATH = '/proc'
+
+# Freshness window of a source, in seconds. Keep it short for the counters
+# which are turned into rates, a stale value shifts the rate.
+DEFAULT_MAX_AGE = 2
+MAX_AGES = {
+    'meminfo': 5,
+    'pid_cgroups': 10,
+    'process_names': 10,
+    'process_cmdlines': 10,
+}
+
+ProcEntry = namedtuple('ProcEntry', ['timestamp', 'value'])
+
+_snapshots = {}
+_snapshots_lock = threading.Lock()
+
+
+def get_proc_snapshot(procfs_path=DEFAULT_PROCFS_PATH):
+    """ The snapshot of the /proc mounted at `procfs_path`, shared by all the checks """
+    procfs_path = procfs_path.rstrip('/') or '/'
+    with _snapshots_lock:
+        snapshot = _snapshots.get(procfs_path)
+        if snapshot is None:
+            snapshot = _snapshots[procfs_path] = ProcSnapshot(procfs_path)
+    return snapshot
+
+
+def invalidate_proc_snapshots():
+    """ Forget about everything that was read, called at the start of each collection run """
+    with _snapshots_lock:
+        snapshots = _snapshots.values()
+    for snapshot in snapshots:
+        snapshot.invalidate()
+
+
+class ProcSnapshot(object):
+    """
+    Cache of the sources read from a /proc, each of them is kept for
+    `MAX_AGES[source]` seconds at most.
+    A source is either a file, relative to /proc, or any of the `load_*`
+    methods. What's read from it is only parsed when asked, the parsed
+    value is cached along with the source.
+    """
+
+    def __init__(self, procfs_path=DEFAULT_PROCFS_PATH):
+        self.procfs_path = procfs_path
+        self._entries = {}  # (source, parser): ProcEntry
+        self._locks = {}  # source: lock held while it's read
+        self._lock = threading.Lock()
+        # attribute: {pid: (psutil.Process, value)} as of the last scan
+        self._process_attributes = {}
+
+    def _get_lock(self, source):
+        with self._lock:
+            lock = self._locks.get(source)
+            if lock is None:
+                lock = self._locks[source] = threading.Lock()
+        return lock
+
+    def _get_fresh(self, key, max_age):
+        entry = self._entries.get(key)
+        if entry is not None and time.time() - entry.timestamp < max_age:
+            return entry
+        return None
+
+    def invalidate(self, source=None):
+        with self._lock:
+            if source is None:
+                self._entries.clear()
+            else:
+                for key in self._entries.keys():
+                    if key[0] == source:
+                        del self._entries[key]
+
+    def get(self, source, parser=None, max_age=None):
+        """
+        Return what was read from `source`, passed through `parser` if
+        there's one. Raise what reading it raised, nothing's cached then.
+        """
+        if max_age is None:
+            max_age = MAX_AGES.get(source, DEFAULT_MAX_AGE)
+
+        key = (source, parser)
+        entry = self._get_fresh(key, max_age)
+        if entry is not None:
+            return entry.value
+
+        with self._get_lock(source):
+            # It may have been read while we were waiting for the lock
+            entry = self._get_fresh(key, max_age)
+            if entry is not None:
+                return entry.value
+
+            raw = self._get_fresh((source, None), max_age)
+            if raw is None:
+                raw = ProcEntry(time.time(), self._read(source))
+                self._entries[(source, None)] = raw
+            if parser is None:
+                return raw.value
+
+            # Parsed values expire with what they were parsed from
+            entry = ProcEntry(raw.timestamp, parser(raw.value))
+            self._entries[key] = entry
+            return entry.value
+
+    def _read(self, source):
+        loader = getattr(self, 'load_%s' % source, None)
+        if loader is not None:
+            return loader()
+        with open(os.path.join(self.procfs_path, source), 'r') as f:
+            return f.readlines()
+
+    def get_pids(self):
+        return [int(d) for d in os.listdir(self.procfs_path) if d.isdigit()]
+
+    def load_pid_cgroups(self):
+        """ {pid: lines of /proc/[pid]/cgroup}, for the processes still alive """
+        cgroups = {}
+        for pid in self.get_pids():
+            path = os.path.join(self.procfs_path, str(pid), 'cgroup')
+            try:
+                with open(path, 'r') as f:
+                    cgroups[pid] = f.readlines()
+            except IOError, e:
+                log.debug("Cannot read %s, process likely raced to finish: %s", path, e)
+        return cgroups
+
+    def _load_process_attribute(self, attribute):
+        """
+        {pid: the `attribute` method of its psutil.Process}, or the
+        psutil.AccessDenied exception raised when calling it.
+        The table is updated incrementally: `psutil.process_iter` yields
+        the same Process as long as its pid isn't reused, so the attribute
+        is only read for the processes which started since the last scan.
+        """
+        last_values = self._process_attributes.get(attribute, {})
+        values = {}
+        for proc in psutil.process_iter():
+            last = last_values.get(proc.pid)
+            if last is not None and last[0] is proc:
+                values[proc.pid] = last
+                continue
+            try:
+                values[proc.pid] = (proc, getattr(proc, attribute)())
+            except psutil.NoSuchProcess:
+                continue
+            except psutil.AccessDenied, e:
+                # Not kept for the next scan, access may be granted by then
+                values[proc.pid] = (None, e)
+        self._process_attributes[attribute] = values
+        return dict((pid, value) for pid, (_, value) in values.iteritems())
+
+    def load_process_names(self):
+        return self._load_process_attribute('name')
+
+    def load_process_cmdlines(self):
+        return self._load_process_attribute('cmdline')
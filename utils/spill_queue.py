@@ -0,0 +1,248 @@
+# stdlib
+import logging
+import mmap
+import os
+import struct
+import zlib
+
+log = logging.getLogger(__name__)
+
+# Size of a segment file, a payload bigger than this gets a segment of its own
+DEFAULT_SEGMENT_SIZE = 8 * 1024 * 1024  # 8MB
+
+# Record header: payload length, payload crc32, consumed flag
+RECORD_HEADER = struct.Struct('!IIB')
+CONSUMED_FLAG_OFFSET = 8
+
+SEGMENT_EXTENSION = '.seg'
+# Sequence number of the first segment, leaves room for segments to be
+# created before it by `SpillQueue.prepend`
+FIRST_SEGMENT_SEQ = 10 ** 12
+
+
+def _crc32(data):
+    return zlib.crc32(data) & 0xffffffff
+
+
+class SpillSegment(object):
+    """
+    An append-only file of records, memory-mapped while it's being read or
+    written.
+    The file is created at its final size, filled with zeros, so an empty
+    record header marks the end of the written records. Popped records are
+    flagged in place as consumed, they are skipped when the segment is
+    loaded again.
+    """
+
+    def __init__(self, path, size=None):
+        self.path = path
+        if size is not None:
+            with open(path, 'wb') as f:
+                f.truncate(size)
+        self.size = os.path.getsize(path)
+
+        self._file = None
+        self._mmap = None
+        self.write_offset = 0
+        self.read_offset = 0
+        self.count = 0
+        self._load()
+
+    def _map(self):
+        if self._mmap is None:
+            self._file = open(self.path, 'r+b')
+            self._mmap = mmap.mmap(self._file.fileno(), self.size)
+        return self._mmap
+
+    def unmap(self):
+        if self._mmap is not None:
+            self._mmap.flush()
+            self._mmap.close()
+            self._file.close()
+            self._mmap = None
+            self._file = None
+
+    def _load(self):
+        mm = self._map()
+        offset = 0
+        while offset + RECORD_HEADER.size <= self.size:
+            length, crc, consumed = RECORD_HEADER.unpack_from(mm, offset)
+            end = offset + RECORD_HEADER.size + length
+            if length == 0 or end > self.size:
+                break
+            if _crc32(mm[offset + RECORD_HEADER.size:end]) != crc:
+                # Partially written record, nothing after it can be trusted
+                log.warning("Corrupted record in spill segment %s at offset %s, ignoring the rest of the segment",
+                            self.path, offset)
+                break
+            if consumed and self.read_offset == offset:
+                self.read_offset = end
+            elif not consumed:
+                self.count += 1
+            offset = end
+        self.write_offset = offset
+
+    def append(self, data):
+        """ Write a record, return False if there isn't enough room left for it. """
+        end = self.write_offset + RECORD_HEADER.size + len(data)
+        if end > self.size:
+            return False
+
+        mm = self._map()
+        mm[self.write_offset + RECORD_HEADER.size:end] = data
+        # Write the header last so that a record is never seen half written
+        mm[self.write_offset:self.write_offset + RECORD_HEADER.size] = \
+            RECORD_HEADER.pack(len(data), _crc32(data), 0)
+        self.write_offset = end
+        self.count += 1
+        return True
+
+    def popleft(self):
+        if not self.count:
+            return None
+
+        mm = self._map()
+        offset = self.read_offset
+        length, _, _ = RECORD_HEADER.unpack_from(mm, offset)
+        end = offset + RECORD_HEADER.size + length
+        data = mm[offset + RECORD_HEADER.size:end]
+        mm[offset + CONSUMED_FLAG_OFFSET] = '\x01'
+        self.read_offset = end
+        self.count -= 1
+        return data
+
+    def sync(self):
+        if self._mmap is not None:
+            self._mmap.flush()
+
+    def remove(self):
+        self.unmap()
+        try:
+            os.remove(self.path)
+        except OSError, e:
+            log.warning("Unable to remove spill segment %s: %s", self.path, e)
+
+
+class SpillQueue(object):
+    """
+    A FIFO of byte strings stored in segment files under `path`.
+    It survives restarts: segments found in `path` are loaded back in order.
+    Disk usage is bounded by `max_size`, when it's exceeded the oldest
+    segments are dropped. A segment which was just prepended is kept, it
+    holds the newest payloads even though it's at the head of the queue.
+    Only the first and last segments are memory-mapped at a given time.
+    """
+
+    def __init__(self, path, max_size, segment_size=DEFAULT_SEGMENT_SIZE):
+        self.path = path
+        self.max_size = max_size
+        self.segment_size = segment_size
+        self._segments = []  # (seq, SpillSegment), oldest first
+        self._count = 0
+        self._size = 0
+
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        self._load()
+
+    def _load(self):
+        seqs = []
+        for filename in os.listdir(self.path):
+            name, ext = os.path.splitext(filename)
+            if ext == SEGMENT_EXTENSION and name.isdigit():
+                seqs.append(int(name))
+
+        for seq in sorted(seqs):
+            segment = SpillSegment(self._segment_path(seq))
+            if not segment.count:
+                segment.remove()
+                continue
+            segment.unmap()
+            self._segments.append((seq, segment))
+            self._count += segment.count
+            self._size += segment.size
+
+        if self._count:
+            log.info("Loaded %s spilled payload(s) from %s", self._count, self.path)
+
+    def _segment_path(self, seq):
+        return os.path.join(self.path, "%020d%s" % (seq, SEGMENT_EXTENSION))
+
+    def _new_segment(self, seq, min_size):
+        segment = SpillSegment(self._segment_path(seq), size=max(self.segment_size, min_size))
+        self._size += segment.size
+        return segment
+
+    def __len__(self):
+        return self._count
+
+    def get_size(self):
+        return self._size
+
+    def append(self, data):
+        if self._segments:
+            seq, tail = self._segments[-1]
+            if tail.append(data):
+                self._count += 1
+                return
+            if len(self._segments) > 1:
+                tail.unmap()
+            seq += 1
+        else:
+            seq = FIRST_SEGMENT_SEQ
+
+        tail = self._new_segment(seq, RECORD_HEADER.size + len(data))
+        tail.append(data)
+        self._segments.append((seq, tail))
+        self._count += 1
+        self._enforce_max_size()
+
+    def prepend(self, items):
+        """ Insert `items` before the current head of the queue, in order. """
+        if not items:
+            return
+
+        seq = self._segments[0][0] - 1 if self._segments else FIRST_SEGMENT_SEQ
+        head = self._new_segment(seq, sum(RECORD_HEADER.size + len(data) for data in items))
+        for data in items:
+            head.append(data)
+        self._segments.insert(0, (seq, head))
+        self._count += len(items)
+        # The payloads queued before the prepended ones are older
+        self._enforce_max_size(keep_head=True)
+
+    def popleft(self):
+        while self._segments:
+            _, head = self._segments[0]
+            data = head.popleft()
+            if not head.count and (data is None or len(self._segments) > 1):
+                self._drop_head()
+            if data is not None:
+                self._count -= 1
+                return data
+        return None
+
+    def _drop_head(self):
+        self._drop_segment(0)
+
+    def _drop_segment(self, index):
+        _, segment = self._segments.pop(index)
+        self._count -= segment.count
+        self._size -= segment.size
+        segment.remove()
+
+    def _enforce_max_size(self, keep_head=False):
+        """ Drop the oldest segments past `max_size`, never the head if `keep_head` """
+        index = 1 if keep_head else 0
+        while self._size > self.max_size and len(self._segments) > 1:
+            lost = self._segments[index][1].count
+            self._drop_segment(index)
+            log.warning("Spill queue is too big, dropped %s payload(s)", lost)
+
+    def sync(self):
+        for _, segment in self._segments:
+            segment.sync()
+
+    def close(self):
+        for _, segment in self._segments:
+            segment.unmap()